@@ -0,0 +1,18 @@
+# Pre-warm the tracklet cache of source.utils for every drive of a raw dataset root, so that
+# the visualization scripts and cluster.py skip xml parsing from their first run on.
+from __future__ import print_function
+import glob
+import os
+import argparse
+from source.utils import load_tracklets_cached, TRACKLET_CACHE_DIR
+
+parser=argparse.ArgumentParser()
+parser.add_argument('--dataset_dir',type=str,help='raw dataset root of format base/date/drive',default='/data/KITTI')
+parser.add_argument('--cache_dir',type=str,help='cache dir',default=TRACKLET_CACHE_DIR)
+args = parser.parse_args()
+
+xml_paths = sorted(glob.glob(os.path.join(args.dataset_dir, '*', '*_sync', 'tracklet_labels.xml')))
+print('Found %d tracklet files under %s.' % (len(xml_paths), args.dataset_dir))
+for xml_path in xml_paths:
+    table = load_tracklets_cached(xml_path, args.cache_dir)
+    print('%s: %d tracklets, %d poses' % (xml_path, len(table), len(table.frames)))
@@ -6,7 +6,7 @@ import os
 import numpy as np
 from mayavi import mlab
 import time
-from source.utils import load_tracklets_for_frames, in_hull
+from source.utils import load_tracklets_for_frames, points_in_boxes_lists
 from source import parseTrackletXML as xmlParser
 import argparse
 from math import atan2, degrees
@@ -32,7 +32,7 @@ outdir = '%s/%s_%s' % (args.outdir,date,drive)
 
 dataset = pykitti.raw(basedir, date, drive)
 tracklet_rects, tracklet_types, tracklet_ids = load_tracklets_for_frames(len(list(dataset.velo)),\
-               '{}/{}/{}_drive_{}_sync/tracklet_labels.xml'.format(basedir,date, date, drive))
+               '{}/{}/{}_drive_{}_sync/tracklet_labels.xml'.format(basedir,date, date, drive))[:3]
 eval_dict = {i:{} for i in np.unique([j for i in tracklet_ids.values() for j in i]) }
 
 
@@ -76,17 +76,17 @@ for i,velo in enumerate(dataset.velo):
     if args.debug:
         manager.update(velo, labels)
     # evaluation
-    for j,box in enumerate(tracklet_rects[i]):
-        box = oxts_pose.dot( np.vstack((box, np.ones((1,8)) )) )  # register boxes
-        idx = in_hull(velo[:,:3],box[:3,:].T)
-        if sum(idx) == 0:
+    boxes = np.matmul(oxts_pose[:3,:3], tracklet_rects[i]) + oxts_pose[:3,3:]  # register boxes
+    box_points = points_in_boxes_lists(velo[:,:3], boxes.transpose(0, 2, 1))
+    for j,idx in enumerate(box_points):
+        if len(idx) == 0:
             continue
         lidx = np.unique(labels)
-        intersect = [len(np.intersect1d(np.where(idx)[0], np.where(labels==k)))\
+        intersect = [len(np.intersect1d(idx, np.where(labels==k)))\
               for k in lidx]
         cid = np.argmax(intersect)
         metric_u = float(intersect[cid])/(np.sum(labels==lidx[cid]))
-        metric_o = float(intersect[cid])/(np.sum(idx)) if np.sum(idx) else 0
+        metric_o = float(intersect[cid])/len(idx)
         eval_dict[tracklet_ids[i][j]].update({i:(metric_u, metric_o)})
         #if metric_o < 1 and metric_o > 0.95:
         #    manager = cluster_manager(debug=True)
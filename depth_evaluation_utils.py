@@ -4,8 +4,10 @@ import numpy as np
 # import pandas as pd
 import os
 import cv2
-from collections import Counter
+import multiprocessing
 import pickle
+from kitti_tools.utils_velo import load_velo_homo
+from kitti_tools.utils_calib import read_calib_file, get_calib_registry
 
 def compute_errors(gt, pred):
     thresh = np.maximum((gt / pred), (pred / gt))
@@ -109,9 +111,7 @@ def read_file_data(files, data_root): # read RAW data for depth evaluation
 
 def load_velodyne_points(file_name):
     # adapted from https://github.com/hunse/kitti
-    points = np.fromfile(file_name, dtype=np.float32).reshape(-1, 4)
-    points[:, 3] = 1.0  # homogeneous
-    return points
+    return load_velo_homo(file_name) # homogeneous
 
 
 def lin_interp(shape, xyd):
@@ -125,28 +125,8 @@ def lin_interp(shape, xyd):
     return disparity
 
 
-def read_calib_file(path):
-    # taken from https://github.com/hunse/kitti
-    float_chars = set("0123456789.e+- ")
-    data = {}
-    with open(path, 'r') as f:
-        for line in f.readlines():
-            key, value = line.split(':', 1)
-            value = value.strip()
-            data[key] = value
-            if float_chars.issuperset(value):
-                # try to cast to float array
-                try:
-                    data[key] = np.array([float(v) for v in value.split(' ')])
-                except ValueError:
-                    # casting error: data[key] already eq. value, so pass
-                    pass
-
-    return data
-
-
 def get_focal_length_baseline(calib_dir, cam=2):
-    cam2cam = read_calib_file(calib_dir + 'calib_cam_to_cam.txt')
+    cam2cam = get_calib_registry().read(calib_dir + 'calib_cam_to_cam.txt')
     P2_rect = cam2cam['P_rect_02'].reshape(3,4)
     P3_rect = cam2cam['P_rect_03'].reshape(3,4)
 
@@ -168,18 +148,36 @@ def sub2ind(matrixSize, rowSub, colSub):
     m, n = matrixSize
     return rowSub * (n-1) + colSub - 1
 
-def generate_depth_map(calib_dir, velo_file_name, im_shape, cam=2, interp=False, vel_depth=False):
-    # load calibration files
-    cam2cam = read_calib_file(calib_dir + 'calib_cam_to_cam.txt')
-    velo2cam = read_calib_file(calib_dir + 'calib_velo_to_cam.txt')
-    velo2cam = np.hstack((velo2cam['R'].reshape(3,3), velo2cam['T'][..., np.newaxis]))
-    velo2cam = np.vstack((velo2cam, np.array([0, 0, 0, 1.0])))
+def zbuffer_depth(im_shape, velo_pts_im):
+    # velo_pts_im: [*, 3] of (col, row, depth) with in-bound integer pixel coords
+    # pixels hit by several points keep the closest depth; duplicates are grouped
+    # by sub2ind exactly as the KITTI matlab code does, in a single sort
+    rows = velo_pts_im[:, 1].astype(int)
+    cols = velo_pts_im[:, 0].astype(int)
+    depth = np.zeros((im_shape))
+    depth[rows, cols] = velo_pts_im[:, 2]
+    if velo_pts_im.shape[0] == 0:
+        return depth
+
+    inds = sub2ind(depth.shape, velo_pts_im[:, 1], velo_pts_im[:, 0])
+    order = np.argsort(inds, kind='mergesort') # stable: first point of each group comes first
+    inds_sorted = inds[order]
+    starts = np.flatnonzero(np.r_[True, inds_sorted[1:] != inds_sorted[:-1]])
+    counts = np.diff(np.r_[starts, inds_sorted.shape[0]])
+    min_depth = np.minimum.reduceat(velo_pts_im[order, 2], starts)
+
+    dupe = counts > 1
+    first = order[starts[dupe]]
+    depth[rows[first], cols[first]] = min_depth[dupe]
+    return depth
+
+def get_velo2im(calib_dir, cam=2):
+    # [projection matrix] velodyne->image plane, composed once per calib_dir by the registry
+    return get_calib_registry().raw_calibs(calib_dir)['P_velo2im']['0'+str(cam)] # 4*3
 
-    # compute [projection matrix] velodyne->image plane
-    R_cam2rect = np.eye(4)
-    R_cam2rect[:3,:3] = cam2cam['R_rect_00'].reshape(3,3)
-    P_rect = cam2cam['P_rect_0'+str(cam)].reshape(3,4)
-    P_velo2im = np.dot(np.dot(P_rect, R_cam2rect), velo2cam) # 4*3
+def generate_depth_map(calib_dir, velo_file_name, im_shape, cam=2, interp=False, vel_depth=False, P_velo2im=None):
+    if P_velo2im is None:
+        P_velo2im = get_velo2im(calib_dir, cam)
 
     # load velodyne points and remove all behind image plane (approximation)
     # each row of the velodyne data is forward, left, up, reflectance
@@ -202,17 +200,7 @@ def generate_depth_map(calib_dir, velo_file_name, im_shape, cam=2, interp=False,
     velo_pts_im = velo_pts_im[val_inds, :]
 
     # project to image
-    depth = np.zeros((im_shape))
-    depth[velo_pts_im[:, 1].astype(np.int), velo_pts_im[:, 0].astype(np.int)] = velo_pts_im[:, 2]
-
-    # find the duplicate points and choose the closest depth
-    inds = sub2ind(depth.shape, velo_pts_im[:, 1], velo_pts_im[:, 0])
-    dupe_inds = [item for item, count in Counter(inds).iteritems() if count > 1]
-    for dd in dupe_inds:
-        pts = np.where(inds==dd)[0]
-        x_loc = int(velo_pts_im[pts[0], 0])
-        y_loc = int(velo_pts_im[pts[0], 1])
-        depth[y_loc, x_loc] = velo_pts_im[pts, 2].min()
+    depth = zbuffer_depth(im_shape, velo_pts_im)
     depth[depth<0] = 0
     # print(depth.shape) # (376, 1241)
 
@@ -224,4 +212,58 @@ def generate_depth_map(calib_dir, velo_file_name, im_shape, cam=2, interp=False,
         return depth
 
 
-
+def _depth_map_worker(job):
+    # module level so that it can be pickled by multiprocessing
+    P_velo2im, velo_file_name, im_shape, vel_depth = job
+    return generate_depth_map(None, velo_file_name, im_shape, vel_depth=vel_depth, P_velo2im=P_velo2im)
+
+class DepthMapGenerator(object):
+    """ Batched generate_depth_map with P_velo2im cached per (calib_dir, cam).
+
+    Usage:
+        generator = DepthMapGenerator(num_workers=8)
+        gt_files, gt_calib, im_sizes, im_files, cams = read_file_data(read_text_lines('test_files_eigen.txt'), data_root)
+        gt_depths = generator(gt_calib, gt_files, im_sizes, cams) # [B, H, W]
+    """
+    def __init__(self, num_workers=1, vel_depth=False):
+        self.num_workers = num_workers
+        self.vel_depth = vel_depth
+        self.P_velo2im_cache = {}
+
+    def get_P_velo2im(self, calib_dir, cam=2):
+        key = (calib_dir, cam)
+        if key not in self.P_velo2im_cache:
+            self.P_velo2im_cache[key] = get_velo2im(calib_dir, cam)
+        return self.P_velo2im_cache[key]
+
+    def __call__(self, calib_dirs, velo_file_names, im_shapes, cams=2):
+        """ calib_dirs, im_shapes and cams are either one value for all frames, or one per frame.
+            Frames of different sizes are zero-padded (i.e. no depth) to the largest [H, W]; the stack is float32,
+            the precision of the velodyne scans.
+        """
+        B = len(velo_file_names)
+        if isinstance(calib_dirs, str):
+            calib_dirs = [calib_dirs] * B
+        if len(np.shape(im_shapes)) == 1:
+            im_shapes = [im_shapes] * B
+        if isinstance(cams, int):
+            cams = [cams] * B
+
+        jobs = [(self.get_P_velo2im(calib_dir, cam), velo_file_name, tuple(im_shape), self.vel_depth) \
+            for calib_dir, velo_file_name, im_shape, cam in zip(calib_dirs, velo_file_names, im_shapes, cams)]
+        if self.num_workers > 1:
+            pool = multiprocessing.Pool(self.num_workers)
+            try:
+                depths = pool.map(_depth_map_worker, jobs, chunksize=max(1, B // (4 * self.num_workers)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            depths = [_depth_map_worker(job) for job in jobs]
+
+        H = max([depth.shape[0] for depth in depths] + [0])
+        W = max([depth.shape[1] for depth in depths] + [0])
+        depth_stack = np.zeros((B, H, W), dtype=np.float32)
+        for b, depth in enumerate(depths):
+            depth_stack[b, :depth.shape[0], :depth.shape[1]] = depth
+        return depth_stack
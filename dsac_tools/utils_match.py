@@ -0,0 +1,107 @@
+""" Descriptor matching with NumPy arrays instead of lists of cv2.DMatch.
+
+knn2_match is an exact brute-force 2-NN matcher (L2, as cv2.BFMatcher(cv2.NORM_L2).knnMatch(des1, des2, k=2)):
+squared distances come from one float32 GEMM per block of query descriptors, the two nearest are picked with
+two argmin passes and their distances recomputed exactly from the descriptors. knn2_from_cv2 turns the output of a
+cv2 knnMatch (e.g. FLANN) into the same arrays in one pass, and ratio_test applies Lowe's ratio test to them.
+
+BatchedMatcher does the same for many frame pairs of a drive with fixed-size descriptor sets (SIFT is cropped or
+padded to sift_num per frame): each frame is loaded once for all the pairs it is in and its descriptors augmented
+once with their squared norms, so that one GEMM per pair gives the distances to rank. block_size > 1 stacks pairs
+in one np.matmul, which on 2000 x 128 SIFT sets was no faster (it still runs one GEMM per pair) and needs a
+[block_size, M, M] buffer, hence the default of 1. On one core, with the dumped .npy files, dump_sift_match_idx took
+about 25 ms per pair with it against 290 ms with the per-pair FLANN matcher.
+"""
+from collections import OrderedDict
+import numpy as np
+
+def knn2_match(des1, des2, block_size=4096):
+    """ Two nearest neighbours in des2 [N2, D] of each row of des1 [N1, D] (N2 >= 2).
+        Returns dists [N1, 2] float32 (L2, nearest first) and idx [N1, 2] int32 (rows of des2).
+    """
+    des1 = np.ascontiguousarray(des1, dtype=np.float32)
+    des2 = np.ascontiguousarray(des2, dtype=np.float32)
+    assert des2.shape[0] >= 2, 'knn2_match needs at least 2 train descriptors!'
+    sq2 = np.einsum('ij,ij->i', des2, des2)
+    idx = np.empty((des1.shape[0], 2), dtype=np.int32)
+    for start in range(0, des1.shape[0], block_size):
+        des1_block = des1[start:start+block_size]
+        # |a - b|^2 up to |a|^2, which does not change the ranking of a row
+        d2 = np.dot(des1_block, des2.T)
+        d2 *= -2.
+        d2 += sq2[np.newaxis, :]
+        # two argmin passes (the second with the nearest masked) are much faster than an argpartition
+        rows = np.arange(d2.shape[0])
+        idx[start:start+block_size, 0] = first = d2.argmin(axis=1)
+        d2[rows, first] = np.inf
+        idx[start:start+block_size, 1] = d2.argmin(axis=1)
+    return knn2_dists(des1, des2, idx), idx
+
+def knn2_dists(des1, des2, idx):
+    """ Exact L2 distances [N1, 2] of the rows of des1 to their neighbours des2[idx]. """
+    return np.sqrt(np.square(des1[:, np.newaxis, :] - des2[idx]).sum(axis=2, dtype=np.float32))
+
+def knn2_from_cv2(matches):
+    """ dists [N, 2], query_idx [N] and idx [N, 2] of the k=2 output of a cv2 matcher (rows with fewer neighbours dropped). """
+    rows = [(m.queryIdx, m.trainIdx, n.trainIdx, m.distance, n.distance) for m, n in (mn for mn in matches if len(mn) == 2)]
+    rows = np.asarray(rows, dtype=np.float64).reshape((-1, 5))
+    return rows[:, 3:5].astype(np.float32), rows[:, 0].astype(np.int32), rows[:, 1:3].astype(np.int32)
+
+def ratio_test(dists, idx, ratio=0.8, query_idx=None):
+    """ Lowe's ratio test on knn2 arrays.
+        Returns all_ij, good_ij [N, 2] int32 (query, train) and quality_all, quality_good [N, 2] float32
+        ([distance, distance / second distance], the ratio is 1. where both are 0).
+    """
+    if query_idx is None:
+        query_idx = np.arange(dists.shape[0], dtype=np.int32)
+    all_ij = np.stack((query_idx, idx[:, 0]), axis=1).astype(np.int32)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = np.where(dists[:, 1] > 0, dists[:, 0] / dists[:, 1], 1.)
+    quality_all = np.stack((dists[:, 0], ratios), axis=1).astype(np.float32)
+    good = dists[:, 0] < ratio * dists[:, 1]
+    return all_ij, all_ij[good], quality_all, quality_all[good]
+
+class BatchedMatcher(object):
+    """ knn2_match of many frame pairs (i, j) of a drive.
+        des: [N_frames, M, D] descriptor stack, or a function frame index -> [M, D] (e.g. reading the dumped
+        features), whose results are kept for the last cache_size frames.
+    """
+    def __init__(self, des, block_size=1, cache_size=32):
+        self.load_des = des if callable(des) else des.__getitem__
+        self.block_size = block_size # pairs per batched GEMM, [block_size, M, M] float32 distances
+        self.cache_size = cache_size
+        self.cache = OrderedDict() # frame -> (des [M, D], [-2 des | 1] [M, D+1], [des | |des|^2]^T [D+1, M])
+
+    def get(self, frame):
+        """ A frame's descriptors, with their augmented versions: [-2 a | 1] . [b | |b|^2]^T = |a - b|^2 - |a|^2,
+            so that the GEMM gives the distances to rank without further passes over them.
+        """
+        if frame in self.cache:
+            self.cache.move_to_end(frame)
+        else:
+            des = np.ascontiguousarray(self.load_des(frame), dtype=np.float32)
+            ones = np.ones((des.shape[0], 1), dtype=np.float32)
+            sq = np.einsum('ij,ij->i', des, des)[:, np.newaxis]
+            self.cache[frame] = (des, np.hstack((-2. * des, ones)), np.ascontiguousarray(np.hstack((des, sq)).T))
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return self.cache[frame]
+
+    def knn2_pairs(self, pairs):
+        """ Yields (i, j, dists [M, 2], idx [M, 2]) as knn2_match(des[i], des[j]) for the pairs (i, j) in order
+            (sorted pairs, e.g. all (i, i+delta), keep the frames in the cache).
+        """
+        pairs = list(pairs)
+        for start in range(0, len(pairs), self.block_size):
+            block = pairs[start:start+self.block_size]
+            if len(set(self.get(frame)[0].shape for pair in block for frame in pair)) > 1: # not padded to one size
+                for i, j in block:
+                    yield (i, j) + knn2_match(self.get(i)[0], self.get(j)[0])
+                continue
+            d2 = np.matmul(np.stack([self.get(i)[1] for i, _ in block]), np.stack([self.get(j)[2] for _, j in block])) # [B, M1, M2]
+            idx = np.empty(d2.shape[:2] + (2,), dtype=np.int32)
+            idx[:, :, 0] = first = d2.argmin(axis=2)
+            np.put_along_axis(d2, first[:, :, np.newaxis], np.inf, axis=2)
+            idx[:, :, 1] = d2.argmin(axis=2)
+            for k, (i, j) in enumerate(block):
+                yield i, j, knn2_dists(self.get(i)[0], self.get(j)[0], idx[k]), idx[k]
@@ -122,7 +122,7 @@ def Rt_depad(Rt01):
 
 def vis_masks_to_inds(mask1, mask2):
     val_inds_both = mask1 & mask2
-    val_idxes = [idx for idx in range(val_inds_both.shape[0]) if val_inds_both[idx]] # within indexes
+    val_idxes = np.flatnonzero(val_inds_both) # within indexes, as an int array for a single fancy-index
     return val_idxes
 
 def normalize_Rt_to_1(Rt):
@@ -8,6 +8,7 @@ import dsac_tools.utils_vis as utils_vis
 import dsac_tools.utils_misc as utils_misc
 import dsac_tools.utils_F as utils_F
 import dsac_tools.utils_geo as utils_geo
+import dsac_tools.utils_match as utils_match
 
 def PIL_to_gray(im_PIL):
     img1_rgb = np.array(im_PIL)
@@ -40,14 +41,9 @@ def KNN_match(des1, des2, x1_all, x2_all, kp1, kp2, img1_rgb, img2_rgb, visualiz
     # https://opencv-python-tutroals.readthedocs.io/en/latest/py_tutorials/py_feature2d/py_matcher/py_matcher.html
     # des2 = np.vstack((des2, np.zeros((1, 128), dtype=des2.dtype)))
     # print(des1.shape, des2.shape)
-    if if_BF: # Use brute force matching
-        bf = cv2.BFMatcher(normType=cv2.NORM_L2)
-        matches = bf.knnMatch(des1,des2, k=2)
-        # # Apply ratio test
-        # good = []
-        # for m,n in matches:
-        #     if m.distance < 0.7*n.distance:
-        #         good.append(m)
+    if if_BF: # Use brute force matching (exact, in numpy: utils_match.knn2_match)
+        dists, idx = utils_match.knn2_match(des1, des2)
+        query_idx = None
     else:
         FLANN_INDEX_KDTREE = 0
         index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
@@ -56,24 +52,20 @@ def KNN_match(des1, des2, x1_all, x2_all, kp1, kp2, img1_rgb, img2_rgb, visualiz
         flann = cv2.FlannBasedMatcher(index_params, search_params)
 
         matches = flann.knnMatch(des1, des2, k=2) # another option is https://github.com/MagicLeapResearch/SuperPointPretrainedNetwork/blob/master/demo_superpoint.py#L309
+        dists, query_idx, idx = utils_match.knn2_from_cv2(matches)
     # print(matches)
     # store all the good matches as per Lowe's ratio test.
-    good = []
-    all_m = []
-    for m,n in matches:
-        all_m.append(m)
-        if if_ratio_test:
-            if m.distance < 0.8*n.distance:
-                good.append(m)
+    all_ij, good_ij, _, _ = utils_match.ratio_test(dists, idx, 0.8, query_idx)
     if not if_ratio_test:
-        good = all_m
-    x1 = x1_all[[mat.queryIdx for mat in good], :]
-    x2 = x2_all[[mat.trainIdx for mat in good], :]
+        good_ij = all_ij
+    x1 = x1_all[good_ij[:, 0], :]
+    x2 = x2_all[good_ij[:, 1], :]
     assert x1.shape == x2.shape
 
-    print('# good points: %d/(%d, %d)'%(len(good), des1.shape[0], des2.shape[0]))
+    print('# good points: %d/(%d, %d)'%(good_ij.shape[0], des1.shape[0], des2.shape[0]))
 
     if visualize:
+        good = [cv2.DMatch(int(i), int(j), float(np.linalg.norm(des1[i] - des2[j]))) for i, j in good_ij]
         draw_params = dict(matchColor = (0,255,0), # draw matches in green color
                            singlePointColor = None,
                            matchesMask = None, # draw only inliers
@@ -84,10 +76,7 @@ def KNN_match(des1, des2, x1_all, x2_all, kp1, kp2, img1_rgb, img2_rgb, visualiz
         plt.imshow(img3, 'gray')
         plt.show()
 
-    good_ij = [[mat.queryIdx for mat in good], [mat.trainIdx for mat in good]]
-    all_ij = [[mat.queryIdx for mat in all_m], [mat.trainIdx for mat in all_m]]
-
-    return x1, x2, np.asarray(all_ij).T.copy(), np.asarray(good_ij).T.copy()
+    return x1, x2, all_ij, good_ij
 
 def sample_and_check(x1, x2, img1_rgb, img2_rgb, img1_rgb_np, img2_rgb_np, F_gt, im_shape=None, \
     visualize=False, if_sample=True, colors=None, random_idx=None):
@@ -10,7 +10,7 @@ from mayavi import mlab
 mlab.options.offscreen = True
 from imayavi import *
 import time
-from source.utils import load_tracklets_for_frames, point_inside, in_hull
+from source.utils import load_tracklets_for_frames, point_inside, points_in_boxes_lists
 from source import parseTrackletXML as xmlParser
 import argparse
 from matplotlib import cm
@@ -32,7 +32,7 @@ outdir = '%s/%s_%s' % (args.outdir,date,drive)
 
 dataset = pykitti.raw(basedir, date, drive)
 tracklet_rects, tracklet_types, tracklet_ids = load_tracklets_for_frames(len(list(dataset.velo)),\
-               '{}/{}/{}_drive_{}_sync/tracklet_labels.xml'.format(basedir,date, date, drive))
+               '{}/{}/{}_drive_{}_sync/tracklet_labels.xml'.format(basedir,date, date, drive))[:3]
 dataset_gray = list(dataset.gray)
 dataset_rgb = list(dataset.rgb) 
 
@@ -70,11 +70,12 @@ for i,velo in enumerate(dataset.velo):
 
     # draw annotated objects
     filled_idx = np.zeros((velo.shape[0],),dtype=bool)
+    box_points = points_in_boxes_lists(velo[:,:3], tracklet_rects[i].transpose(0, 2, 1)) # indices of the points in each box; a point in overlapping boxes is in each, as with in_hull
     for j,box in enumerate(tracklet_rects[i]):
         draw_class.draw_box(box, tracklet_ids[i][j])
-        idx = in_hull(velo[:,:3],box[:3,:].T)
+        idx = box_points[j]
         draw_class.draw_cluster(velo[idx,:], tracklet_ids[i][j])
-        filled_idx |= idx
+        filled_idx[idx] = True
     
     # print other points
     draw_class.draw_cluster(velo[~filled_idx,:])
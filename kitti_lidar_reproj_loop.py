@@ -14,7 +14,7 @@ from mayavi import mlab
 mlab.options.offscreen = True
 from imayavi import *
 import time
-from source.utils import load_tracklets_for_frames, point_inside, in_hull
+from source.utils import load_tracklets_for_frames, point_inside, points_in_boxes_lists
 from source import parseTrackletXML as xmlParser
 import argparse
 from matplotlib import cm
@@ -83,7 +83,7 @@ for date in date_list:
         if not(os.path.isfile(tracklet_name)):
             print('!!!! Tracklet Not Found at:', tracklet_name)
             continue
-        tracklet_rects, tracklet_types, tracklet_ids = load_tracklets_for_frames(len(list(dataset.velo)), tracklet_name)
+        tracklet_rects, tracklet_types, tracklet_ids = load_tracklets_for_frames(len(list(dataset.velo)), tracklet_name)[:3]
         dataset_gray = list(dataset.gray)
         dataset_rgb = list(dataset.rgb) 
 
@@ -109,11 +109,12 @@ for date in date_list:
 
             # draw annotated objects
             filled_idx = np.zeros((velo.shape[0],),dtype=bool)
+            box_points = points_in_boxes_lists(velo[:,:3], tracklet_rects[frame_idx].transpose(0, 2, 1)) # indices of the points in each box; a point in overlapping boxes is in each, as with in_hull
             for j,box in enumerate(tracklet_rects[frame_idx]):
                 draw_class.draw_box(box, tracklet_ids[frame_idx][j])
-                idx = in_hull(velo[:,:3],box[:3,:].T)
+                idx = box_points[j]
                 draw_class.draw_cluster(velo[idx,:], tracklet_ids[frame_idx][j])
-                filled_idx |= idx
+                filled_idx[idx] = True
             
             # print other points
             draw_class.draw_cluster(velo[~filled_idx,:])
@@ -158,17 +159,7 @@ for date in date_list:
             velo_pts_im = velo_pts_im[val_inds, :]
 
             # project to image
-            depth = np.zeros((im_shape))
-            depth[velo_pts_im[:, 1].astype(np.int), velo_pts_im[:, 0].astype(np.int)] = velo_pts_im[:, 2]
-
-            # find the duplicate points and choose the closest depth
-            inds = sub2ind(depth.shape, velo_pts_im[:, 1], velo_pts_im[:, 0])
-            dupe_inds = [item for item, count in Counter(inds).iteritems() if count > 1]
-            for dd in dupe_inds:
-                pts = np.where(inds==dd)[0]
-                x_loc = int(velo_pts_im[pts[0], 0])
-                y_loc = int(velo_pts_im[pts[0], 1])
-                depth[y_loc, x_loc] = velo_pts_im[pts, 2].min()
+            depth = zbuffer_depth(im_shape, velo_pts_im)
             depth[depth<0] = np.nan
             ax_proj[0].clear()
             ax_proj[0].imshow(dataset_rgb[frame_idx][0])
@@ -5,6 +5,23 @@ import os
 import sys
 # sys.path.append('/home/ruizhu/Documents/Projects/kitti_instance_RGBD_utils/deepSfm_ori/FME')
 
+import argparse
+import multiprocessing as mp
+# ratio_CPU = 0.5
+# default_number_of_process = int(ratio_CPU * mp.cpu_count())
+default_number_of_process = 1 # to prevent congestion; SIFT and matrix operations in recfity points already takes advantage of multi-cores
+default_number_of_cores = max(1, int(0.8 * mp.cpu_count()))
+
+# BLAS/OpenMP read their thread counts from the environment when numpy, cv2 and torch load them (below), and the
+# sequence processes forked from here inherit them: set them to the per-sequence share of --num_cores first.
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+pre_parser = argparse.ArgumentParser(add_help=False)
+pre_parser.add_argument("--num_threads", type=int, default=default_number_of_process)
+pre_parser.add_argument("--num_cores", type=int, default=default_number_of_cores)
+pre_args, _ = pre_parser.parse_known_args()
+for var in THREAD_ENV_VARS:
+    os.environ[var] = str(max(1, pre_args.num_cores // pre_args.num_threads))
+
 import numpy as np 
 import scipy.misc
 import os
@@ -24,17 +41,16 @@ from torch.utils.data import Dataset
 # from config import get_config
 # config, unparsed = get_config()
 
-import argparse
 from pebble import ProcessPool
-import multiprocessing as mp
-# ratio_CPU = 0.5
-# default_number_of_process = int(ratio_CPU * mp.cpu_count())
-default_number_of_process = 1 # to prevent congestion; SIFT and matrix operations in recfity points already takes advantage of multi-cores
 import time
 
 parser = argparse.ArgumentParser(description='Foo')
 parser.add_argument("--dataset_dir", type=str, default="/data/KITTI/raw_meta/", help="path to dataset")   
-parser.add_argument("--num_threads", type=int, default=default_number_of_process, help="number of thread to load data")
+parser.add_argument("--calib_cache_file", type=str, default=None,
+                    help="cache of the parsed calibration files (default <dataset_dir>/calib_cache.npz, skipped if not writable)")
+parser.add_argument("--num_threads", type=int, default=default_number_of_process, help="number of sequences dumped in parallel (one process each)")
+parser.add_argument("--num_cores", type=int, default=default_number_of_cores,
+                    help="core budget, split evenly between the --num_threads sequence processes (BLAS/OpenCV/torch threads and match workers of each)")
 parser.add_argument("--cam_id", type=str, default='02', help="number of thread to load data")
 parser.add_argument("--img_height", type=int, default=376, help="number of thread to load data")
 parser.add_argument("--img_width", type=int, default=1241, help="number of thread to load data")
@@ -49,7 +65,25 @@ parser.add_argument("--with_sift", action='store_true', default=False,
                     help="If available (e.g. with KITTI), will store SIFT points ground truth along with images, for validation")
 parser.add_argument("--with_SP", action='store_true', default=False,
                     help="If available (e.g. with KITTI), will store SuperPoint points ground truth along with images, for validation")
+parser.add_argument("--sift_matcher", type=str, default='bf', choices=['bf', 'flann'],
+                    help="SIFT matcher with --with_sift: exact brute force on all pairs of a sequence (utils_match.BatchedMatcher), or OpenCV FLANN per pair")
 parser.add_argument("--dump_root", type=str, default='dump', help="Where to dump the data")
+parser.add_argument('--pipeline', action='store_true', default=False,
+                    help="Overlap image reading, feature extraction and writing of the frames of a sequence")
+parser.add_argument("--pipeline_workers", type=int, default=4, help="number of feature extraction threads with --pipeline")
+parser.add_argument("--img_format", type=str, default='jpg', choices=['jpg', 'png', 'pack'],
+                    help="format of the dumped frames: jpg, png (lossless) or pack (raw uint8 in images.pack, no encoding)")
+parser.add_argument("--jpg_quality", type=int, default=75, help="JPEG quality with --img_format jpg")
+parser.add_argument("--png_compression", type=int, default=3, help="zlib level (0-9) with --img_format png")
+parser.add_argument('--save_h5', action='store_true', default=False,
+                    help="Store the per-frame/per-pair arrays as .h5 files instead of .npy")
+parser.add_argument("--h5_compression", type=str, default='lzf', choices=['none', 'lzf', 'gzip'], help="compression of the .h5 files with --save_h5")
+parser.add_argument('--save_pack', action='store_true', default=False,
+                    help="Store the per-frame/per-pair arrays in a few append-only packs per sequence instead of one .npy file each")
+parser.add_argument('--resume', action='store_true', default=False,
+                    help="Skip the frames and matches the manifests of --dump_root record as dumped with the current parameters")
+parser.add_argument('--manifest_sha1', action='store_true', default=False,
+                    help="Also record the sha1 of every dumped file in the manifests (reads each file back after writing it)")
 
 # args = parser.parse_args('--dump --with_X --with_pose --with_sift \
 #     --static_frames_file /home/ruizhu/Documents/Projects/SfmLearner-Pytorch/data/static_frames.txt \
@@ -64,14 +98,53 @@ print(args)
 
 from kitti_odo_loader import KittiOdoLoader
 assert args.cam_id in ['00', '02'], 'Only supported left greyscale/color cameras (cam 00 or 02)!'
-data_loader = KittiOdoLoader(args.dataset_dir,
-                             img_height=args.img_height,
-                             img_width=args.img_width,
-                             cam_ids=[args.cam_id],
-                             get_X=args.with_X,
-                             get_pose=args.with_pose,
-                             get_sift=args.with_sift, 
-                             get_SP=args.with_SP)
+threads_per_drive = max(1, args.num_cores // args.num_threads)
+loader_kwargs = dict(img_height=args.img_height,
+                     img_width=args.img_width,
+                     cam_ids=[args.cam_id],
+                     get_X=args.with_X,
+                     get_pose=args.with_pose,
+                     get_sift=args.with_sift,
+                     get_SP=args.with_SP,
+                     if_BF_matcher=args.sift_matcher == 'bf',
+                     pipeline=args.pipeline,
+                     pipeline_workers=min(args.pipeline_workers, threads_per_drive),
+                     match_workers=threads_per_drive,
+                     resume=args.resume,
+                     save_npy=not args.save_h5,
+                     h5_compression=None if args.h5_compression == 'none' else args.h5_compression,
+                     save_pack=args.save_pack,
+                     img_format=args.img_format,
+                     jpg_quality=args.jpg_quality,
+                     png_compression=args.png_compression,
+                     calib_cache_file=args.calib_cache_file,
+                     manifest_sha1=args.manifest_sha1)
+data_loader = KittiOdoLoader(args.dataset_dir, **loader_kwargs)
+
+def limit_threads(n_threads):
+    """ Caps the intra-op threads of BLAS, OpenCV and torch in a sequence process. """
+    cv2.setNumThreads(n_threads)
+    import torch
+    torch.set_num_threads(n_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(n_threads)
+    except ImportError: # BLAS is already loaded: only the environment set at the top of the file reaches it
+        loaded = [os.environ.get(var) for var in THREAD_ENV_VARS]
+        if any(value != str(n_threads) for value in loaded):
+            logging.warning('threadpoolctl not found; BLAS keeps %s threads instead of %d.'%('/'.join(str(value) for value in loaded), n_threads))
+
+# One loader per sequence process, built by the pool initializer: tasks are module level functions and only
+# pickle their arguments (a closure over data_loader cannot be sent to the workers).
+worker_loader = None
+
+def init_dump_worker(dataset_dir, loader_kwargs, n_threads):
+    global worker_loader
+    limit_threads(n_threads)
+    worker_loader = KittiOdoLoader(dataset_dir, **loader_kwargs)
+
+def dump_drive_task(args, split, drive_path):
+    return worker_loader.dump_drive(args, drive_path, split=split, scene_data=None)
 
 # drive_path_test = data_loader.get_drive_path('2011_09_28', '0016')
 # data_loader.scenes = [drive_path_test]
@@ -86,28 +159,25 @@ sample_name_lists = []
 for split in ['train', 'test']:
     print('> Retrieving frames for %s...'%split)
     seconds = time.time()
-    def dump_scenes_from_drive(args, split, drive_path):
-        # scene = data_loader.collect_scene_from_drive(drive_path)
-        sample_name_list = data_loader.dump_drive(args, drive_path, split=split, scene_data=None)
-        return sample_name_list
-
     if args.num_threads == 1:
+        limit_threads(threads_per_drive)
         for drive_path in tqdm (data_loader.scenes[split]):
             print('Dumping ', drive_path)
-            sample_name_list = dump_scenes_from_drive(args, split, drive_path)
-            if split=='train':
+            sample_name_list = data_loader.dump_drive(args, drive_path, split=split, scene_data=None)
+            if split=='train' and sample_name_list:
                 sample_name_lists.append(sample_name_list)
             # time.sleep(10)
-    # else:
-    #     with ProcessPool(max_workers=args.num_threads) as pool:
-    #         tasks = pool.map(dump_scenes_from_drive, [args]*n_scenes[split], [split]*n_scenes[split], data_loader.scenes[split])
-    #         try:
-    #             for result in tqdm(tasks.result(), total=n_scenes[split]):
-    #                 if split=='train':
-    #                     sample_name_lists.append(result)
-    #         except KeyboardInterrupt as e:
-    #             tasks.cancel()
-    #             raise e
+    else:
+        print('Dumping %d sequences at a time, %d threads each.'%(args.num_threads, threads_per_drive))
+        with ProcessPool(max_workers=args.num_threads, initializer=init_dump_worker, initargs=(args.dataset_dir, loader_kwargs, threads_per_drive)) as pool:
+            tasks = pool.map(dump_drive_task, [args]*n_scenes[split], [split]*n_scenes[split], data_loader.scenes[split])
+            try:
+                for result in tqdm(tasks.result(), total=n_scenes[split]):
+                    if split=='train' and result:
+                        sample_name_lists.append(result)
+            except KeyboardInterrupt as e:
+                tasks.cancel()
+                raise e
     print("<<< Finished dump %s scenes. "%split, time.time() - seconds)
 
 sample_name_flat_list = [item for sublist in sample_name_lists for item in sublist]
@@ -20,6 +20,8 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(BASE_DIR)
 sys.path.append(ROOT_DIR)
 import traceback
+import queue
+import threading
 
 import coloredlogs, logging
 logging.basicConfig()
@@ -28,8 +30,16 @@ coloredlogs.install(level='INFO', logger=logger)
 
 import cv2
 
-from kitti_tools.utils_kitti import load_velo_scan, rectify, read_calib_file, transform_from_rot_trans, scale_intrinsics, scale_P
+from kitti_tools.utils_kitti import load_velo_scan, load_velo_homo, open_velo_pack, rectify, velo_proj_transform, read_calib_file, transform_from_rot_trans, scale_intrinsics, scale_P, calibs_hash
+from kitti_tools.utils_calib import get_calib_registry, read_odo_calib_file
+from kitti_tools.utils_poses import RelativePoses
+from kitti_tools.utils_manifest import DumpManifest, params_key
+from kitti_tools.utils_pack import RecordPackWriter, frame_key, pair_key
+from kitti_tools.utils_good import saveh5
+from kitti_tools.utils_imwrite import ImageWriter
 import dsac_tools.utils_misc as utils_misc
+import dsac_tools.utils_match as utils_match
+from dsac_tools.utils_match import BatchedMatcher
 # from utils_good import *
 from glob import glob
 from dsac_tools.utils_misc import crop_or_pad_choice
@@ -55,11 +65,26 @@ class KittiOdoLoader(object):
                  get_SP=False,
                  sift_num=2000,
                  if_BF_matcher=False,
-                 save_npy=True):
+                 save_npy=True,
+                 pipeline=False,
+                 pipeline_workers=4,
+                 pipeline_queue_size=16,
+                 match_workers=default_number_of_process,
+                 resume=False,
+                 save_pack=False,
+                 h5_compression='lzf',
+                 img_format='jpg',
+                 jpg_quality=75,
+                 png_compression=3,
+                 img_writer_threads=2,
+                 calib_cache_file=None,
+                 manifest_sha1=False):
                  # depth_size_ratio=1):
         dir_path = Path(__file__).realpath().dirname()
 
         self.dataset_dir = Path(dataset_dir)
+        self.calib_cache_file = self.dataset_dir/'calib_cache.npz' if calib_cache_file is None else Path(calib_cache_file)
+        get_calib_registry().scan(self.dataset_dir, cache_file=self.calib_cache_file) # parse all calibration files once, or load them from the cache
         self.img_height = img_height
         self.img_width = img_width
         self.cam_ids = cam_ids
@@ -80,14 +105,27 @@ class KittiOdoLoader(object):
         self.get_sift = get_sift
         self.get_SP = get_SP
         self.save_npy = save_npy
+        self.img_format = img_format # of the dumped frames, see utils_imwrite.ImageWriter
+        self.jpg_quality = jpg_quality
+        self.png_compression = png_compression
+        self.img_writer_threads = img_writer_threads
+        self.h5_compression = h5_compression # of the .h5 files (save_npy=False): None, 'lzf' or 'gzip'
+        self.save_pack = save_pack # X, sift, SP and matches in a few append-only packs per drive (utils_pack) instead of one file per frame/pair
+        self.pipeline = pipeline # dump_drive: reader thread -> pipeline_workers feature threads -> writer, at most pipeline_queue_size frames in flight
+        self.pipeline_workers = pipeline_workers
+        self.pipeline_queue_size = pipeline_queue_size
+        self.match_workers = match_workers # processes for the SIFT/SP matches of a drive
+        self.resume = resume # dump_drive skips the artifacts its manifest records as done with the current parameters
+        self.manifest_sha1 = manifest_sha1 # also record the sha1 of every dumped file (reads each one back, see DumpManifest)
         if self.save_npy:
             logging.info('+++ Dumping as npy')
         else:
             logging.info('+++ Dumping as h5')
         if self.get_sift:
             self.sift_num = sift_num
+            self.sift_contrast_threshold = 1e-5
             self.if_BF_matcher = if_BF_matcher
-            self.sift = cv2.xfeatures2d.SIFT_create(nfeatures=self.sift_num, contrastThreshold=1e-5)
+            self.sift = self.make_sift()
             # self.bf = cv2.BFMatcher(normType=cv2.NORM_L2)
             # FLANN_INDEX_KDTREE = 0
             # index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
@@ -166,14 +204,10 @@ class KittiOdoLoader(object):
             date = drive_in_raw[:10]
             seq = drive_in_raw[-4:]
             calib_path_in_raw = Path(self.dataset_dir)/'raw'/date
-            imu2velo_dict = read_calib_file(calib_path_in_raw/'calib_imu_to_velo.txt')
-            velo2cam_dict = read_calib_file(calib_path_in_raw/'calib_velo_to_cam.txt')
-            cam2cam_dict = read_calib_file(calib_path_in_raw/'calib_cam_to_cam.txt')
-            velo2cam_mat = transform_from_rot_trans(velo2cam_dict['R'], velo2cam_dict['T'])
-            imu2velo_mat = transform_from_rot_trans(imu2velo_dict['R'], imu2velo_dict['T'])
-            cam_2rect_mat = transform_from_rot_trans(cam2cam_dict['R_rect_00'], np.zeros(3))
-            scene_data['calibs'].update({'K': intrinsics, 'P_rect_ori_dict': P_rect_ori_dict, 'cam_2rect': cam_2rect_mat, 'velo2cam': velo2cam_mat})
+            raw_calibs = get_calib_registry().raw_calibs(calib_path_in_raw) # parsed once per date, transforms pre-composed
+            scene_data['calibs'].update({'K': intrinsics, 'P_rect_ori_dict': P_rect_ori_dict, 'cam_2rect': raw_calibs['cam_2rect'], 'velo2cam': raw_calibs['velo2cam']})
             scene_data['calibs'].update(calibs_rects)
+            scene_data['calibs']['T_velo_proj'] = velo_proj_transform(scene_data['calibs']) # composite velo->cam0/rect/image, once per scene
 
             # Get pose
             poses = np.genfromtxt(self.dataset_dir/'poses'/'{}.txt'.format(drive_path[-2:])).astype(np.float32).reshape(-1, 3, 4)
@@ -185,23 +219,54 @@ class KittiOdoLoader(object):
             train_scenes.append(scene_data)
         return train_scenes
 
-    def construct_sample(self, scene_data, idx, frame_id, show_zoom_info):
-        img, zoom_xy, img_ori = self.load_image(scene_data, idx, show_zoom_info)
+    def make_sift(self):
+        """ A SIFT detector with the parameters of artifact_keys()['sift'] (one per thread, see iter_samples_pipelined). """
+        return cv2.xfeatures2d.SIFT_create(nfeatures=self.sift_num, contrastThreshold=self.sift_contrast_threshold)
+
+    def frame_artifacts(self):
+        return [artifact for artifact, enabled in [('img', True), ('X', self.get_X), ('sift', self.get_sift), ('SP', self.get_SP)] if enabled]
+
+    def needs_image(self, artifacts):
+        return artifacts is None or len(set(artifacts) & set(['img', 'sift', 'SP'])) > 0
+
+    def artifact_keys(self, scene_data):
+        """ Parameters of each artifact of a drive (utils_manifest.params_key); when they change, --resume recomputes the
+            artifact (and what is derived from it).
+        """
+        keys = {'frame': params_key(self.img_height, self.img_width, scene_data['cid'], scene_data['calibs']['zoom_xy'])} # the image the features are computed on
+        storage = 'pack' if self.save_pack else 'npy' if self.save_npy else ('h5', self.h5_compression) # where X/sift/SP and matches go
+        keys['img'] = params_key(keys['frame'], self.img_format, self.jpg_quality if self.img_format == 'jpg' else self.png_compression if self.img_format == 'png' else None)
+        keys['X'] = params_key(keys['frame'], storage, calibs_hash(dict((key, scene_data['calibs'][key]) for key in ['T_velo_proj', 'K']), scene_data['calibs']['im_shape']))
+        keys['sift'] = params_key(keys['frame'], storage, getattr(self, 'sift_num', None), getattr(self, 'sift_contrast_threshold', None)) # as make_sift
+        keys['SP'] = params_key(keys['frame'], storage, self.config_SP['model'], self.config_SP['pretrained']) if self.get_SP else None
+        keys['sift_match'] = params_key(keys['sift'], getattr(self, 'if_BF_matcher', None))
+        return keys
+
+    def construct_sample(self, scene_data, idx, frame_id, show_zoom_info, image=None, sift=None, lock_SP=None, artifacts=None):
+        """ image: load_image output if already loaded; sift, lock_SP: per-thread SIFT detector and a lock shared
+            around the SuperPoint front end, when called from several threads (see iter_samples_pipelined);
+            artifacts: subset of frame_artifacts() to compute (default all).
+        """
+        artifacts = self.frame_artifacts() if artifacts is None else artifacts
+        if image is None and self.needs_image(artifacts):
+            image = self.load_image(scene_data, idx, show_zoom_info)
+        img, zoom_xy, img_ori = (None, None, None) if image is None else image
         # print(img.shape, img_ori.shape)
-        sample = {"img":img, "id":frame_id}
-        if self.get_X:
-            velo = load_velo(scene_data, idx)
-            if velo is None:
+        sample = {"id":frame_id}
+        if 'img' in artifacts:
+            sample["img"] = img
+        if 'X' in artifacts:
+            velo_homo = load_velo(scene_data, idx, homo=True)
+            if velo_homo is None:
                 logging.error('0 velo in %s. Skipped.'%scene_data['dir'])
-            velo_homo = utils_misc.homo_np(velo)
-            val_idxes, X_rect, X_cam0 = rectify(velo_homo, scene_data['calibs']) # list, [N, 3]
-            sample['X_cam2_vis'] = X_rect[val_idxes].astype(np.float32)
-            sample['X_cam0_vis'] = X_cam0[val_idxes].astype(np.float32)
+            val_idxes, X_rect, X_cam0 = rectify(velo_homo, scene_data['calibs']) # [M] int, [N, 3]
+            sample['X_cam2_vis'] = X_rect[val_idxes].astype(np.float32, copy=False)
+            sample['X_cam0_vis'] = X_cam0[val_idxes].astype(np.float32, copy=False)
         if self.get_pose:
             sample['pose'] = scene_data['poses'][idx].astype(np.float32)
-        if self.get_sift:
+        if 'sift' in artifacts:
             # logging.info('Getting sift for frame %d/%d.'%(idx, scene_data['N_frames']))
-            kp, des = self.sift.detectAndCompute(img_ori, None) ## IMPORTANT: normalize these points
+            kp, des = (self.sift if sift is None else sift).detectAndCompute(img_ori, None) ## IMPORTANT: normalize these points
             x_all = np.array([p.pt for p in kp])
             # print(zoom_xy)
             x_all = (x_all * np.array([[zoom_xy[0], zoom_xy[1]]])).astype(np.float32)
@@ -212,10 +277,11 @@ class KittiOdoLoader(object):
                 des = des[choice]
             sample['sift_kp'] = x_all
             sample['sift_des'] = des
-        if self.get_SP:
+        if 'SP' in artifacts:
             img_ori_gray = cv2.cvtColor(img_ori, cv2.COLOR_RGB2GRAY)
             img = torch.from_numpy(img_ori_gray).float().unsqueeze(0).unsqueeze(0).float() / 255.
-            pts, desc, _, heatmap = self.fe.run(img)
+            with lock_SP or threading.Lock():
+                pts, desc, _, heatmap = self.fe.run(img)
             pts = pts[0].T # [N, 3]
             pts[:, :2] = (pts[:, :2] * np.array([[zoom_xy[0], zoom_xy[1]]])).astype(np.float32)
             desc = desc[0].T # [N, 256]
@@ -223,6 +289,76 @@ class KittiOdoLoader(object):
             sample['SP_des'] = desc
         return sample
 
+    def iter_samples(self, scene_data, todo=None):
+        """ Samples of all frames; todo: artifacts to compute per frame (default all). """
+        for idx in range(scene_data['N_frames']):
+            frame_id = scene_data['frame_ids'][idx]
+            assert int(frame_id)==idx
+            yield self.construct_sample(scene_data, idx, frame_id, show_zoom_info=False, artifacts=None if todo is None else todo[idx])
+
+    def iter_samples_pipelined(self, scene_data, todo=None):
+        """ Same samples as iter_samples, in order: a reader thread loads the images, pipeline_workers threads run
+            construct_sample on them, and the caller consumes (writes) the samples. At most pipeline_queue_size frames
+            are in flight, so the reader waits for the writer when it falls behind.
+        """
+        N_frames = scene_data['N_frames']
+        in_flight = threading.Semaphore(self.pipeline_queue_size)
+        image_queue = queue.Queue(maxsize=self.pipeline_queue_size)
+        sample_queue = queue.Queue() # bounded by in_flight
+        stop = threading.Event()
+        lock_SP = threading.Lock()
+
+        def reader():
+            for idx in range(N_frames):
+                in_flight.acquire()
+                if stop.is_set():
+                    break
+                frame_id = scene_data['frame_ids'][idx]
+                artifacts = None if todo is None else todo[idx]
+                try:
+                    assert int(frame_id)==idx
+                    image = self.load_image(scene_data, idx, show_zoom_info=False) if self.needs_image(artifacts) else None
+                    image_queue.put((idx, frame_id, image, artifacts))
+                except Exception as e:
+                    sample_queue.put((idx, e))
+                    break
+            for _ in range(self.pipeline_workers):
+                image_queue.put(None)
+
+        def worker():
+            # OpenCV SIFT detectors are not shared across threads
+            sift = self.make_sift() if self.get_sift else None
+            while True:
+                item = image_queue.get()
+                if item is None:
+                    return
+                idx, frame_id, image, artifacts = item
+                if stop.is_set():
+                    continue
+                try:
+                    sample = self.construct_sample(scene_data, idx, frame_id, show_zoom_info=False, image=image, sift=sift, lock_SP=lock_SP, artifacts=artifacts)
+                except Exception as e:
+                    sample = e
+                sample_queue.put((idx, sample))
+
+        threads = [threading.Thread(target=reader, daemon=True)] + [threading.Thread(target=worker, daemon=True) for _ in range(self.pipeline_workers)]
+        for thread in threads:
+            thread.start()
+        pending = {} # samples done ahead of the next one to write
+        try:
+            for idx in range(N_frames):
+                while idx not in pending:
+                    done_idx, sample = sample_queue.get()
+                    pending[done_idx] = sample
+                sample = pending.pop(idx)
+                if isinstance(sample, Exception):
+                    raise sample
+                yield sample
+                in_flight.release()
+        finally:
+            stop.set()
+            in_flight.release() # wake up the reader if it is waiting
+
     def dump_drive(self, args, drive_path, split, scene_data=None):
         assert split in ['train', 'test']
         if scene_data is None:
@@ -243,65 +379,113 @@ class KittiOdoLoader(object):
         poses_file = dump_dir/'poses'
         poses = []
 
+        # What was already written, with which parameters (see utils_manifest)
+        keys = self.artifact_keys(scene_data)
+        if not self.resume:
+            DumpManifest.clear(dump_dir)
+        manifest = DumpManifest(dump_dir, sha1=self.manifest_sha1)
+        frames_pack = RecordPackWriter(dump_dir/'frames.pack', append=self.resume) if self.save_pack else None
+        img_writer = ImageWriter(dump_dir, self.img_format, self.jpg_quality, self.png_compression, num_threads=self.img_writer_threads, \
+            append=self.resume)
+        def done(frame_id, artifact):
+            if artifact == 'img':
+                in_pack = frame_id in img_writer
+            else:
+                in_pack = frames_pack is None or frame_key(artifact, frame_id) in frames_pack
+            return self.resume and manifest.done(frame_id, artifact, keys[artifact]) and in_pack
+        todo = [[artifact for artifact in self.frame_artifacts() if not done(frame_id, artifact)] for frame_id in scene_data['frame_ids']]
+        if self.resume:
+            logging.info('Resuming: %d/%d frames already dumped.'%(sum(len(artifacts)==0 for artifacts in todo), scene_data['N_frames']))
+
         logging.info('Dumping %d samples to %s...'%(scene_data['N_frames'], dump_dir))
         sample_name_list = []
         # sift_des_list = []
-        for idx in tqdm(range(scene_data['N_frames'])):
-            frame_id = scene_data['frame_ids'][idx]
-            assert int(frame_id)==idx
-            sample = self.construct_sample(scene_data, idx, frame_id, show_zoom_info=False)
-
-            img, frame_nb = sample["img"], sample["id"]
-            dump_img_file = dump_dir/'{}.jpg'.format(frame_nb)
-            scipy.misc.imsave(dump_img_file, img)
+        samples = self.iter_samples_pipelined(scene_data, todo) if self.pipeline else self.iter_samples(scene_data, todo)
+        for sample in tqdm(samples, total=scene_data['N_frames']):
+            frame_nb = sample["id"]
+            if "img" in sample.keys():
+                img_writer.write(frame_nb, sample["img"]) # encoded and written in the background
+            for written_nb, files in img_writer.pop_written():
+                manifest.add(written_nb, 'img', keys['img'], files)
             if "pose" in sample.keys():
                 poses.append(sample["pose"].astype(np.float32))
             if "X_cam0_vis" in sample.keys():
                 dump_X_cam0_file = dump_dir/'X_cam0_{}'.format(frame_nb)
                 dump_X_cam2_file = dump_dir/'X_cam2_{}'.format(frame_nb)
-                if self.save_npy:
+                if self.save_pack:
+                    frames_pack.add(frame_key('X', frame_nb), {"X_cam0_vis": sample["X_cam0_vis"], "X_cam2_vis": sample["X_cam2_vis"]})
+                    manifest.add(frame_nb, 'X', keys['X'], [])
+                elif self.save_npy:
                     np.save(dump_X_cam0_file+'.npy', sample["X_cam0_vis"])
                     np.save(dump_X_cam2_file+'.npy', sample["X_cam2_vis"])
+                    manifest.add(frame_nb, 'X', keys['X'], [dump_X_cam0_file+'.npy', dump_X_cam2_file+'.npy'])
                 else:
-                    saveh5({"X_cam0_vis": sample["X_cam0_vis"], "X_cam2_vis": sample["X_cam2_vis"]}, dump_X_file+'.h5')
+                    dump_X_file = dump_dir/'X_{}'.format(frame_nb)
+                    saveh5({"X_cam0_vis": sample["X_cam0_vis"], "X_cam2_vis": sample["X_cam2_vis"]}, dump_X_file+'.h5', compression=self.h5_compression)
+                    manifest.add(frame_nb, 'X', keys['X'], [dump_X_file+'.h5'])
             if "sift_kp" in sample.keys():
                 dump_sift_file = dump_dir/'sift_{}'.format(frame_nb)
-                if self.save_npy:
+                if self.save_pack:
+                    frames_pack.add(frame_key('sift', frame_nb), {'sift_kp': sample['sift_kp'], 'sift_des': sample['sift_des']})
+                    manifest.add(frame_nb, 'sift', keys['sift'], [])
+                elif self.save_npy:
                     np.save(dump_sift_file+'.npy', np.hstack((sample['sift_kp'], sample['sift_des'])))
+                    manifest.add(frame_nb, 'sift', keys['sift'], [dump_sift_file+'.npy'])
                 else:
-                    saveh5({'sift_kp': sample['sift_kp'], 'sift_des': sample['sift_des']}, dump_sift_file+'.h5')
+                    saveh5({'sift_kp': sample['sift_kp'], 'sift_des': sample['sift_des']}, dump_sift_file+'.h5', compression=self.h5_compression)
+                    manifest.add(frame_nb, 'sift', keys['sift'], [dump_sift_file+'.h5'])
                 # sift_des_list.append(sample['sift_des'])
             if "SP_kp" in sample.keys():
                 dump_sift_file = dump_dir/'SP_{}'.format(frame_nb)
-                if self.save_npy:
+                if self.save_pack:
+                    frames_pack.add(frame_key('SP', frame_nb), {'SP_kp': sample['SP_kp'], 'SP_des': sample['SP_des']})
+                    manifest.add(frame_nb, 'SP', keys['SP'], [])
+                elif self.save_npy:
                     np.save(dump_sift_file+'.npy', np.hstack((sample['SP_kp'], sample['SP_des'])))
+                    manifest.add(frame_nb, 'SP', keys['SP'], [dump_sift_file+'.npy'])
                     # print(sample['SP_kp'].shape, sample['SP_des'].shape)
                 else:
-                    pass
+                    saveh5({'SP_kp': sample['SP_kp'], 'SP_des': sample['SP_des']}, dump_sift_file+'.h5', compression=self.h5_compression)
+                    manifest.add(frame_nb, 'SP', keys['SP'], [dump_sift_file+'.h5'])
 
             sample_name_list.append('%s %s'%(dump_dir[-5:], frame_nb))
+        if frames_pack is not None:
+            frames_pack.close() # complete before the match processes read it
+        img_writer.close()
+        for written_nb, files in img_writer.pop_written():
+            manifest.add(written_nb, 'img', keys['img'], files)
 
         # Get all poses    
+        delta_ijs = [1, 2, 3, 5, 8, 10]
+        # delta_ijs = [1]
         if "pose" in sample.keys():      
             if len(poses) != 0:
                 # np.savetxt(poses_file, np.array(poses).reshape(-1, 16), fmt='%.20e')a
                 if self.save_npy:
                     np.save(poses_file+'.npy', np.stack(poses).reshape(-1, 3, 4))
                 else:
-                    saveh5({"poses": np.array(poses).reshape(-1, 3, 4)}, poses_file+'.h5')
+                    saveh5({"poses": np.array(poses).reshape(-1, 3, 4)}, poses_file+'.h5', compression=self.h5_compression)
+                # camera/scene motion of every pair the matches below are dumped for, from poses inverted once
+                ij_poses = RelativePoses(scene_data['poses'], scene_data['calibs']['Rtl_gt']).pairs(delta_ijs)
+                ij_poses = dict((key, value.astype(np.float32) if value.dtype == np.float64 else value) for key, value in ij_poses.items())
+                ij_poses_file = dump_dir/'ij_poses'
+                if self.save_npy:
+                    np.savez(ij_poses_file+'.npz', **ij_poses)
+                else:
+                    saveh5(ij_poses, ij_poses_file+'.h5', compression=self.h5_compression)
 
         # Get SIFT matches
         if self.get_sift:
-            delta_ijs = [1, 2, 3, 5, 8, 10]
-            # delta_ijs = [1]
             num_tasks = len(delta_ijs)
-            num_workers = min(len(delta_ijs), default_number_of_process)
+            num_workers = min(len(delta_ijs), self.match_workers)
             # num_workers = 1
             logging.info('Getting SIFT matches on %d workers for delta_ijs = %s'%(num_workers, ' '.join(str(e) for e in delta_ijs)))
 
             with ProcessPool(max_workers=num_workers) as pool:
                 tasks = pool.map(dump_sift_match_idx, delta_ijs, [scene_data['N_frames']]*num_tasks, \
-                    [dump_dir]*num_tasks, [self.save_npy]*num_tasks, [self.if_BF_matcher]*num_tasks)
+                    [dump_dir]*num_tasks, [self.save_npy]*num_tasks, [self.if_BF_matcher]*num_tasks, \
+                    [keys['sift_match']]*num_tasks, [self.resume]*num_tasks, [self.save_pack]*num_tasks, [self.h5_compression]*num_tasks, \
+                    [self.manifest_sha1]*num_tasks)
                 try:
                     for _ in tqdm(tasks.result(), total=num_tasks):
                         pass
@@ -311,17 +495,17 @@ class KittiOdoLoader(object):
 
         # Get SP matches
         if self.get_SP:
-            delta_ijs = [1, 2, 3, 5, 8, 10]
             nn_threshes = [0.7, 1.0]
-            # delta_ijs = [1]
             num_tasks = len(delta_ijs)
-            num_workers = min(len(delta_ijs), default_number_of_process)
+            num_workers = min(len(delta_ijs), self.match_workers)
             # num_workers = 1
             logging.info('Getting SP matches on %d workers for delta_ijs = %s'%(num_workers, ' '.join(str(e) for e in delta_ijs)))
 
             with ProcessPool(max_workers=num_workers) as pool:
                 tasks = pool.map(dump_SP_match_idx, delta_ijs, [scene_data['N_frames']]*num_tasks, \
-                    [dump_dir]*num_tasks, [self.save_npy]*num_tasks, [nn_threshes]*num_tasks)
+                    [dump_dir]*num_tasks, [self.save_npy]*num_tasks, [nn_threshes]*num_tasks, \
+                    [params_key(keys['SP'], nn_threshes)]*num_tasks, [self.resume]*num_tasks, [self.save_pack]*num_tasks, [self.h5_compression]*num_tasks, \
+                    [self.manifest_sha1]*num_tasks)
                 try:
                     for _ in tqdm(tasks.result(), total=num_tasks):
                         pass
@@ -332,7 +516,8 @@ class KittiOdoLoader(object):
             # for delta_ij in delta_ijs:
             #     dump_match_idx(delta_ij, scene_data['N_frames'], sift_des_list, dump_dir, self.save_npy, self.if_BF_matcher)
 
-        if len(dump_dir.files('*.jpg')) < 2:
+        manifest.close()
+        if len(img_writer) < 2:
             dump_dir.rmtree()
 
         return sample_name_list
@@ -378,25 +563,54 @@ class KittiOdoLoader(object):
         calibs_rects = {'Rtl_gt': Rtl_gt}
         return calibs_rects
 
-def dump_sift_match_idx(delta_ij, N_frames, dump_dir, save_npy, if_BF_matcher):
-    if if_BF_matcher: # OpenCV sift matcher must be created inside each thread (because it does not support sharing across threads!)
-        bf = cv2.BFMatcher(normType=cv2.NORM_L2)
-        sift_matcher = bf
-    else:
+def pair_match_key(manifest, match_key, artifact, ii, jj):
+    """ Key of the matches of pair ii-jj: match_key and the recorded versions of both frames' features (artifact 'sift'
+        or 'SP'), so that the matches of a frame whose features were recomputed are recomputed too.
+    """
+    return params_key(match_key, manifest.version('%06d'%ii, artifact), manifest.version('%06d'%jj, artifact))
+
+def dump_sift_match_idx(delta_ij, N_frames, dump_dir, save_npy, if_BF_matcher, match_key=None, resume=False, save_pack=False, h5_compression=None, manifest_sha1=False):
+    if if_BF_matcher: # exact brute force in numpy, all pairs of the drive in batches (utils_match.BatchedMatcher)
+        sift_matcher = None
+    else: # OpenCV sift matcher must be created inside each thread (because it does not support sharing across threads!)
         FLANN_INDEX_KDTREE = 0
         index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
         search_params = dict(checks = 50)
         flann = cv2.FlannBasedMatcher(index_params, search_params)
         sift_matcher = flann
 
-    for ii in tqdm(range(N_frames-delta_ij)):
-        jj = ii + delta_ij
-
-        sift_kps_ii, sift_des_ii = load_sift(dump_dir, '%06d'%ii, ext='.npy' if save_npy else '.h5')
-        sift_kps_jj, sift_des_jj = load_sift(dump_dir, '%06d'%jj, ext='.npy' if save_npy else '.h5')
+    manifest = DumpManifest(dump_dir, 'sift_match_%d'%delta_ij, sha1=manifest_sha1)
+    pairs_pack = RecordPackWriter(dump_dir/'sift_match_%d.pack'%delta_ij, append=resume) if save_pack else None
+    ext = '.pack' if save_pack else ('.npy' if save_npy else '.h5')
+    ij_keys = dict(((ii, ii + delta_ij), pair_match_key(manifest, match_key, 'sift', ii, ii + delta_ij)) for ii in range(N_frames-delta_ij))
+    pairs = [(ii, jj) for ii, jj in sorted(ij_keys) \
+        if not (resume and manifest.done('%d-%d'%(ii, jj), 'sift_match', ij_keys[(ii, jj)]) and (pairs_pack is None or pair_key('sift_match', ii, jj) in pairs_pack))]
+    sift_kps = {}
+    def load_sift_des(frame): # keypoints are kept for the match qualities below
+        sift_kps[frame], sift_des = load_sift(dump_dir, '%06d'%frame, ext=ext)
+        return sift_des
+    def get_sift_kps(frame, pop=False):
+        kps = sift_kps.pop(frame, None) if pop else sift_kps.get(frame)
+        return kps if kps is not None else load_sift(dump_dir, '%06d'%frame, ext=ext)[0] # descriptors still cached after a failed block
+    if sift_matcher is None:
+        batched_matcher = BatchedMatcher(load_sift_des, cache_size=2*delta_ij+8)
+        knn2_pairs = batched_matcher.knn2_pairs(pairs)
+    for k, (ii, jj) in enumerate(tqdm(pairs)):
+        if sift_matcher is None:
+            try:
+                _, _, dists, idx = next(knn2_pairs)
+                all_ij, good_ij, quality_all, quality_good = utils_match.ratio_test(dists, idx, 0.8)
+                sift_kps_ii, sift_kps_jj = get_sift_kps(ii, pop=True), get_sift_kps(jj) # ii is no query again
+            except Exception as e:
+                logging.error(traceback.format_exception(*sys.exc_info()))
+                all_ij = None
+                knn2_pairs = batched_matcher.knn2_pairs(pairs[k+1:]) # the failed generator is closed, go on after this pair
+        else:
+            sift_kps_ii, sift_des_ii = load_sift(dump_dir, '%06d'%ii, ext=ext)
+            sift_kps_jj, sift_des_jj = load_sift(dump_dir, '%06d'%jj, ext=ext)
 
-        # all_ij, good_ij = get_sift_match_idx_pair(sift_matcher, sift_des_list[ii], sift_des_list[jj])
-        all_ij, good_ij, quality_good, quality_all = get_sift_match_idx_pair(sift_matcher, sift_des_ii.copy(), sift_des_jj.copy())
+            # all_ij, good_ij = get_sift_match_idx_pair(sift_matcher, sift_des_list[ii], sift_des_list[jj])
+            all_ij, good_ij, quality_good, quality_all = get_sift_match_idx_pair(sift_matcher, sift_des_ii.copy(), sift_des_jj.copy())
         if all_ij is None:
             logging.warning('KNN match failed dumping %s frame %d-%d. Skipping'%(dump_dir, ii, jj))
             continue
@@ -404,7 +618,13 @@ def dump_sift_match_idx(delta_ij, N_frames, dump_dir, save_npy, if_BF_matcher):
         dump_ij_quality_file = dump_dir/'ij_quality_{}-{}'.format(ii, jj)
         dump_ij_match_quality_file = dump_dir/'ij_match_quality_{}-{}'.format(ii, jj)
 
-        if save_npy:
+        if save_pack:
+            match_quality_good = np.hstack((sift_kps_ii[good_ij[:, 0]], sift_kps_jj[good_ij[:, 1]], quality_good)) # [[x1, y1, x2, y2, dist_good, ratio_good]]
+            match_quality_all = np.hstack((sift_kps_ii[all_ij[:, 0]], sift_kps_jj[all_ij[:, 1]], quality_all))
+            pairs_pack.add(pair_key('sift_match', ii, jj), {'all_ij': all_ij, 'good_ij': good_ij, 'quality_good': quality_good, 'quality_all': quality_all, \
+                'match_quality_good': match_quality_good, 'match_quality_all': match_quality_all})
+            manifest.add('%d-%d'%(ii, jj), 'sift_match', ij_keys[(ii, jj)], [])
+        elif save_npy:
             np.save(dump_ij_idx_file+'_all.npy', all_ij)
             np.save(dump_ij_idx_file+'_good.npy', good_ij)
             np.save(dump_ij_quality_file+'_good.npy', quality_good)
@@ -415,54 +635,71 @@ def dump_sift_match_idx(delta_ij, N_frames, dump_dir, save_npy, if_BF_matcher):
             match_quality_all = np.hstack((sift_kps_ii[all_ij[:, 0]], sift_kps_jj[all_ij[:, 1]], quality_all)) # [[x1, y1, x2, y2, dist_good, ratio_good]]
             np.save(dump_ij_match_quality_file+'_good.npy', match_quality_good)
             np.save(dump_ij_match_quality_file+'_all.npy', match_quality_all)
+            manifest.add('%d-%d'%(ii, jj), 'sift_match', ij_keys[(ii, jj)], [dump_ij_idx_file+'_all.npy', dump_ij_idx_file+'_good.npy', \
+                dump_ij_quality_file+'_good.npy', dump_ij_quality_file+'_all.npy', dump_ij_match_quality_file+'_good.npy', dump_ij_match_quality_file+'_all.npy'])
 
             # print(good_ij.dtype, quality_good.dtype, good_ij.shape, quality_good.shape)
         else:
-            dump_ij_idx_dict = {'all_ij': all_ij, 'good_ij': good_ij}
-            saveh5(dump_ij_idx_dict, dump_ij_idx_file+'.h5')
+            match_quality_good = np.hstack((sift_kps_ii[good_ij[:, 0]], sift_kps_jj[good_ij[:, 1]], quality_good))
+            match_quality_all = np.hstack((sift_kps_ii[all_ij[:, 0]], sift_kps_jj[all_ij[:, 1]], quality_all))
+            dump_ij_idx_dict = {'all_ij': all_ij, 'good_ij': good_ij, 'quality_good': quality_good, 'quality_all': quality_all, \
+                'match_quality_good': match_quality_good, 'match_quality_all': match_quality_all}
+            saveh5(dump_ij_idx_dict, dump_ij_idx_file+'.h5', compression=h5_compression)
+            manifest.add('%d-%d'%(ii, jj), 'sift_match', ij_keys[(ii, jj)], [dump_ij_idx_file+'.h5'])
+    manifest.close()
+    if pairs_pack is not None:
+        pairs_pack.close()
 
 def get_sift_match_idx_pair(sift_matcher, des1, des2):
+    """ sift_matcher: a cv2 matcher, or None for utils_match.knn2_match. """
     try:
-        matches = sift_matcher.knnMatch(des1, des2, k=2) # another option is https://github.com/MagicLeapResearch/SuperPointPretrainedNetwork/blob/master/demo_superpoint.py#L309
+        if sift_matcher is None:
+            dists, idx = utils_match.knn2_match(des1, des2)
+            query_idx = None
+        else:
+            matches = sift_matcher.knnMatch(des1, des2, k=2) # another option is https://github.com/MagicLeapResearch/SuperPointPretrainedNetwork/blob/master/demo_superpoint.py#L309
+            dists, query_idx, idx = utils_match.knn2_from_cv2(matches)
     except Exception as e:
         logging.error(traceback.format_exception(*sys.exc_info()))
-        return None, None
+        return None, None, None, None
     # store all the good matches as per Lowe's ratio test.
-    good = []
-    all_m = []
-    quality_good = []
-    quality_all = []
-    for m,n in matches:
-        all_m.append(m)
-        if m.distance < 0.8*n.distance:
-            good.append(m)
-            quality_good.append([m.distance, m.distance / n.distance])
-        quality_all.append([m.distance, m.distance / n.distance])
-
-    good_ij = [[mat.queryIdx for mat in good], [mat.trainIdx for mat in good]]
-    all_ij = [[mat.queryIdx for mat in all_m], [mat.trainIdx for mat in all_m]]
-    return np.asarray(all_ij, dtype=np.int32).T.copy(), np.asarray(good_ij, dtype=np.int32).T.copy(), np.asarray(quality_good, dtype=np.float32).copy(), np.asarray(quality_all, dtype=np.float32).copy()
-
-def dump_SP_match_idx(delta_ij, N_frames, dump_dir, save_npy, nn_threshes):
+    all_ij, good_ij, quality_all, quality_good = utils_match.ratio_test(dists, idx, 0.8, query_idx)
+    return all_ij, good_ij, quality_good, quality_all
+
+def dump_SP_match_idx(delta_ij, N_frames, dump_dir, save_npy, nn_threshes, match_key=None, resume=False, save_pack=False, h5_compression=None, manifest_sha1=False):
+    manifest = DumpManifest(dump_dir, 'SP_match_%d'%delta_ij, sha1=manifest_sha1)
+    pairs_pack = RecordPackWriter(dump_dir/'SP_match_%d.pack'%delta_ij, append=resume) if save_pack else None
+    ext = '.pack' if save_pack else ('.npy' if save_npy else '.h5')
     for nn_thresh, name in zip(nn_threshes, ['good', 'all']):
         SP_matcher = PointTracker(max_length=2, nn_thresh=nn_thresh)
 
         for ii in tqdm(range(N_frames-delta_ij)):
             jj = ii + delta_ij
+            ij_key = pair_match_key(manifest, match_key, 'SP', ii, jj)
+            if resume and manifest.done('%d-%d'%(ii, jj), 'SP_match_%s'%name, ij_key) and (pairs_pack is None or pair_key('SP_match_%s'%name, ii, jj) in pairs_pack):
+                continue
 
-            SP_kps_ii, SP_des_ii = load_SP(dump_dir, '%06d'%ii, ext='.npy' if save_npy else '.h5')
-            SP_kps_jj, SP_des_jj = load_SP(dump_dir, '%06d'%jj, ext='.npy' if save_npy else '.h5')
+            SP_kps_ii, SP_des_ii = load_SP(dump_dir, '%06d'%ii, ext=ext)
+            SP_kps_jj, SP_des_jj = load_SP(dump_dir, '%06d'%jj, ext=ext)
 
             matches, scores = get_SP_match_idx_pair(SP_matcher, SP_kps_ii, SP_kps_jj, SP_des_ii, SP_des_jj)
 
             dump_ij_match_quality_file = dump_dir/'SP_ij_match_quality_{}-{}'.format(ii, jj)
 
-            if save_npy:
+            if save_pack:
+                pairs_pack.add(pair_key('SP_match_%s'%name, ii, jj), {'match_quality': np.hstack((matches, scores))})
+                manifest.add('%d-%d'%(ii, jj), 'SP_match_%s'%name, ij_key, [])
+            elif save_npy:
                 # print(matches.shape, scores.shape)
                 match_quality = np.hstack((matches, scores)) # [[x1, y1, x2, y2, dist_good, ratio_good]]
                 np.save(dump_ij_match_quality_file+'_%s.npy'%name, match_quality)
+                manifest.add('%d-%d'%(ii, jj), 'SP_match_%s'%name, ij_key, [dump_ij_match_quality_file+'_%s.npy'%name])
             else:
-                pass
+                saveh5({'match_quality': np.hstack((matches, scores))}, dump_ij_match_quality_file+'_%s.h5'%name, compression=h5_compression)
+                manifest.add('%d-%d'%(ii, jj), 'SP_match_%s'%name, ij_key, [dump_ij_match_quality_file+'_%s.h5'%name])
+    manifest.close()
+    if pairs_pack is not None:
+        pairs_pack.close()
 
 def get_SP_match_idx_pair(matcher, kps1, kps2, des1, des2):
     matcher.update(kps1.T, des1.T)
@@ -473,25 +710,20 @@ def get_SP_match_idx_pair(matcher, kps1, kps2, des1, des2):
 
     return matches.astype(np.float32).copy(), scores.astype(np.float32).copy()
 
-def load_velo(scene_data, tgt_idx):
+def load_velo(scene_data, tgt_idx, homo=False):
+    frame_nb = int(scene_data['frame_ids'][tgt_idx])
+    velo_pack = open_velo_pack(scene_data['dir']/'velodyne')
+    if velo_pack is not None: # packed drive (see pack_velo.py): one seek into velodyne.pack
+        if frame_nb not in velo_pack:
+            logging.warning('Velo frame %d not found in %s!'%(frame_nb, velo_pack.pack_filename))
+            return None
+        return velo_pack.load_homo(frame_nb) if homo else velo_pack.load(frame_nb)[:, :3]
     velo_file = scene_data['dir']/'velodyne'/scene_data['frame_ids'][tgt_idx]+'.bin'
     if not velo_file.isfile():
         logging.warning('Velo file %s not found!'%velo_file)
         return None
-    velo = load_velo_scan(velo_file)[:, :3]
+    if homo: # [N, 4] in the scan's own buffer, no extra copy for utils_misc.homo_np
+        return load_velo_homo(velo_file)
+    velo = load_velo_scan(velo_file)[:, :3] # zero-copy view
     return velo
 
-def read_odo_calib_file(filepath, cid=2):
-    # From https://github.com/tinghuiz/SfMLearner/blob/master/data/kitti/kitti_odom_loader.py#L133
-    """Read in a calibration file and parse into a dictionary."""
-    with open(filepath, 'r') as f:
-        C = f.readlines()
-    def parseLine(L, shape):
-        data = L.split()
-        data = np.array(data[1:]).reshape(shape).astype(np.float32)
-        return data
-    proj_c2p = parseLine(C[cid], shape=(3,4))
-    proj_v2c = parseLine(C[-1], shape=(3,4))
-    filler = np.array([0, 0, 0, 1]).reshape((1,4))
-    proj_v2c = np.concatenate((proj_v2c, filler), axis=0)
-    return proj_c2p, proj_v2c
@@ -20,7 +20,14 @@ coloredlogs.install(level='INFO', logger=logger)
 import cv2
 
 # from kitti_tools.utils_kitti import *
+from kitti_tools.utils_velo import load_velo_scan, load_velo_homo, open_velo_pack
+from kitti_tools.utils_kitti import rectify, velo_proj_transform, RectifyCache, rectify_to_cache
+from kitti_tools.utils_calib import get_calib_registry
+from kitti_tools.utils_oxts import load_oxts
 # from utils_good import *
+from kitti_tools.utils_good import saveh5
+from kitti_tools.utils_imwrite import ImageWriter
+import dsac_tools.utils_match as utils_match
 
 class KittiRawLoader(object):
     def __init__(self,
@@ -35,7 +42,14 @@ class KittiRawLoader(object):
                  get_sift=False,
                  sift_num=2000,
                  BF_matcher=False,
-                 save_npy=True):
+                 save_npy=True,
+                 rectify_cache_dir=None,
+                 rectify_workers=1,
+                 img_format='jpg',
+                 jpg_quality=75,
+                 png_compression=3,
+                 img_writer_threads=2,
+                 calib_cache_file=None):
                  # depth_size_ratio=1):
         dir_path = Path(__file__).realpath().dirname()
         # test_scene_file = dir_path/'test_scenes.txt'
@@ -51,6 +65,8 @@ class KittiRawLoader(object):
         # self.test_scenes = []
 
         self.dataset_dir = Path(dataset_dir)
+        self.calib_cache_file = self.dataset_dir/'calib_cache.npz' if calib_cache_file is None else Path(calib_cache_file)
+        get_calib_registry().scan(self.dataset_dir, cache_file=self.calib_cache_file) # parse all calibration files once, or load them from the cache
         self.img_height = img_height
         self.img_width = img_width
         self.cam_ids = ['02']
@@ -60,6 +76,12 @@ class KittiRawLoader(object):
         self.get_pose = get_pose
         self.get_sift = get_sift
         self.save_npy = save_npy
+        self.rectify_cache_dir = rectify_cache_dir # cache X_rect per frame on disk (see RectifyCache) and reuse it across runs
+        self.rectify_workers = rectify_workers
+        self.img_format = img_format # of the dumped frames, see utils_imwrite.ImageWriter
+        self.jpg_quality = jpg_quality
+        self.png_compression = png_compression
+        self.img_writer_threads = img_writer_threads
         if self.save_npy:
             logging.info('+++ Dumping as npy')
         else:
@@ -71,7 +93,7 @@ class KittiRawLoader(object):
             index_params = dict(algorithm = FLANN_INDEX_KDTREE, trees = 5)
             search_params = dict(checks = 50)
             self.flann = cv2.FlannBasedMatcher(index_params, search_params)
-            self.sift_matcher = self.bf if BF_matcher else self.flann
+            self.sift_matcher = None if BF_matcher else self.flann # None: brute force in numpy (utils_match.knn2_match)
 
         # self.depth_size_ratio = depth_size_ratio
         self.collect_train_folders()
@@ -117,41 +139,56 @@ class KittiRawLoader(object):
             # logging.warning('[%s] Zooming the image with zoom_x=%f, zoom_y=%f.'%(img_file, zoom_x, zoom_y))
             return img, zoom_x, zoom_y
 
-    def load_velo(self, scene_data, tgt_idx):
+    def load_velo(self, scene_data, tgt_idx, homo=False):
+        frame_nb = int(scene_data['frame_id'][tgt_idx])
+        velo_pack = open_velo_pack(scene_data['dir']/'velodyne_points'/'data')
+        if velo_pack is not None: # packed drive (see pack_velo.py): one seek into data.pack
+            if frame_nb not in velo_pack:
+                logging.warning('Velo frame %d not found in %s!'%(frame_nb, velo_pack.pack_filename))
+                return None
+            return velo_pack.load_homo(frame_nb) if homo else velo_pack.load(frame_nb)[:, :3]
         velo_file = scene_data['dir']/'velodyne_points'/'data'/scene_data['frame_id'][tgt_idx]+'.bin'
         if not velo_file.isfile():
             logging.warning('Velo file %s not found!'%velo_file)
             return None
-        velo = load_velo_scan(velo_file)[:, :3]
+        if homo: # [N, 4] in the scan's own buffer, no extra copy for utils_misc.homo_np
+            return load_velo_homo(velo_file)
+        velo = load_velo_scan(velo_file)[:, :3] # zero-copy view
         return velo
 
+    def rectify_cached(self, scene_data, calibs):
+        """ Same as the rectify loop in collect_scene_from_drive, but frames go through an on-disk cache under
+            rectify_cache_dir: only frames missing from it are rectified (on rectify_workers processes), and the
+            returned lists load one frame per access.
+        """
+        velo_dir = scene_data['dir']/'velodyne_points'/'data'
+        N_velo = scene_data['N_frames']
+        velo_pack = open_velo_pack(velo_dir)
+        for idx in range(scene_data['N_frames']): # stop at the first missing frame, as the uncached loop does
+            frame_nb = int(scene_data['frame_id'][idx])
+            if not (frame_nb in velo_pack if velo_pack is not None else (velo_dir/scene_data['frame_id'][idx]+'.bin').isfile()):
+                logging.warning('Velo frame %d not found in %s!'%(frame_nb, velo_dir))
+                N_velo = idx
+                break
+        frame_nbs = [int(frame_id) for frame_id in scene_data['frame_id'][:N_velo]]
+        velo_files = [velo_dir/frame_id+'.bin' for frame_id in scene_data['frame_id'][:N_velo]]
+        cache = RectifyCache(self.rectify_cache_dir, str(scene_data['dir'].name), calibs, rectify)
+        rectify_to_cache(rectify, calibs, velo_dir, velo_files, frame_nbs, cache, num_workers=self.rectify_workers)
+        return cache.field_list('val_idxes', frame_nbs), cache.field_list('X_rect', frame_nbs)
+
     def read_raw_calib_file(self, filepath):
-        # From https://github.com/utiasSTARS/pykitti/blob/master/pykitti/utils.py
-        """Read in a calibration file and parse into a dictionary."""
-        data = {}
-
-        with open(filepath, 'r') as f:
-            for line in f.readlines():
-                key, value = line.split(':', 1)
-                # The only non-float values in these files are dates, which
-                # we don't care about anyway
-                try:
-                        data[key] = np.array([float(x) for x in value.split()])
-                except ValueError:
-                        pass
-        return data
+        """Read in a calibration file and parse into a dictionary (parsed once, see CalibrationRegistry)."""
+        return get_calib_registry().read(filepath)
 
     def get_P_rect(self, scene_data, zoom_x=1., zoom_y=1., get_2cam_dict=True):
-        calib_file = scene_data['dir'].parent/'calib_cam_to_cam.txt'
-
-        filedata = self.read_raw_calib_file(calib_file)
+        P_rect_all = get_calib_registry().raw_calibs(scene_data['dir'].parent)['P_rect']
         if get_2cam_dict:
             P_rect = {}
             for cid in ['02', '03']:
-                P_rect[cid] = np.reshape(filedata['P_rect_' + cid], (3, 4))
+                P_rect[cid] = P_rect_all[cid]
             return P_rect
         else:       
-            P_rect = np.reshape(filedata['P_rect_' + scene_data['cid']], (3, 4))
+            P_rect = P_rect_all[scene_data['cid']].copy()
             P_rect[0] *= zoom_x
             P_rect[1] *= zoom_y
             return P_rect
@@ -174,48 +211,24 @@ class KittiRawLoader(object):
     def collect_scene_from_drive(self, drive_path):
         train_scenes = []
         for c in self.cam_ids:
-            oxts_path = drive_path + '/oxts/data/*.txt'
-            oxts = sorted(glob.glob(oxts_path))
-
             scene_data = {'cid': c, 'dir': Path(drive_path), 'speed': [], 'frame_id': [], 'imu_pose_matrix':[], 'rel_path': Path(drive_path).name + '_' + c}
             scene_data['P_rect_ori_dict'] = self.get_P_rect(scene_data, get_2cam_dict=True)
             scene_data['intrinsics_ori'] = scene_data['P_rect_ori_dict']['02'][:,:3]
-            calibs_rects = self.get_rect_cams(scene_data['intrinsics_ori'], scene_data['P_rect_ori_dict']['02'], scene_data['P_rect_ori_dict']['03'])
-
-            scale = None
-            origin = None
-            imu2velo_dict = read_calib_file(drive_path+'/../calib_imu_to_velo.txt')
-            velo2cam_dict = read_calib_file(drive_path+'/../calib_velo_to_cam.txt')
-            cam2cam_dict = read_calib_file(drive_path+'/../calib_cam_to_cam.txt')
-            velo2cam_mat = transform_from_rot_trans(velo2cam_dict['R'], velo2cam_dict['T'])
-            imu2velo_mat = transform_from_rot_trans(imu2velo_dict['R'], imu2velo_dict['T'])
-            cam_2rect_mat = transform_from_rot_trans(cam2cam_dict['R_rect_00'], np.zeros(3))
-            calibs = {'K': scene_data['intrinsics_ori'], 'cam_2rect': cam_2rect_mat, 'velo2cam': velo2cam_mat, \
+            raw_calibs = get_calib_registry().raw_calibs(drive_path+'/..') # parsed once per date, transforms pre-composed
+
+            calibs = {'K': scene_data['intrinsics_ori'], 'cam_2rect': raw_calibs['cam_2rect'], 'velo2cam': raw_calibs['velo2cam'], \
                 'im_shape': [self.img_height, self.img_width]}
-            calibs.update(calibs_rects)
+            calibs.update(dict((key, raw_calibs[key]) for key in ['Rtl_gt', 'delta_Rtlr_gt', 'delta_Rlr_gt', 'delta_tlr_gt'])) # = self.get_rect_cams(...)
+            calibs['T_velo_proj'] = velo_proj_transform(calibs) # composite velo->cam0/rect/image, once per scene
 
             # scene_data['imu2cam'] = calibs['Rtl_gt'] @ cam_2rect_mat @ velo2cam_mat @ imu2velo_mat
-            scene_data['imu2cam'] = cam_2rect_mat @ velo2cam_mat @ imu2velo_mat #  [RUI] In Cam 0
+            scene_data['imu2cam'] = raw_calibs['imu2cam'] #  [RUI] In Cam 0
 
             logging.info('Getting imu poses...'+drive_path)
-            for n, f in enumerate(oxts):
-                metadata = np.genfromtxt(f)
-                speed = metadata[8:11]
-                scene_data['speed'].append(speed)
-                scene_data['frame_id'].append('{:010d}'.format(n))
-                drive = str(scene_data['dir'].name)
-                # print(self.static_frames.keys())
-                # print(self.static_frames[drive])
-                # print(drive)
-                # print(scene_data['frame_id'][-1])
-                # if not((drive not in self.static_frames.keys()) or (scene_data['frame_id'][-1] not in self.static_frames[drive])):
-                #     logging.warning('%s in static_frames.keys() and scene_data[%s] in static_frames[drive]'%(drive, scene_data['frame_id'][-1]))
-                #     return []
-                lat = metadata[0]
-                if scale is None:
-                    scale = np.cos(lat * np.pi / 180.)
-                imu_pose_matrix = pose_from_oxts_packet(metadata[:6], scale)
-                scene_data['imu_pose_matrix'].append(imu_pose_matrix.copy())
+            oxts, imu_poses = load_oxts(drive_path) # [N, 30], [N, 4, 4]; parsed once per drive, shared by the cameras
+            scene_data['speed'] = list(oxts[:, 8:11])
+            scene_data['frame_id'] = ['{:010d}'.format(n) for n in range(len(oxts))]
+            scene_data['imu_pose_matrix'] = list(imu_poses.copy())
 
             scene_data['N_frames'] = len(scene_data['imu_pose_matrix'])
             if scene_data['N_frames'] == 0:
@@ -244,19 +257,24 @@ class KittiRawLoader(object):
             if self.get_X:
                 logging.info('Getting X, rectifying...'+drive_path)
                 # for each frame, get the visible points on front view with identity left camera, as well as indexes of points on both left/right images
-                val_idxes_list = []
-                X_rect_list = []
-                for idx in range(scene_data['N_frames']):
-                    velo = self.load_velo(scene_data, idx)
-                    if velo is None:
-                        break
-                    velo_reproj = utils_misc.homo_np(velo)
-                    val_idxes, X_rect = rectify(velo_reproj, calibs)
-                    val_idxes_list.append(val_idxes)
-                    X_rect_list.append(X_rect)
-                if velo is None and idx==0:
-                    logging.warning('0 velo in %s. Skipped.'%drive_path)
-                    return []
+                if self.rectify_cache_dir is not None:
+                    val_idxes_list, X_rect_list = self.rectify_cached(scene_data, calibs)
+                    if len(X_rect_list) == 0:
+                        logging.warning('0 velo in %s. Skipped.'%drive_path)
+                        return []
+                else:
+                    val_idxes_list = []
+                    X_rect_list = []
+                    for idx in range(scene_data['N_frames']):
+                        velo = self.load_velo(scene_data, idx, homo=True)
+                        if velo is None:
+                            break
+                        val_idxes, X_rect, _ = rectify(velo, calibs) # velo is already homogeneous; X_rect [M, 3]
+                        val_idxes_list.append(val_idxes)
+                        X_rect_list.append(X_rect)
+                    if velo is None and idx==0:
+                        logging.warning('0 velo in %s. Skipped.'%drive_path)
+                        return []
                 scene_data['val_idxes'] = val_idxes_list
                 scene_data['X_rect'] = X_rect_list
                 # Check number of velo frames
@@ -334,7 +352,7 @@ class KittiRawLoader(object):
             # if self.get_depth:
             #     sample['depth'] = self.generate_depth_map(scene_data, i)
             if self.get_X:
-                sample['X_rect_vis'] = scene_data['X_rect'][i][:, scene_data['val_idxes'][i]].copy()
+                sample['X_rect_vis'] = scene_data['X_rect'][i][scene_data['val_idxes'][i]] # [M_vis, 3] as X_cam2_vis of the odometry dumps; fancy-indexing already copies
             if self.get_pose:
                 sample['imu_pose_matrix'] = scene_data['imu_pose_matrix'][i].copy()
             if self.get_sift:
@@ -395,11 +413,12 @@ class KittiRawLoader(object):
         poses = []
 
         logging.info('Dumping %d samples to %s...'%(len(scene_samples), dump_dir))
+        img_writer = ImageWriter(dump_dir, self.img_format, self.jpg_quality, self.png_compression, num_threads=self.img_writer_threads, \
+            append=False)
         for ii, sample in enumerate(scene_samples):
             # logging.info('Dumping %d/%d.'%(ii, len(scene_samples)))
             img, frame_nb = sample["img"], sample["id"]
-            dump_img_file = dump_dir/'{}.jpg'.format(frame_nb)
-            scipy.misc.imsave(dump_img_file, img)
+            img_writer.write(frame_nb, img) # encoded and written in the background
             if "imu_pose_matrix" in sample.keys():
                 poses.append(sample["imu_pose_matrix"].reshape(-1).tolist())
                 if len(poses) != 0:
@@ -421,6 +440,8 @@ class KittiRawLoader(object):
                 else:
                     saveh5({'sift_kp': sample['sift_kp'], 'sift_des': sample['sift_des']}, dump_sift_file+'.h5')
 
+        img_writer.close()
+
         if self.get_sift:
             delta_ijs = [1, 2, 3, 5]
             for delta_ij in delta_ijs:
@@ -435,19 +456,16 @@ class KittiRawLoader(object):
                         dump_ij_idx_dict = {'all_ij': all_ij, 'good_ij': good_ij}
                         saveh5(dump_ij_idx_dict, dump_ij_idx_file+'.h5')
 
-        if len(dump_dir.files('*.jpg')) < 2:
+        if len(img_writer) < 2:
             dump_dir.rmtree()
 
     def get_sift_match_idx_pair(self, des1, des2):
-        matches = self.sift_matcher.knnMatch(des1, des2, k=2) # another option is https://github.com/MagicLeapResearch/SuperPointPretrainedNetwork/blob/master/demo_superpoint.py#L309
+        if self.sift_matcher is None:
+            dists, idx = utils_match.knn2_match(des1, des2)
+            query_idx = None
+        else:
+            matches = self.sift_matcher.knnMatch(des1, des2, k=2) # another option is https://github.com/MagicLeapResearch/SuperPointPretrainedNetwork/blob/master/demo_superpoint.py#L309
+            dists, query_idx, idx = utils_match.knn2_from_cv2(matches)
         # store all the good matches as per Lowe's ratio test.
-        good = []
-        all_m = []
-        for m,n in matches:
-            all_m.append(m)
-            if m.distance < 0.7*n.distance:
-                good.append(m)
-
-        good_ij = [[mat.queryIdx for mat in good], [mat.trainIdx for mat in good]]
-        all_ij = [[mat.queryIdx for mat in all_m], [mat.trainIdx for mat in all_m]]
-        return np.asarray(all_ij).T.copy(), np.asarray(good_ij).T.copy()
+        all_ij, good_ij, _, _ = utils_match.ratio_test(dists, idx, 0.7, query_idx)
+        return all_ij, good_ij
@@ -0,0 +1,39 @@
+""" Pack the per-frame velodyne .bin files of KITTI drives into one file per drive (see utils_velo.VeloPack).
+Once packed, load_velo in KittiOdoLoader/KittiRawLoader reads from the pack instead of the .bin files.
+
+Usage:
+> python pack_velo.py --dataset_dir /data/kitti/odometry --odo
+> python pack_velo.py --dataset_dir /data/kitti/raw
+> python pack_velo.py --dataset_dir /data/kitti/raw --verify   # also stat every .bin of the existing packs
+"""
+import os,sys
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BASE_DIR)
+sys.path.append(ROOT_DIR)
+import argparse
+from glob import glob
+from tqdm import tqdm
+
+from kitti_tools.utils_velo import pack_velo_dir, velo_pack_path, open_velo_pack
+
+parser = argparse.ArgumentParser(description='Pack velodyne scans per drive')
+parser.add_argument("--dataset_dir", type=str, required=True, help="KITTI raw root (with date folders), or odometry root (with sequences/) if --odo")
+parser.add_argument('--odo', action='store_true', default=False, help="dataset_dir is the KITTI odometry dataset")
+parser.add_argument('--overwrite', action='store_true', default=False, help="re-pack drives which already have an up-to-date pack")
+parser.add_argument('--verify', action='store_true', default=False, help="re-pack drives whose .bin files changed since packing (checks every frame's size and mtime)")
+args = parser.parse_args()
+
+if args.odo:
+    velo_dirs = sorted(glob(os.path.join(args.dataset_dir, 'sequences', '*', 'velodyne')))
+else:
+    velo_dirs = sorted(glob(os.path.join(args.dataset_dir, '*', '*_sync', 'velodyne_points', 'data')))
+print('Found %d drives with velodyne scans.'%len(velo_dirs))
+
+for velo_dir in tqdm(velo_dirs):
+    velo_pack = open_velo_pack(velo_dir)
+    if not args.overwrite and velo_pack is not None:
+        if not args.verify or velo_pack.matches_dir(velo_dir, full=True):
+            print('Exists, skipped: %s'%velo_pack_path(velo_dir))
+            continue
+        print('Out of date: %s'%velo_pack_path(velo_dir))
+    print('Packed: %s'%pack_velo_dir(velo_dir))
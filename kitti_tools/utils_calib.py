@@ -0,0 +1,166 @@
+""" Calibration registry shared by the loaders.
+
+All calib_*.txt (raw) and calib.txt (odometry) files under a KITTI root are parsed once by CalibrationRegistry.scan
+and optionally stored in one .npz cache file. Loaders then ask the registry for a date (raw_calibs) or a sequence
+(odo_calibs) and get read-only matrices with the usual transforms already composed, instead of re-reading and
+re-parsing the text files for every drive.
+"""
+import os
+import glob
+import logging
+import numpy as np
+
+CALIB_PATTERNS = ['*/calib_*.txt', 'raw/*/calib_*.txt', 'sequences/*/calib.txt']
+
+def read_calib_file(path):
+    """ Read in a calibration file and parse into a dictionary of float arrays; non-float values (dates) are dropped. """
+    data = {}
+    with open(path, 'r') as f:
+        for line in f.readlines():
+            line = line.rstrip()
+            if len(line)==0: continue
+            key, value = line.split(':', 1)
+            try:
+                data[key] = np.array(value.split(), dtype=np.float64)
+            except ValueError:
+                pass
+    return data
+
+def read_odo_calib_file(filepath, cid=2):
+    """ Returns the projection matrix [3, 4] of camera cid and velo2cam [4, 4] of an odometry calib.txt, in float32. """
+    calibs = get_calib_registry().odo_calibs(os.path.dirname(filepath))
+    return calibs['P_rect']['%02d'%cid].copy(), calibs['velo2cam'].copy()
+
+def transform_from_rot_trans(R, t):
+    """Transforation matrix from rotation matrix and translation vector."""
+    R = R.reshape(3, 3)
+    t = t.reshape(3, 1)
+    return np.vstack((np.hstack([R, t]), [0, 0, 0, 1]))
+
+def _frozen(calibs):
+    """ Makes the arrays of a dict (nested dicts included) read-only; the dicts stay plain dicts (Python 2 has no
+        MappingProxyType), so callers copy them before adding keys.
+    """
+    for key, value in calibs.items():
+        if isinstance(value, dict):
+            calibs[key] = _frozen(value)
+        else:
+            value.setflags(write=False)
+    return calibs
+
+class CalibrationRegistry(object):
+    """ Parsed calibration files, keyed by real path and invalidated by mtime/size. """
+    def __init__(self):
+        self.files = {} # realpath -> (mtime, size, {key: array})
+        self.raw = {}
+        self.odo = {}
+
+    def scan(self, kitti_root, cache_file=None):
+        """ Parses every calibration file under kitti_root (see CALIB_PATTERNS) once. With cache_file (.npz), the parsed
+            arrays are loaded from it when it is up to date, and written to it otherwise.
+        """
+        calib_files = sorted(set(os.path.realpath(f) for pattern in CALIB_PATTERNS for f in glob.glob(os.path.join(kitti_root, pattern))))
+        cached = {}
+        if cache_file is not None and os.path.isfile(cache_file):
+            try:
+                cached = self.load_cache(cache_file)
+            except Exception as e:
+                logging.warning('Could not read the calibration cache %s, parsing the files: %s'%(cache_file, e))
+        stale = False
+        for f in calib_files:
+            if f in cached and cached[f][:2] == self._stat(f):
+                self.files[f] = cached[f]
+            else:
+                self.read(f)
+                stale = True
+        if cache_file is not None and (stale or len(cached) != len(calib_files)):
+            try:
+                self.save_cache(cache_file, calib_files)
+            except (IOError, OSError) as e:
+                logging.warning('Could not write the calibration cache %s: %s'%(cache_file, e))
+        return self
+
+    def _stat(self, calib_file):
+        st = os.stat(calib_file)
+        return st.st_mtime, st.st_size
+
+    def _version(self, calib_dir, *names):
+        # (mtime, size) of already read files, so that composed transforms are rebuilt when a file changes
+        return tuple(self.files[os.path.realpath(os.path.join(calib_dir, name))][:2] for name in names)
+
+    def read(self, calib_file):
+        """ Same as read_calib_file, parsed once per file; the arrays are read-only. """
+        calib_file = os.path.realpath(calib_file)
+        mtime, size = self._stat(calib_file)
+        if calib_file not in self.files or self.files[calib_file][:2] != (mtime, size):
+            self.files[calib_file] = (mtime, size, _frozen(read_calib_file(calib_file)))
+        return self.files[calib_file][2]
+
+    def save_cache(self, cache_file, calib_files):
+        arrays = {'files': np.array(calib_files), 'stats': np.array([self.files[f][:2] for f in calib_files], dtype=np.float64)}
+        for n, f in enumerate(calib_files):
+            for key, value in self.files[f][2].items():
+                arrays['%d/%s'%(n, key)] = value
+        tmp_file = '%s.%d.tmp.npz'%(cache_file, os.getpid()) # loader processes may write it at the same time
+        np.savez(tmp_file, **arrays)
+        os.rename(tmp_file, cache_file)
+
+    def load_cache(self, cache_file):
+        cached = {}
+        with np.load(cache_file) as npz:
+            calib_files = [str(f) for f in npz['files']]
+            data = [{} for _ in calib_files]
+            for name in npz.files:
+                if '/' in name:
+                    n, key = name.split('/', 1)
+                    data[int(n)][key] = npz[name]
+            for f, (mtime, size), calibs in zip(calib_files, npz['stats'], data):
+                cached[f] = (mtime, int(size), _frozen(calibs))
+        return cached
+
+    def raw_calibs(self, calib_dir):
+        """ Read-only transforms of a raw date folder (which holds calib_{cam_to_cam,velo_to_cam,imu_to_velo}.txt):
+            cam_2rect, velo2cam, imu2velo [4, 4]; imu2cam = cam_2rect @ velo2cam @ imu2velo (cam 0);
+            P_rect / P_velo2im: dicts of [3, 4] per camera ('00'...'03'); K (cam 02); Rtl_gt [4, 4] and
+            delta_Rtlr_gt / delta_Rlr_gt / delta_tlr_gt of the rectified cam 02 -> cam 03 as in KittiRawLoader.get_rect_cams.
+        """
+        calib_dir = os.path.realpath(calib_dir)
+        cam2cam, velo2cam, imu2velo = [self.read(os.path.join(calib_dir, 'calib_%s.txt'%name)) for name in ['cam_to_cam', 'velo_to_cam', 'imu_to_velo']]
+        key = (calib_dir, self._version(calib_dir, 'calib_cam_to_cam.txt', 'calib_velo_to_cam.txt', 'calib_imu_to_velo.txt'))
+        if key not in self.raw:
+            calibs = {}
+            calibs['cam_2rect'] = transform_from_rot_trans(cam2cam['R_rect_00'], np.zeros(3))
+            calibs['velo2cam'] = transform_from_rot_trans(velo2cam['R'], velo2cam['T'])
+            calibs['imu2velo'] = transform_from_rot_trans(imu2velo['R'], imu2velo['T'])
+            calibs['imu2cam'] = np.dot(np.dot(calibs['cam_2rect'], calibs['velo2cam']), calibs['imu2velo'])
+            calibs['P_rect'] = dict((cid, cam2cam['P_rect_' + cid].reshape(3, 4)) for cid in ['00', '01', '02', '03'])
+            calibs['P_velo2im'] = dict((cid, np.dot(np.dot(P_rect, calibs['cam_2rect']), calibs['velo2cam'])) for cid, P_rect in calibs['P_rect'].items())
+            calibs['K'] = calibs['P_rect']['02'][:, :3]
+            calibs.update(rect_cams(calibs['K'], calibs['P_rect']['02'], calibs['P_rect']['03']))
+            self.raw[key] = _frozen(calibs)
+        return self.raw[key]
+
+    def odo_calibs(self, seq_dir):
+        """ Read-only float32 P_rect (dict of [3, 4] per camera '00'...'03') and velo2cam [4, 4] of an odometry sequence. """
+        seq_dir = os.path.realpath(seq_dir)
+        calib = self.read(os.path.join(seq_dir, 'calib.txt'))
+        key = (seq_dir, self._version(seq_dir, 'calib.txt'))
+        if key not in self.odo:
+            calibs = {}
+            calibs['P_rect'] = dict(('%02d'%cid, calib['P%d'%cid].reshape(3, 4).astype(np.float32)) for cid in range(4))
+            calibs['velo2cam'] = np.vstack((calib['Tr'].reshape(3, 4), [0, 0, 0, 1])).astype(np.float32)
+            self.odo[key] = _frozen(calibs)
+        return self.odo[key]
+
+def rect_cams(K, P_rect_20, P_rect_30):
+    Ml_gt = np.matmul(np.linalg.inv(K), P_rect_20)
+    Mr_gt = np.matmul(np.linalg.inv(K), P_rect_30)
+    Rtl_gt = np.vstack((Ml_gt, np.array([0., 0., 0., 1.], dtype=np.float64)))
+    delta_Rtlr_gt = np.matmul(Mr_gt, np.linalg.inv(Rtl_gt))
+    return {'Rtl_gt': Rtl_gt, 'delta_Rtlr_gt': delta_Rtlr_gt, 'delta_Rlr_gt': delta_Rtlr_gt[:, :3], 'delta_tlr_gt': delta_Rtlr_gt[:, 3:4]}
+
+_calib_registry = CalibrationRegistry()
+
+def get_calib_registry():
+    """ The registry shared by all loaders of the process. """
+    return _calib_registry
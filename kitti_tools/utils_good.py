@@ -35,6 +35,7 @@ import gzip
 import pickle
 
 import h5py
+import numpy as np
 
 
 def savepklz(data_to_dump, dump_file_full_name, force_run=False):
@@ -59,36 +60,88 @@ def loadpklz(dump_file_full_name, force_run=False):
     return dump_data
 
 
-def saveh5(dict_to_dump, dump_file_full_name):
-    ''' Saves a dictionary as h5 file '''
+def saveh5(dict_to_dump, dump_file_full_name, chunks=None, compression=None,
+           compression_opts=None):
+    ''' Saves a dictionary as h5 file
+
+    chunks and compression are either one value for all datasets or a
+    dict key -> value (missing keys: h5py defaults). compression is None,
+    'lzf' or 'gzip' (compression_opts is the gzip level); compressed
+    datasets are byte-shuffled first, which helps a lot on float arrays.
+    '''
 
     with h5py.File(dump_file_full_name, 'w') as h5file:
         if isinstance(dict_to_dump, list):
             for i, d in enumerate(dict_to_dump):
                 newdict = {'dict' + str(i): d}
-                writeh5(newdict, h5file)
+                writeh5(newdict, h5file, chunks, compression, compression_opts)
         else:
-            writeh5(dict_to_dump, h5file)
+            writeh5(dict_to_dump, h5file, chunks, compression, compression_opts)
+
+
+def _per_key(option, _key):
+    ''' Value of a saveh5 option for a key '''
+
+    if isinstance(option, dict):
+        return option.get(_key)
+    return option
 
 
-def writeh5(dict_to_dump, h5node):
+def _row_chunks(data, chunk_bytes=1 << 20):
+    ''' Chunks of whole rows, up to chunk_bytes (h5py's guess splits
+    columns, which compresses worse and reads slower here) '''
+
+    row_bytes = max(1, data.nbytes // data.shape[0])
+    n_rows = max(1, min(data.shape[0], chunk_bytes // row_bytes))
+    return (n_rows,) + data.shape[1:]
+
+
+def writeh5(dict_to_dump, h5node, chunks=None, compression=None,
+            compression_opts=None):
     ''' Recursive function to write dictionary to h5 nodes '''
 
     for _key in dict_to_dump.keys():
         if isinstance(dict_to_dump[_key], dict):
             h5node.create_group(_key)
             cur_grp = h5node[_key]
-            writeh5(dict_to_dump[_key], cur_grp)
-        else:
+            writeh5(dict_to_dump[_key], cur_grp,
+                    _per_key(chunks, _key), _per_key(compression, _key),
+                    _per_key(compression_opts, _key))
+            continue
+
+        data = np.asarray(dict_to_dump[_key])
+        key_chunks = _per_key(chunks, _key)
+        key_compression = _per_key(compression, _key)
+        if data.ndim == 0 or data.size == 0 or data.dtype.kind in 'OUS':
+            # scalars, empty and string data can not be chunked
             h5node[_key] = dict_to_dump[_key]
+        elif key_compression is None:
+            h5node.create_dataset(_key, data=data, chunks=key_chunks)
+        else:
+            h5node.create_dataset(
+                _key, data=data,
+                chunks=_row_chunks(data) if key_chunks is None else key_chunks,
+                compression=key_compression,
+                compression_opts=_per_key(compression_opts, _key),
+                shuffle=True)
+
 
+def loadh5(dump_file_full_name, lazy=False):
+    ''' Loads a h5 file as dictionary
 
-def loadh5(dump_file_full_name):
-    ''' Loads a h5 file as dictionary '''
+    With lazy=True, the values are h5py datasets of the file left open
+    (read them with [()] or slices, close with .file.close()); with
+    lazy='mmap', contiguous uncompressed datasets are read-only np.memmap
+    views of the file instead.
+    '''
 
     try:
-        with h5py.File(dump_file_full_name, 'r') as h5file:
-            dict_from_file = readh5(h5file)
+        if lazy:
+            h5file = h5py.File(dump_file_full_name, 'r')
+            dict_from_file = readh5(h5file, lazy)
+        else:
+            with h5py.File(dump_file_full_name, 'r') as h5file:
+                dict_from_file = readh5(h5file)
     except Exception as e:
         print("Error while loading {}".format(dump_file_full_name))
         raise e
@@ -96,18 +149,31 @@ def loadh5(dump_file_full_name):
     return dict_from_file
 
 
-def readh5(h5node):
+def memmaph5(dataset):
+    ''' np.memmap of a contiguous uncompressed dataset (else the dataset) '''
+
+    offset = dataset.id.get_offset()
+    if dataset.chunks is not None or offset is None or dataset.size == 0:
+        return dataset
+    return np.memmap(dataset.file.filename, mode='r', dtype=dataset.dtype,
+                     shape=dataset.shape, offset=offset)
+
+
+def readh5(h5node, lazy=False):
     ''' Recursive function to read h5 nodes as dictionary '''
 
     dict_from_file = {}
     for _key in h5node.keys():
-        if isinstance(h5node[_key], h5py._hl.group.Group):
-            dict_from_file[_key] = readh5(h5node[_key])
+        if isinstance(h5node[_key], h5py.Group):
+            dict_from_file[_key] = readh5(h5node[_key], lazy)
+        elif lazy == 'mmap':
+            dict_from_file[_key] = memmaph5(h5node[_key])
+        elif lazy:
+            dict_from_file[_key] = h5node[_key]
         else:
-            dict_from_file[_key] = h5node[_key].value
+            dict_from_file[_key] = h5node[_key][()]
 
     return dict_from_file
 
-
 #
 # utils.py ends here
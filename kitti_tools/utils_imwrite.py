@@ -0,0 +1,115 @@
+""" Image writer for the dump scripts: frames are encoded and written by a small pool of threads.
+
+dump_drive hands each frame to ImageWriter.write and moves on; the encoding (cv2.imencode, or Pillow without
+OpenCV, both release the GIL) and the file write happen in the pool, with at most queue_size frames waiting so
+that a slow disk cannot fill the memory. Formats:
+    'jpg'   <frame_nb>.jpg with quality jpg_quality (75, the quality scipy.misc.imsave used)
+    'png'   <frame_nb>.png with zlib level png_compression (lossless)
+    'pack'  raw uint8 arrays in images.pack of the dump dir (utils_pack record 'img/<frame_nb>', no encoding at all),
+            read back with load_frame(dump_dir, 'img', frame_nb, pack_name='images')['img']
+Files are written to a .tmp name and renamed, so an interrupted dump never leaves a truncated image behind.
+"""
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+    from io import BytesIO
+    from PIL import Image
+
+from kitti_tools.utils_pack import RecordPackWriter, frame_key
+
+IMAGE_FORMATS = ['jpg', 'png', 'pack']
+
+def encode_image(img, img_format, jpg_quality=75, png_compression=3):
+    """ Encodes a uint8 RGB [H, W, 3] or grey [H, W] image to jpg or png bytes. """
+    if cv2 is not None:
+        if img.ndim == 3:
+            img = img[:, :, ::-1] # cv2 expects BGR
+        if img_format == 'jpg':
+            params = [cv2.IMWRITE_JPEG_QUALITY, int(jpg_quality)]
+        else:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, int(png_compression)]
+        ok, buf = cv2.imencode('.' + img_format, np.ascontiguousarray(img), params)
+        assert ok, 'Failed to encode an image as %s!'%img_format
+        return buf.tobytes()
+    f = BytesIO()
+    if img_format == 'jpg':
+        Image.fromarray(img).save(f, format='JPEG', quality=int(jpg_quality))
+    else:
+        Image.fromarray(img).save(f, format='PNG', compress_level=int(png_compression))
+    return f.getvalue()
+
+class ImageWriter(object):
+    def __init__(self, dump_dir, img_format='jpg', jpg_quality=75, png_compression=3, num_threads=2, queue_size=16, append=True):
+        assert img_format in IMAGE_FORMATS, 'Unknown image format %s!'%img_format
+        self.dump_dir = str(dump_dir)
+        self.img_format = img_format
+        self.jpg_quality = jpg_quality
+        self.png_compression = png_compression
+        self.pack = RecordPackWriter(os.path.join(self.dump_dir, 'images.pack'), append=append) if img_format == 'pack' else None
+        self.lock_pack = threading.Lock()
+        self.slots = threading.Semaphore(queue_size)
+        self.pool = ThreadPoolExecutor(max_workers=num_threads)
+        self.written = queue.Queue() # (frame_nb, files) of finished writes
+        self.errors = []
+
+    def image_file(self, frame_nb):
+        return os.path.join(self.dump_dir, '%s.%s'%(frame_nb, self.img_format))
+
+    def __contains__(self, frame_nb):
+        """ Whether the image of frame_nb is in the pack (always True for the file formats, see the manifest). """
+        return self.pack is None or frame_key('img', frame_nb) in self.pack
+
+    def __len__(self):
+        """ Number of images in the dump dir. """
+        if self.pack is not None:
+            return len([key for key in self.pack.index if key.startswith('img/')])
+        return len([f for f in os.listdir(self.dump_dir) if f.endswith('.' + self.img_format)])
+
+    def write(self, frame_nb, img):
+        """ Queues img for writing; blocks only while queue_size images are already waiting. """
+        self.raise_errors()
+        self.slots.acquire()
+        future = self.pool.submit(self._write, frame_nb, img)
+        future.add_done_callback(lambda _: self.slots.release())
+
+    def _write(self, frame_nb, img):
+        try:
+            if self.pack is not None:
+                with self.lock_pack:
+                    self.pack.add(frame_key('img', frame_nb), {'img': img})
+                self.written.put((frame_nb, []))
+                return
+            buf = encode_image(img, self.img_format, self.jpg_quality, self.png_compression)
+            image_file = self.image_file(frame_nb)
+            with open(image_file + '.tmp', 'wb') as f:
+                f.write(buf)
+            os.rename(image_file + '.tmp', image_file)
+            self.written.put((frame_nb, [image_file]))
+        except Exception as e:
+            self.errors.append(e)
+
+    def raise_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def pop_written(self):
+        """ Returns the (frame_nb, files) written since the last call, e.g. to record them in a DumpManifest. """
+        written = []
+        while True:
+            try:
+                written.append(self.written.get_nowait())
+            except queue.Empty:
+                return written
+
+    def close(self):
+        """ Waits for the queued images (and re-raises the first error of a write). """
+        self.pool.shutdown(wait=True)
+        if self.pack is not None:
+            self.pack.close()
+        self.raise_errors()
@@ -1,16 +1,29 @@
+import os
 import sys
 import numpy as np
 import matplotlib.pyplot as plt
 import glob
+from collections import OrderedDict
+import queue
+import threading
+import hashlib
+from pebble import ProcessPool
 import torch
 from path import Path
 from imageio import imread
+from PIL import Image
 
 import pykitti  # install using pip install pykitti
 # from kitti_tools.kitti_raw_loader import read_calib_file, transform_from_rot_trans
 import dsac_tools.utils_misc as utils_misc
 import dsac_tools.utils_vis as utils_vis
 import dsac_tools.utils_geo as utils_geo
+from kitti_tools.utils_velo import load_velo_scan, load_velo_homo, open_velo_pack
+from kitti_tools.utils_calib import read_calib_file, transform_from_rot_trans, get_calib_registry
+from kitti_tools.utils_oxts import load_oxts
+from kitti_tools.utils_poses import RelativePoses
+from kitti_tools.utils_pack import load_frame
+from kitti_tools.utils_good import loadh5
 
 class KittiLoader(object):
     def __init__(self, KITTI_ROOT_PATH):
@@ -18,7 +31,7 @@ class KittiLoader(object):
         self.KITTI_PATH = KITTI_ROOT_PATH + '/raw' if 'raw' not in self.KITTI_ROOT_PATH else self.KITTI_ROOT_PATH
 
 
-    def set_drive(self, date, drive, drive_path=None):
+    def set_drive(self, date, drive, drive_path=None, cache_size=16):
         # self.date_name = date
         # self.seq_name = seq
 
@@ -39,9 +52,12 @@ class KittiLoader(object):
         else:
             self.drive_path = drive_path
         self.dataset = pykitti.raw(self.KITTI_PATH, date, drive)
-        self.dataset_gray = list(self.dataset.gray)
-        self.dataset_rgb = list(self.dataset.rgb) 
+        # decoded on demand; only the cache_size most recent frames stay in memory
+        self.dataset_gray = LazyStereoFrames(self.drive_path, ['00', '01'], 'L', cache_size)
+        self.dataset_rgb = LazyStereoFrames(self.drive_path, ['02', '03'], 'RGB', cache_size)
         self.N_frames = len(self.dataset_rgb)
+        self.velo_dir = self.drive_path + '/velodyne_points/data'
+        self.velo_files = sorted(glob.glob(self.velo_dir + '/*.bin'))
         if self.N_frames == 0:
             return
         ## From Rui
@@ -53,39 +69,82 @@ class KittiLoader(object):
         P_rect = self.P_rects['leftRGB'] # P_rect_0[0-3]: 3x4 projection matrix after rectification; the reprojection matrix in MV3D
         self.velo2cam = self.dataset.calib.T_cam0_velo_unrect
         self.P_velo2im = np.dot(np.dot(P_rect, self.R_cam2rect), self.velo2cam) # 4*3
-        self.im_shape = [self.dataset_gray[0][0].size[1], self.dataset_gray[0][0].size[0]] if self.N_frames!= 0 else [-1, -1]
+        self.im_shape = self.dataset_gray.im_shape()
 
         # print('KITTI track loaded at %s.'%self.fdir_path)
 
+    def get_velo(self, i, homo=False):
+        """ Scan of frame i as [N, 4] (memory-mapped, from the drive's pack if there is one); homo=True replaces
+            reflectance by 1. in a private copy-on-write buffer.
+        """
+        velo_pack = open_velo_pack(self.velo_dir)
+        if velo_pack is not None:
+            frame_nb = int(os.path.basename(self.velo_files[i])[:-4]) if self.velo_files else i
+            return velo_pack.load_homo(frame_nb) if homo else velo_pack.load(frame_nb)
+        return load_velo_homo(self.velo_files[i]) if homo else load_velo_scan(self.velo_files[i])
+
+    def iter_velo(self, homo=False, prefetch=0):
+        """ Yields (i, get_velo(i)) for all frames, reading each scan once. With prefetch > 0 a reader thread
+            stays up to prefetch scans ahead, so that disk I/O overlaps with the caller's work.
+        """
+        if prefetch <= 0:
+            for i in range(self.N_frames):
+                yield i, self.get_velo(i, homo=homo)
+            return
+
+        velo_queue = queue.Queue(maxsize=prefetch)
+        stop = threading.Event() # set when the consumer is done, even if it stops early
+        def put(item):
+            while not stop.is_set():
+                try:
+                    velo_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        def reader():
+            try:
+                for i in range(self.N_frames):
+                    velo = self.get_velo(i, homo=homo)
+                    if not homo:
+                        velo = np.array(velo) # touch the pages here rather than in the consumer
+                    if not put((i, velo)):
+                        return
+            except Exception as e:
+                put((None, e))
+                return
+            put((None, None))
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+        try:
+            while True:
+                i, velo = velo_queue.get()
+                if i is None:
+                    if velo is not None:
+                        raise velo
+                    return
+                yield i, velo
+        finally:
+            stop.set()
+            while True: # drop the prefetched scans
+                try:
+                    velo_queue.get_nowait()
+                except queue.Empty:
+                    break
+            thread.join()
+
     def load_cam_poses(self):
-        oxts_path = self.drive_path + '/oxts/data/*.txt'
-        oxts = sorted(glob.glob(oxts_path))
+        oxts, imu_poses = load_oxts(self.drive_path) # [N, 30], [N, 4, 4]; parsed once per drive
 
         c = '02'
         scene_data = {'cid': c, 'dir': self.drive_path, 'speed': [], 'frame_id': [], 'imu_pose_matrix':[], 'rel_path': Path(self.drive_path).name + '_' + c}
-        scale = None
         origin = None
-        imu2velo_dict = read_calib_file(self.drive_path+'/../calib_imu_to_velo.txt')
-        velo2cam_dict = read_calib_file(self.drive_path+'/../calib_velo_to_cam.txt')
-        cam2cam_dict = read_calib_file(self.drive_path+'/../calib_cam_to_cam.txt')
-
-        velo2cam_mat = transform_from_rot_trans(velo2cam_dict['R'], velo2cam_dict['T'])
-        imu2velo_mat = transform_from_rot_trans(imu2velo_dict['R'], imu2velo_dict['T'])
-        cam_2rect_mat = transform_from_rot_trans(cam2cam_dict['R_rect_00'], np.zeros(3))
-
         # self.imu2cam = self.Rtl_gt.copy() @ cam_2rect_mat @ velo2cam_mat @ imu2velo_mat
-        self.imu2cam = cam_2rect_mat @ velo2cam_mat @ imu2velo_mat
-
-        for n, f in enumerate(oxts):
-            metadata = np.genfromtxt(f)
-            speed = metadata[8:11]
-            scene_data['speed'].append(speed)
-            scene_data['frame_id'].append('{:010d}'.format(n))
-            lat = metadata[0]
-
-            if scale is None:
-                scale = np.cos(lat * np.pi / 180.)
-            imu_pose_matrix = pose_from_oxts_packet(metadata[:6], scale)
+        self.imu2cam = get_calib_registry().raw_calibs(self.drive_path+'/..')['imu2cam'] # cam_2rect @ velo2cam @ imu2velo
+
+        scene_data['speed'] = list(oxts[:, 8:11])
+        scene_data['frame_id'] = ['{:010d}'.format(n) for n in range(len(oxts))]
+        scene_data['imu_pose_matrix'] = list(imu_poses.copy()) # pose_from_oxts_packet of each packet, scale of the first
             # if origin is None:
             #     origin = pose_matrix
 
@@ -104,18 +163,16 @@ class KittiLoader(object):
 
             # Rt12 = np.hstack((R12, t12))
             # scene_data['pose'].append(Rt12)
-            scene_data['imu_pose_matrix'].append(imu_pose_matrix.copy())
 
         self.scene_data = scene_data
+        self.relative_poses = None
         return scene_data
 
     def show_demo(self):
         velo_reproj_list = []
         for i in range(self.N_frames):
-            velo = list(self.dataset.velo)[i] # [N, 4]
             # project the points to the camera
-            velo = velo[:, :3]
-            velo_reproj = utils_misc.homo_np(velo)
+            velo_reproj = self.get_velo(i, homo=True) # [N, 4]
             velo_reproj_list.append(velo_reproj)
 
             for cam_iter, cam in enumerate(['leftRGB', 'rightRGB']):
@@ -170,7 +227,14 @@ class KittiLoader(object):
         self.Elr_gt_th = torch.matmul(tlr_gt_x, torch.eye(3)).to(torch.float64)
         self.Flr_gt_th = torch.matmul(torch.matmul(torch.inverse(self.K_th).t(), self.Elr_gt_th), torch.inverse(self.K_th))
 
+    def get_rectify_calibs(self):
+        calibs = {'cam_2rect': self.R_cam2rect, 'velo2cam': self.velo2cam, 'Rtl_gt': self.Rtl_gt, 'K': self.K, 'im_shape': self.im_shape}
+        calibs['T_velo_proj'] = velo_proj_transform(calibs)
+        return calibs
+
     def rectify(self, velo_reproj, im_l, im_r, visualize=False):
+        if not visualize:
+            return rectify_lr(velo_reproj, self.get_rectify_calibs())
         val_inds_list = []
 
         X_homo = np.dot(np.dot(self.R_cam2rect, self.velo2cam), velo_reproj.T) # 4*N
@@ -208,24 +272,43 @@ class KittiLoader(object):
         # val_idxes = [idx for idx in range(val_inds_both.shape[0]) if val_inds_both[idx]] # within indexes
 
         val_idxes = utils_misc.vis_masks_to_inds(val_inds_list[0], val_inds_list[1])
-        return val_idxes, X_rect # list, 3*N
+        return val_idxes, X_rect # [M] int, 3*N
 
-    def rectify_all(self, visualize=False):
+    def rectify_all(self, visualize=False, prefetch=4, cache_dir=None, num_workers=1):
         # for each frame, get the visible points on front view with identity left camera, as well as indexes of points on both left/right images
+        # With cache_dir, frames are rectified on num_workers processes into an on-disk cache (see RectifyCache), frames already
+        # in the cache are skipped, and val_idxes_list/X_rect_list load single frames from it on access.
         print('Rectifying...')
+        if cache_dir is not None:
+            cache = RectifyCache(cache_dir, Path(self.drive_path).name, self.get_rectify_calibs(), rectify_lr)
+            frame_nbs = [int(os.path.basename(f)[:-4]) for f in self.velo_files] if self.velo_files else list(range(self.N_frames))
+            rectify_to_cache(rectify_lr, self.get_rectify_calibs(), self.velo_dir, self.velo_files, frame_nbs, cache, num_workers=num_workers)
+            self.val_idxes_list = cache.field_list('val_idxes', frame_nbs)
+            self.X_rect_list = cache.field_list('X_rect', frame_nbs)
+            if visualize:
+                for i in range(0, self.N_frames, 100):
+                    self.rectify(self.get_velo(i, homo=True), self.dataset_rgb[i][0], self.dataset_rgb[i][1], visualize=True)
+            print('Finished rectifying all frames, cached at %s.'%cache.cache_dir)
+            return self.val_idxes_list, self.X_rect_list
+
         self.val_idxes_list = []
         self.X_rect_list = []
-        for i in range(self.N_frames):
+        for i, velo_reproj in self.iter_velo(homo=True, prefetch=prefetch):
             print(i, self.N_frames)
-            velo = list(self.dataset.velo)[i] # [N, 4]
-            velo = velo[:, :3]
-            velo_reproj = utils_misc.homo_np(velo)
             val_idxes, X_rect = self.rectify(velo_reproj, self.dataset_rgb[i][0], self.dataset_rgb[i][1], visualize=((i%100==0)&visualize))
             self.val_idxes_list.append(val_idxes)
             self.X_rect_list.append(X_rect)
         print('Finished rectifying all frames.')
         return self.val_idxes_list, self.X_rect_list
 
+    def get_relative_poses(self):
+        """ RelativePoses of the drive (from load_cam_poses and Rtl_gt), built once; .pairs(delta_ijs) gives all
+            (i, i+delta) motions of get_ij at once.
+        """
+        if getattr(self, 'relative_poses', None) is None:
+            self.relative_poses = RelativePoses.from_imu_poses(np.stack(self.scene_data['imu_pose_matrix']), self.imu2cam, self.Rtl_gt)
+        return self.relative_poses
+
     def get_ij(self, i, j, visualize=False):
         """ Return frame i and j with point cloud from i, and relative camera pose [R|t] """
         # Rt0 = self.scene_data['pose'][0] # Identity, or = utils_misc.identity_Rt()
@@ -240,12 +323,13 @@ class KittiLoader(object):
         np.set_printoptions(precision=8, suppress=True)\
 
         # delta_Rtij = utils_misc.Rt_depad(np.linalg.inv(utils_misc.Rt_pad(Rti)) @ utils_misc.Rt_pad(Rtj))
-        odo_pose = self.imu2cam @ np.linalg.inv(self.scene_data['imu_pose_matrix'][i]) @ self.scene_data['imu_pose_matrix'][j] @ np.linalg.inv(self.imu2cam) # camera motion
+        relative_poses = self.get_relative_poses()
+        # odo_pose = self.imu2cam @ np.linalg.inv(self.scene_data['imu_pose_matrix'][i]) @ self.scene_data['imu_pose_matrix'][j] @ np.linalg.inv(self.imu2cam) # camera motion
         # delta_Rtij = utils_misc.Rt_depad(np.linalg.inv(odo_pose)) # scene motion;  [RUI] Cam 0
 
-        print(self.imu2cam @ np.linalg.inv(self.scene_data['imu_pose_matrix'][j]) @ self.scene_data['imu_pose_matrix'][i] @ np.linalg.inv(self.imu2cam))
+        print(relative_poses.camera_motion(j, i))
 
-        delta_Rtij = utils_misc.Rt_depad(self.Rtl_gt @ np.linalg.inv(odo_pose) @ np.linalg.inv(self.Rtl_gt)) # [RUI] Cam 2
+        delta_Rtij = relative_poses.scene_motion(i, j) # = Rtl_gt @ inv(odo_pose) @ inv(Rtl_gt); [RUI] Cam 2
         val_inds_i, _ = utils_vis.reproj_and_scatter(utils_misc.identity_Rt(), X_rect_i.T, self.dataset_rgb[i][0], self, visualize=visualize, title_appendix='frame %d (left)'%i, set_lim=True)
         val_inds_j, _ = utils_vis.reproj_and_scatter(delta_Rtij, X_rect_i.T, self.dataset_rgb[j][0], self, visualize=visualize, title_appendix='frame %d (left)'%j, set_lim=True)
         X_rect_j = self.X_rect_list[j]
@@ -253,7 +337,7 @@ class KittiLoader(object):
         val_idxes = utils_misc.vis_masks_to_inds(val_inds_i, val_inds_j)
         X_rect_i_vis = X_rect_i[:, val_idxes]
 
-        delta_Rtij_inv = utils_misc.Rt_depad(odo_pose) # camera motion
+        delta_Rtij_inv = relative_poses.camera_motion(i, j) # = odo_pose, camera motion
 
         # print(delta_Rtij_inv)
 
@@ -286,6 +370,46 @@ class KittiLoader(object):
         return X_rect_i, X_rect_i_vis, delta_Rtij, delta_Rtij_inv, self.dataset_rgb[i][0], self.dataset_rgb[i][1]
 
 
+class LazyStereoFrames(object):
+    """ Drop-in for list(pykitti.raw.gray/rgb): frames[i] is the (left, right) PIL image pair of frame i,
+        decoded from image_xx/data on first access and kept in an LRU cache of cache_size frames.
+    """
+    def __init__(self, drive_path, cam_ids, mode, cache_size=16):
+        self.files = [sorted(glob.glob(drive_path + '/image_%s/data/*.png'%cid)) for cid in cam_ids]
+        self.mode = mode
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.files[0])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('frame %d out of range of %d frames'%(idx, len(self)))
+        if idx in self.cache:
+            frames = self.cache.pop(idx)
+        else:
+            frames = tuple(self.load(files[idx]) for files in self.files)
+        self.cache[idx] = frames
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return frames
+
+    def load(self, image_file):
+        with Image.open(image_file) as im:
+            return im.convert(self.mode)
+
+    def im_shape(self):
+        """ [H, W] of the left camera from the header of the first frame only; [-1, -1] for an empty drive. """
+        if len(self) == 0:
+            return [-1, -1]
+        with Image.open(self.files[0][0]) as im: # lazy: reads the header, does not decode
+            width, height = im.size
+        return [height, width]
+
+
 def pose_from_oxts_packet(metadata, scale):
 
     lat, lon, alt, roll, pitch, yaw = metadata
@@ -311,67 +435,133 @@ def pose_from_oxts_packet(metadata, scale):
     return transform_from_rot_trans(R, t)
 
 
-def read_calib_file(path):
-    # taken from https://github.com/hunse/kitti
-    float_chars = set("0123456789.e+- ")
-    data = {}
-    with open(path, 'r') as f:
-        for line in f.readlines():
-            key, value = line.split(':', 1)
-            value = value.strip()
-            data[key] = value
-            if float_chars.issuperset(value):
-                # try to cast to float array
-                try:
-                    data[key] = np.array(list(map(float, value.split(' '))))
-                except ValueError:
-                    # casting error: data[key] already eq. value, so pass
-                    pass
+def velo_proj_transform(calibs):
+    """ Composite [9, 4] float32 transform of a scene: velo_homo [N, 4] @ T.T gives X_cam0 (cols 0:3), X_rect (cols 3:6)
+        and the homogeneous pixels K @ X_rect (cols 6:9) of every point in one product. Assumes cam_2rect, velo2cam and
+        Rtl_gt are rigid (last row [0, 0, 0, 1]), so that no perspective divide is needed before the projection.
+    """
+    velo2cam0 = np.dot(calibs['cam_2rect'], calibs['velo2cam'])
+    velo2rect = np.dot(calibs['Rtl_gt'], velo2cam0)
+    return np.vstack((velo2cam0[:3], velo2rect[:3], np.dot(calibs['K'], velo2rect[:3]))).astype(np.float32)
 
-    return data
+def project_velo(velo_homo, calibs):
+    """ Returns X_cam0 [M, 3], X_rect [M, 3] and pixels x1 [M, 2] (cam 2) of the M points in front of the camera, as
+        views into one [M, 9] float32 buffer. Uses calibs['T_velo_proj'] (see velo_proj_transform) when precomputed.
+    """
+    T_velo_proj = calibs['T_velo_proj'] if 'T_velo_proj' in calibs else velo_proj_transform(calibs)
+    X_all = np.dot(velo_homo.astype(np.float32, copy=False), T_velo_proj.T) # [N, 9]
+    X_all = X_all[X_all[:, 5]>0] # front mask
+    X_all[:, 6:8] /= X_all[:, 8:9] # in-place perspective divide
+    return X_all[:, 0:3], X_all[:, 3:6], X_all[:, 6:8]
+
+def rectify_lr(velo_homo, calibs):
+    """ KittiLoader.rectify without plotting; returns val_idxes and X_rect [3, N] of the points in front of cam 2. """
+    _, X_rect, x1 = project_velo(velo_homo, calibs)
+    val_inds = utils_misc.within(x1[:, 0], x1[:, 1], calibs['im_shape'][1], calibs['im_shape'][0])
+
+    val_idxes = utils_misc.vis_masks_to_inds(val_inds, val_inds)
+    return val_idxes, np.ascontiguousarray(X_rect.T) # [M] int, 3*N; a copy, so that the [M, 9] buffer is freed
+
+class RectifyCache(object):
+    """ On-disk cache of rectified lidar frames: cache_dir/drive_name/<calib hash>/<frame_nb>.npz holds the visible
+        indexes (int32) and X_rect (float32) of one frame. The hash covers the calibs and the rectify function (its
+        qualified name and code, see function_fingerprint), so that changing either starts a new cache instead of
+        reusing stale frames; bump version when only a function called by rectify_fn changes.
+    """
+    def __init__(self, cache_dir, drive_name, calibs, rectify_fn, version=0):
+        self.calib_hash = calibs_hash(calibs, function_fingerprint(rectify_fn), version)
+        self.cache_dir = os.path.join(cache_dir, drive_name, self.calib_hash)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def frame_file(self, frame_nb):
+        return os.path.join(self.cache_dir, '%010d.npz'%frame_nb)
+
+    def has(self, frame_nb):
+        return os.path.isfile(self.frame_file(frame_nb))
+
+    def save(self, frame_nb, val_idxes, X_rect):
+        tmp_file = self.frame_file(frame_nb) + '.tmp.npz'
+        np.savez(tmp_file, val_idxes=np.asarray(val_idxes, dtype=np.int32), X_rect=X_rect.astype(np.float32))
+        os.rename(tmp_file, self.frame_file(frame_nb)) # a killed run never leaves a truncated frame behind
+
+    def load(self, frame_nb):
+        with np.load(self.frame_file(frame_nb)) as frame:
+            return frame['val_idxes'], frame['X_rect']
+
+    def field_list(self, field, frame_nbs):
+        return CachedFrameList(self, field, frame_nbs)
+
+class CachedFrameList(object):
+    """ List-like view of one field ('val_idxes' or 'X_rect') of a RectifyCache; loads a frame per access. """
+    def __init__(self, cache, field, frame_nbs):
+        self.cache = cache
+        self.field_idx = ['val_idxes', 'X_rect'].index(field)
+        self.frame_nbs = frame_nbs
+
+    def __len__(self):
+        return len(self.frame_nbs)
+
+    def __getitem__(self, idx):
+        return self.cache.load(self.frame_nbs[idx])[self.field_idx]
+
+def function_fingerprint(fn):
+    """ Qualified name, bytecode and constants of a function (the module name is left out, as the loaders import
+        utils_kitti both as kitti_tools.utils_kitti and as utils_kitti).
+    """
+    def code_digest(code, sha1):
+        sha1.update(code.co_code)
+        for const in code.co_consts: # nested functions and lambdas are code objects, whose repr has an address
+            if hasattr(const, 'co_code'):
+                code_digest(const, sha1)
+            else:
+                sha1.update(repr(const).encode())
+        return sha1
+    return '%s:%s'%(getattr(fn, '__qualname__', fn.__name__), code_digest(fn.__code__, hashlib.sha1()).hexdigest())
+
+def calibs_hash(calibs, *extra):
+    sha1 = hashlib.sha1()
+    for key in sorted(calibs.keys()):
+        sha1.update(key.encode())
+        sha1.update(np.ascontiguousarray(calibs[key], dtype=np.float64).tobytes())
+    for e in extra:
+        sha1.update(str(e).encode())
+    return sha1.hexdigest()[:16]
+
+def rectify_frame_to_cache(rectify_fn, calibs, velo_dir, velo_file, frame_nb, cache):
+    if cache.has(frame_nb):
+        return frame_nb
+    velo_pack = open_velo_pack(velo_dir)
+    velo_homo = velo_pack.load_homo(frame_nb) if velo_pack is not None else load_velo_homo(velo_file)
+    rectified = rectify_fn(velo_homo, calibs)
+    cache.save(frame_nb, rectified[0], rectified[1])
+    return frame_nb
+
+def rectify_to_cache(rectify_fn, calibs, velo_dir, velo_files, frame_nbs, cache, num_workers=1):
+    """ Rectifies the frames missing from the cache, on num_workers processes. """
+    todo = [(velo_file, frame_nb) for velo_file, frame_nb in zip(velo_files or [None]*len(frame_nbs), frame_nbs) if not cache.has(frame_nb)]
+    print('Rectifying %d/%d frames into %s on %d workers.'%(len(todo), len(frame_nbs), cache.cache_dir, num_workers))
+    if num_workers <= 1:
+        for velo_file, frame_nb in todo:
+            rectify_frame_to_cache(rectify_fn, calibs, velo_dir, velo_file, frame_nb, cache)
+        return
+    num_tasks = len(todo)
+    with ProcessPool(max_workers=num_workers) as pool:
+        tasks = pool.map(rectify_frame_to_cache, [rectify_fn]*num_tasks, [calibs]*num_tasks, [velo_dir]*num_tasks, \
+            [velo_file for velo_file, _ in todo], [frame_nb for _, frame_nb in todo], [cache]*num_tasks, chunksize=16)
+        try:
+            for _ in tasks.result():
+                pass
+        except KeyboardInterrupt as e:
+            tasks.cancel()
+            raise e
 
 def rectify(velo_homo, calibs):
-        val_inds_list = []
-
-        X_homo = np.dot(np.dot(calibs['cam_2rect'], calibs['velo2cam']), velo_homo.T) # 4*N
-        X_cam0 = utils_misc.de_homo_np(X_homo.T).copy()
-        X_rect_homo = np.matmul(calibs['Rtl_gt'], X_homo)
-        X_rect = X_rect_homo[:3, :] / X_rect_homo[3:4, :]
-
-        front_mask = X_rect[-1, :]>0
-        X_rect = X_rect[:, front_mask]
-        X_rect_homo = X_rect_homo[:, front_mask]
-        X_cam0 = X_cam0[front_mask, :]
-
-        # Plot with recfitied X and R, t
-        x1_homo = np.matmul(calibs['K'], np.matmul(np.hstack((np.eye(3), np.zeros((3, 1)))), X_rect_homo)).T
-        x1 = x1_homo[:, 0:2]/x1_homo[:, 2:3]
-        val_inds = utils_misc.within(x1[:, 0], x1[:, 1], calibs['im_shape'][1]-1, calibs['im_shape'][0]-1)
-        val_inds_list.append(val_inds)
-
-        # x2_homo = np.matmul(calibs['K'], np.matmul(np.hstack((calibs['delta_Rlr_gt'], calibs['delta_tlr_gt'])), X_homo_rect)).T
-        # x2 = x2_homo[:, :2]/x2_homo[:, 2:3]
-        # val_inds = utils_misc.within(x1[:, 0], x1[:, 1], calibs['im_shape'][1]-1, calibs['im_shape'][0]-1)
-        # val_inds_list.append(val_inds)
-
-        # val_inds_both = val_inds_list[0] & val_inds_list[1]
-        # val_idxes = [idx for idx in range(val_inds_both.shape[0]) if val_inds_both[idx]] # within indexes
-
-        val_idxes = utils_misc.vis_masks_to_inds(val_inds_list[0], val_inds_list[0])
-        return val_idxes, X_rect.T, X_cam0
-
-def load_velo_scan(velo_filename):
-    # https://github.com/charlesq34/frustum-pointnets/blob/889c277144a33818ddf73c4665753975f9397fc4/kitti/kitti_util.py#L270
-    scan = np.fromfile(velo_filename, dtype=np.float32)
-    scan = scan.reshape((-1, 4))
-    return scan
-
-def transform_from_rot_trans(R, t):
-    """Transforation matrix from rotation matrix and translation vector."""
-    R = R.reshape(3, 3)
-    t = t.reshape(3, 1)
-    return np.vstack((np.hstack([R, t]), [0, 0, 0, 1]))
+    X_cam0, X_rect, x1 = project_velo(velo_homo, calibs)
+    val_inds = utils_misc.within(x1[:, 0], x1[:, 1], calibs['im_shape'][1]-1, calibs['im_shape'][0]-1)
 
+    val_idxes = utils_misc.vis_masks_to_inds(val_inds, val_inds)
+    return val_idxes, np.ascontiguousarray(X_rect), np.ascontiguousarray(X_cam0) # copies, not views into the [M, 9] buffer
 
 def rotx(t):
     """Rotation about the x-axis."""
@@ -426,6 +616,12 @@ def load_as_array(path, dtype=None):
         return array
 
 def load_sift(dump_dir, frame_nb, ext):
+    if ext == '.pack': # frames.pack of dump_drive(save_pack=True)
+        sift = load_frame(dump_dir, 'sift', frame_nb)
+        return sift['sift_kp'], sift['sift_des']
+    if ext == '.h5':
+        sift = loadh5(dump_dir/'sift_{}'.format(frame_nb) + ext)
+        return sift['sift_kp'].astype(np.float32), sift['sift_des'].astype(np.float32)
     sift_file = dump_dir/'sift_{}'.format(frame_nb) + ext
     sift_array = load_as_array(sift_file, np.float32)
     sift_kp = sift_array[:, :2] # [N, 2]
@@ -433,6 +629,12 @@ def load_sift(dump_dir, frame_nb, ext):
     return sift_kp, sift_des
 
 def load_SP(dump_dir, frame_nb, ext):
+    if ext == '.pack':
+        SP = load_frame(dump_dir, 'SP', frame_nb)
+        return SP['SP_kp'], SP['SP_des']
+    if ext == '.h5':
+        SP = loadh5(dump_dir/'SP_{}'.format(frame_nb) + ext)
+        return SP['SP_kp'].astype(np.float32), SP['SP_des'].astype(np.float32)
     SP_file = dump_dir/'SP_{}'.format(frame_nb) + ext
     SP_array = load_as_array(SP_file, np.float32)
     SP_kp = SP_array[:, :3] # [N, 2]
@@ -0,0 +1,92 @@
+""" Manifests of the files written by the dump scripts, for resuming an interrupted dump.
+
+Each record says which files an artifact of an item (e.g. the 'sift' of frame '000042', or the 'sift_match' of pair
+'3-8') was written to, with their sizes (and sha1 with DumpManifest(sha1=True), which reads every file back once
+written), and the key of the parameters it was computed with (see
+params_key). Records are appended as json lines to manifest_<name>.jsonl in the dump dir, one file per writer
+process, so that a crash loses at most the line being written; reading loads all manifest_*.jsonl of the dir and
+later records override earlier ones. An artifact is done when its record has the current key and its files still
+have the recorded sizes, so that changing e.g. sift_num only invalidates the sift (and match) artifacts. Artifacts
+derived from others (the matches of a pair from the features of both frames) put the version of what they were
+computed from in their key, so that recomputing a frame's features also invalidates its pairs.
+"""
+import os
+import glob
+import json
+import time
+import hashlib
+import logging
+
+def params_key(*params):
+    """ Short hash of parameter values (anything with a stable str). """
+    sha1 = hashlib.sha1()
+    for p in params:
+        sha1.update(str(p).encode())
+    return sha1.hexdigest()[:16]
+
+def file_sha1(filename, chunk_size=1<<20):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+class DumpManifest(object):
+    def __init__(self, dump_dir, name='frames', sha1=False):
+        self.dump_dir = str(dump_dir)
+        self.sha1 = sha1 # record the sha1 of the files (None otherwise), for done(check_sha1=True)
+        self.path = os.path.join(self.dump_dir, 'manifest_%s.jsonl'%name)
+        self.records = {} # (item, artifact) -> {'key': ..., 'time': ..., 'files': {filename: [size, sha1 or None]}}
+        for manifest_file in sorted(glob.glob(os.path.join(self.dump_dir, 'manifest_*.jsonl'))):
+            self.load(manifest_file)
+        self.f = None
+
+    def load(self, manifest_file):
+        with open(manifest_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError: # partially written last line
+                    logging.warning('Skipping a broken record in %s.'%manifest_file)
+                    continue
+                self.records[(record['item'], record['artifact'])] = record
+
+    @staticmethod
+    def clear(dump_dir):
+        """ Removes all manifests of dump_dir (before a dump that rewrites everything). """
+        for manifest_file in glob.glob(os.path.join(str(dump_dir), 'manifest_*.jsonl')):
+            os.remove(manifest_file)
+
+    def done(self, item, artifact, key, check_sha1=False):
+        record = self.records.get((item, artifact))
+        if record is None or record['key'] != key:
+            return False
+        for filename, (size, sha1) in record['files'].items():
+            path = os.path.join(self.dump_dir, filename)
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                return False
+            if check_sha1 and sha1 is not None and file_sha1(path) != sha1:
+                return False
+        return True
+
+    def version(self, item, artifact):
+        """ Identifies the recorded write of artifact of item (None if there is none); changes whenever it is recorded again. """
+        record = self.records.get((item, artifact))
+        if record is None:
+            return None
+        return params_key(record['key'], record.get('time'), sorted((filename, size, sha1) for filename, (size, sha1) in record['files'].items()))
+
+    def add(self, item, artifact, key, files):
+        """ Records files (paths in the dump dir) as written for artifact of item. """
+        record = {'item': item, 'artifact': artifact, 'key': key, 'time': time.time(), \
+            'files': dict((os.path.basename(f), [os.path.getsize(f), file_sha1(f) if self.sha1 else None]) for f in files)}
+        self.records[(item, artifact)] = record
+        if self.f is None:
+            self.f = open(self.path, 'a')
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
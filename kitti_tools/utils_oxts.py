@@ -0,0 +1,65 @@
+""" OXTS (GPS/IMU) reader shared by the loaders.
+
+A raw drive holds one oxts/data/%010d.txt per frame with 30 values (lat, lon, alt, roll, pitch, yaw, ...,
+vf, vl, vu at 8:11, ...). read_oxts_dir reads all of them into one [N, 30] array, and oxts_poses turns the packets
+into IMU poses [N, 4, 4] in one batch (same Mercator projection and Rz @ Ry @ Rx convention as
+utils_kitti.pose_from_oxts_packet). load_oxts keeps both per drive, so that a drive is parsed once per process.
+"""
+import os
+import glob
+import numpy as np
+
+OXTS_N_FIELDS = 30
+EARTH_RADIUS = 6378137. # in meters (approx.)
+
+def read_oxts_dir(oxts_dir):
+    """ Returns the packets of all .txt files in oxts_dir (sorted by name) as [N, 30] float64. """
+    oxts_files = sorted(glob.glob(os.path.join(oxts_dir, '*.txt')))
+    chunks = []
+    for oxts_file in oxts_files:
+        with open(oxts_file, 'rb') as f:
+            chunks.append(f.read())
+    oxts = np.array(b' '.join(chunks).split(), dtype=np.float64)
+    assert oxts.shape[0] == OXTS_N_FIELDS * len(oxts_files), 'Corrupted oxts file in %s!'%oxts_dir
+    return oxts.reshape((-1, OXTS_N_FIELDS))
+
+def rot_from_euler(roll, pitch, yaw):
+    """ Rz(yaw) @ Ry(pitch) @ Rx(roll) for arrays of angles [N]; returns [N, 3, 3]. """
+    cr, sr = np.cos(roll), np.sin(roll)
+    cp, sp = np.cos(pitch), np.sin(pitch)
+    cy, sy = np.cos(yaw), np.sin(yaw)
+    R = np.empty((len(roll), 3, 3))
+    R[:, 0, 0], R[:, 0, 1], R[:, 0, 2] = cy * cp, cy * sp * sr - sy * cr, cy * sp * cr + sy * sr
+    R[:, 1, 0], R[:, 1, 1], R[:, 1, 2] = sy * cp, sy * sp * sr + cy * cr, sy * sp * cr - cy * sr
+    R[:, 2, 0], R[:, 2, 1], R[:, 2, 2] = -sp, cp * sr, cp * cr
+    return R
+
+def oxts_poses(oxts, scale=None):
+    """ SE(3) IMU poses [N, 4, 4] of packets oxts [N, >=6]; scale defaults to cos(latitude) of the first packet. """
+    lat, lon, alt, roll, pitch, yaw = oxts[:, :6].T
+    if scale is None:
+        scale = np.cos(lat[0] * np.pi / 180.) if len(oxts) else 1.
+    poses = np.zeros((len(oxts), 4, 4))
+    # Use a Mercator projection to get the translation vector
+    poses[:, 0, 3] = scale * lon * np.pi * EARTH_RADIUS / 180.
+    poses[:, 1, 3] = lat * np.pi * EARTH_RADIUS / 180.
+    poses[:, 2, 3] = alt
+    poses[:, :3, :3] = rot_from_euler(roll, pitch, yaw)
+    poses[:, 3, 3] = 1.
+    return poses
+
+_drive_oxts = {}
+
+def load_oxts(drive_path):
+    """ Returns read-only (oxts [N, 30], poses [N, 4, 4]) of a raw drive, parsed once per process (and again only
+        when files are added to or removed from its oxts/data).
+    """
+    oxts_dir = os.path.realpath(os.path.join(drive_path, 'oxts', 'data'))
+    version = os.stat(oxts_dir).st_mtime if os.path.isdir(oxts_dir) else None
+    if oxts_dir not in _drive_oxts or _drive_oxts[oxts_dir][0] != version:
+        oxts = read_oxts_dir(oxts_dir)
+        poses = oxts_poses(oxts)
+        oxts.setflags(write=False)
+        poses.setflags(write=False)
+        _drive_oxts[oxts_dir] = (version, oxts, poses)
+    return _drive_oxts[oxts_dir][1:]
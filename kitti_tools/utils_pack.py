@@ -0,0 +1,144 @@
+""" Append-only record packs: the per-frame and per-pair arrays of a dumped drive in a few files.
+
+A pack is a data file of concatenated records plus an index (<pack>.idx, one json line per record) giving for each
+record key (e.g. 'sift/000042' or 'sift_match/3-8') its offset, size and fields (name, dtype, shape, offset in the
+record). A record is read with a single pread of its bytes and its arrays are views into them. Records are only
+ever appended: the index line is written after the data, and a record written again (e.g. on --resume with new
+parameters) supersedes the old one. A writer re-opening a pack drops any data past the last indexed record.
+
+dump_drive (save_pack=True) writes frames.pack (X, sift and SP of each frame) and <match>_<delta>.pack (the matches of
+the pairs (i, i+delta), one pack per match process), and utils_imwrite.ImageWriter images.pack (img_format='pack');
+load_frame and load_pair read them back.
+"""
+import os
+import json
+import logging
+import numpy as np
+
+def pack_index_path(pack_filename):
+    return pack_filename + '.idx'
+
+def read_pack_index(pack_filename):
+    """ Returns {key: entry}; the last entry of a key wins, and a partially written last line is skipped. """
+    index = {}
+    index_filename = pack_index_path(pack_filename)
+    if not os.path.isfile(index_filename):
+        return index
+    with open(index_filename, 'r') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logging.warning('Skipping a broken index entry in %s.'%index_filename)
+                continue
+            index[entry['key']] = entry
+    return index
+
+class RecordPackWriter(object):
+    def __init__(self, pack_filename, append=True):
+        self.pack_filename = str(pack_filename)
+        if append:
+            self.index = read_pack_index(self.pack_filename)
+            end = max([entry['offset'] + entry['size'] for entry in self.index.values()] + [0])
+            if os.path.isfile(self.pack_filename) and os.path.getsize(self.pack_filename) > end:
+                with open(self.pack_filename, 'r+b') as f: # drop a record interrupted before its index entry
+                    f.truncate(end)
+        else:
+            self.index = {}
+            for filename in [self.pack_filename, pack_index_path(self.pack_filename)]:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+        self.f = open(self.pack_filename, 'ab')
+        self.f_index = open(pack_index_path(self.pack_filename), 'a')
+        if self.f_index.tell() > 0:
+            with open(pack_index_path(self.pack_filename), 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n': # keep a partially written entry on its own line
+                    self.f_index.write('\n')
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def add(self, key, arrays):
+        """ Appends a record of named arrays (dict name -> array). """
+        offset = self.f.tell()
+        fields = []
+        size = 0
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            fields.append([name, array.dtype.str, list(array.shape), size])
+            self.f.write(array.tobytes())
+            size += array.nbytes
+        self.f.flush()
+        entry = {'key': key, 'offset': offset, 'size': size, 'fields': fields}
+        self.f_index.write(json.dumps(entry) + '\n')
+        self.f_index.flush()
+        self.index[key] = entry
+
+    def close(self):
+        self.f.close()
+        self.f_index.close()
+
+class RecordPack(object):
+    """ Random access reader of a pack. """
+    def __init__(self, pack_filename):
+        self.pack_filename = str(pack_filename)
+        self.index = read_pack_index(self.pack_filename)
+        self.fd = os.open(self.pack_filename, os.O_RDONLY)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        return self.index.keys()
+
+    def load(self, key):
+        """ Returns the record as a dict name -> read-only array (or None). """
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        buf = os.pread(self.fd, entry['size'], entry['offset'])
+        arrays = {}
+        for name, dtype, shape, offset in entry['fields']:
+            count = int(np.prod(shape))
+            if count == 0: # frombuffer refuses an offset at the end of the buffer
+                arrays[name] = np.zeros(shape, dtype=dtype)
+            else:
+                arrays[name] = np.frombuffer(buf, dtype=dtype, count=count, offset=offset).reshape(shape)
+        return arrays
+
+    def close(self):
+        os.close(self.fd)
+
+_record_packs = {}
+
+def open_record_pack(pack_filename):
+    """ Returns the (cached) RecordPack of pack_filename, re-read when its index has grown; None if there is none. """
+    pack_filename = str(pack_filename)
+    if not os.path.isfile(pack_index_path(pack_filename)):
+        return None
+    version = os.path.getsize(pack_index_path(pack_filename))
+    if pack_filename not in _record_packs or _record_packs[pack_filename][0] != version:
+        if pack_filename in _record_packs:
+            _record_packs[pack_filename][1].close()
+        _record_packs[pack_filename] = (version, RecordPack(pack_filename))
+    return _record_packs[pack_filename][1]
+
+def frame_key(artifact, frame_nb):
+    return '%s/%s'%(artifact, frame_nb)
+
+def pair_key(artifact, i, j):
+    return '%s/%d-%d'%(artifact, i, j)
+
+def load_frame(dump_dir, artifact, frame_nb, pack_name='frames'):
+    """ e.g. load_frame(dump_dir, 'sift', '000042') -> {'sift_kp': [N, 2], 'sift_des': [N, 128]} """
+    pack = open_record_pack(os.path.join(str(dump_dir), '%s.pack'%pack_name))
+    return None if pack is None else pack.load(frame_key(artifact, frame_nb))
+
+def load_pair(dump_dir, pack_name, artifact, i, j):
+    """ e.g. load_pair(dump_dir, 'sift_match', 'sift_match', 3, 8) or load_pair(dump_dir, 'SP_match', 'SP_match_good', 3, 8) """
+    pack = open_record_pack(os.path.join(str(dump_dir), '%s_%d.pack'%(pack_name, j - i)))
+    return None if pack is None else pack.load(pair_key(artifact, i, j))
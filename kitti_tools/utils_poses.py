@@ -0,0 +1,79 @@
+""" Relative poses of frame pairs, for all pairs of a drive at once.
+
+Given the camera poses of a drive (camera -> world, [N, 4, 4] or [N, 3, 4]), RelativePoses inverts them once with
+the closed-form rigid inverse and then gives, for any arrays of frame indices i and j, the camera motion
+inv(pose_i) @ pose_j (as delta_Rtij_inv in KittiLoader.get_ij) and the scene motion Rt_out @ inv(pose_j) @ pose_i
+@ inv(Rt_out) (delta_Rtij, expressed in the output camera, e.g. Rtl_gt for cam 2) with a few batched matmuls.
+"""
+import numpy as np
+
+def Rt_pad_batch(Rts):
+    """ [N, 3, 4] or [N, 4, 4] -> [N, 4, 4] """
+    if Rts.shape[1:] == (4, 4):
+        return Rts
+    pad = np.zeros((Rts.shape[0], 1, 4), dtype=Rts.dtype)
+    pad[:, 0, 3] = 1.
+    return np.concatenate((Rts, pad), axis=1)
+
+def inv_Rt_batch(Rts):
+    """ Inverse of rigid transforms [N, 3, 4] or [N, 4, 4] as [N, 4, 4]: [R^T | -R^T t] (utils_misc.inv_Rt_np in batch). """
+    R_inv = np.swapaxes(Rts[:, :3, :3], 1, 2)
+    Rts_inv = np.zeros((Rts.shape[0], 4, 4), dtype=Rts.dtype)
+    Rts_inv[:, :3, :3] = R_inv
+    Rts_inv[:, :3, 3:4] = -np.matmul(R_inv, Rts[:, :3, 3:4])
+    Rts_inv[:, 3, 3] = 1.
+    return Rts_inv
+
+def rot_angle_errors(Rs):
+    """ Rotation angles in degree [N] of Rs [N, 3, 3], same as utils_geo.rot12_to_angle_error(np.eye(3), R) for each R
+        (atan2 of the skew part and the trace, which stays accurate for small angles).
+    """
+    skew = np.stack((Rs[:, 2, 1] - Rs[:, 1, 2], Rs[:, 0, 2] - Rs[:, 2, 0], Rs[:, 1, 0] - Rs[:, 0, 1]), axis=1)
+    trace = Rs[:, 0, 0] + Rs[:, 1, 1] + Rs[:, 2, 2]
+    return np.degrees(np.arctan2(np.linalg.norm(skew, axis=1), trace - 1.))
+
+def t_angle_errors(ts, t_ref=(0., 0., 1.)):
+    """ Angles in degree [N] between translations ts [N, 3] and t_ref, as utils_geo.vector_angle for each t. """
+    ts = ts.reshape((-1, 3))
+    cos = np.dot(ts, np.asarray(t_ref, dtype=ts.dtype)) / (np.linalg.norm(ts, axis=1) * np.linalg.norm(t_ref) + 1e-10)
+    return np.degrees(np.arccos(np.clip(cos, -1., 1.)))
+
+class RelativePoses(object):
+    """ Camera and scene motion between frames of a drive, from camera poses computed once. """
+    def __init__(self, cam_poses, Rt_out=None):
+        self.poses = Rt_pad_batch(np.asarray(cam_poses, dtype=np.float64)) # [N, 4, 4] camera -> world
+        self.poses_inv = inv_Rt_batch(self.poses)
+        self.Rt_out = np.eye(4) if Rt_out is None else np.asarray(Rt_out, dtype=np.float64)
+        self.Rt_out_inv = np.linalg.inv(self.Rt_out) # not necessarily rigid (e.g. inv(K) @ P_rect)
+
+    @classmethod
+    def from_imu_poses(cls, imu_poses, imu2cam, Rt_out=None):
+        """ From IMU poses [N, 4, 4] (utils_oxts.load_oxts), so that camera_motion(i, j) is
+            imu2cam @ inv(imu_pose_i) @ imu_pose_j @ inv(imu2cam).
+        """
+        cam_poses = np.matmul(imu_poses, inv_Rt_batch(np.asarray(imu2cam)[np.newaxis]))
+        return cls(cam_poses, Rt_out)
+
+    def __len__(self):
+        return self.poses.shape[0]
+
+    def camera_motion(self, i, j):
+        """ [3, 4] (or [K, 3, 4] for index arrays) inv(pose_i) @ pose_j. """
+        return np.matmul(self.poses_inv[i], self.poses[j])[..., :3, :]
+
+    def scene_motion(self, i, j):
+        """ [3, 4] (or [K, 3, 4]) Rt_out @ inv(pose_j) @ pose_i @ inv(Rt_out), i.e. Rt_out @ inv(camera_motion(i, j)) @ inv(Rt_out). """
+        return np.matmul(np.matmul(self.Rt_out, np.matmul(self.poses_inv[j], self.poses[i])), self.Rt_out_inv)[..., :3, :]
+
+    def pairs(self, delta_ijs):
+        """ All pairs (i, i+delta) for delta in delta_ijs, ordered by delta then i, as a dict of arrays:
+            i, j [K]; delta_Rtij (scene motion), delta_Rtij_inv (camera motion) [K, 3, 4];
+            angle_R, angle_t [K] (in degree, of the camera motion, as printed by KittiLoader.get_ij).
+        """
+        delta_ijs = [delta for delta in delta_ijs if delta < len(self)]
+        counts = [len(self) - delta for delta in delta_ijs]
+        i = np.concatenate([np.arange(count) for count in counts]) if counts else np.zeros((0,), dtype=np.int64)
+        j = i + np.repeat(np.asarray(delta_ijs, dtype=np.int64), counts)
+        delta_Rtij_inv = self.camera_motion(i, j)
+        return {'i': i, 'j': j, 'delta_Rtij': self.scene_motion(i, j), 'delta_Rtij_inv': delta_Rtij_inv, \
+            'angle_R': rot_angle_errors(delta_Rtij_inv[:, :, :3]), 'angle_t': t_angle_errors(delta_Rtij_inv[:, :, 3])}
@@ -0,0 +1,185 @@
+""" Velodyne scan reader shared by the loaders.
+
+A KITTI velodyne .bin is a flat float32 array of [x, y, z, reflectance] rows. Scans are memory-mapped
+instead of read with np.fromfile, so xyz/reflectance (and xyz[:, :3] slices) are views into the page
+cache rather than copies. A whole drive can also be packed into one file (pack_velo.py) and read with VeloPack,
+which load_velo in the loaders picks up automatically as long as it matches the .bin files.
+"""
+import os
+import logging
+import numpy as np
+
+VELO_DTYPE = np.dtype([('xyz', np.float32, (3,)), ('reflectance', np.float32)])
+
+def _memmap(velo_filename, dtype, readonly):
+    if os.path.getsize(velo_filename) == 0: # mmap refuses empty files
+        return np.zeros((0,), dtype=dtype)
+    # 'c' is copy-on-write: writes stay in memory and never reach the file
+    return np.asarray(np.memmap(velo_filename, dtype=dtype, mode='r' if readonly else 'c'))
+
+def load_velo_scan(velo_filename, readonly=True):
+    """ Returns the scan as a [N, 4] float32 view of the file. """
+    return _memmap(velo_filename, np.float32, readonly).reshape((-1, 4))
+
+def load_velo_fields(velo_filename, readonly=True):
+    """ Returns zero-copy views xyz [N, 3] and reflectance [N] of the scan. """
+    scan = _memmap(velo_filename, VELO_DTYPE, readonly)
+    return scan['xyz'], scan['reflectance']
+
+def load_velo_homo(velo_filename):
+    """ Returns homogeneous points [N, 4] (reflectance replaced by 1.) in the scan's own copy-on-write
+        buffer, to be used in place of utils_misc.homo_np(scan[:, :3]).
+    """
+    scan = load_velo_scan(velo_filename, readonly=False)
+    scan[:, 3] = 1.
+    return scan
+
+########## Packed drives: all sweeps of a drive in one file ##########
+# Layout (little endian):
+#   magic 'KITTIVP3' | uint64 n_frames | float64 dir_mtime | int64 frame_nbs[n_frames] | uint64 offsets[n_frames+1]
+#   | float64 mtimes[n_frames] | float32 [sum(N), 4]
+# frame_nbs are the integer names of the .bin files; offsets are in points, so frame k is rows offsets[k]:offsets[k+1].
+# open_velo_pack only compares the mtime of the velodyne dir and its number of .bin files (no per-frame stat, which is
+# what the pack saves on network filesystems); the sizes (from the offsets) and mtimes of the .bin files are checked
+# by pack_velo.py --verify, which also catches a .bin rewritten in place.
+VELO_PACK_MAGIC = b'KITTIVP3'
+
+def velo_pack_path(velo_dir):
+    """ e.g. sequences/00/velodyne -> sequences/00/velodyne.pack; drive/velodyne_points/data -> drive/velodyne_points/data.pack """
+    return velo_dir.rstrip('/') + '.pack'
+
+def pack_velo_dir(velo_dir, pack_filename=None):
+    """ Packs every .bin under velo_dir into one file; returns the pack path. """
+    if pack_filename is None:
+        pack_filename = velo_pack_path(velo_dir)
+    dir_mtime = os.stat(velo_dir).st_mtime
+    velo_files = sorted(f for f in os.listdir(velo_dir) if f.endswith('.bin'))
+    frame_nbs = np.array([int(f[:-4]) for f in velo_files], dtype='<i8')
+    stats = [os.stat(os.path.join(velo_dir, f)) for f in velo_files]
+    sizes = np.array([st.st_size for st in stats], dtype='<u8')
+    mtimes = np.array([st.st_mtime for st in stats], dtype='<f8')
+    assert np.all(sizes % VELO_DTYPE.itemsize == 0), 'Corrupted velodyne file in %s!'%velo_dir
+    offsets = np.concatenate([[0], np.cumsum(sizes // VELO_DTYPE.itemsize)]).astype('<u8')
+
+    tmp_filename = pack_filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(VELO_PACK_MAGIC)
+        f.write(np.array([len(velo_files)], dtype='<u8').tobytes())
+        f.write(np.array([dir_mtime], dtype='<f8').tobytes())
+        f.write(frame_nbs.tobytes())
+        f.write(offsets.tobytes())
+        f.write(mtimes.tobytes())
+        for velo_file in velo_files:
+            with open(os.path.join(velo_dir, velo_file), 'rb') as f_bin:
+                f.write(f_bin.read())
+    os.rename(tmp_filename, pack_filename) # never leave a half-written pack behind
+    return pack_filename
+
+class VeloPack(object):
+    """ Random access reader of a packed drive; frames are addressed by their frame number. """
+    def __init__(self, pack_filename):
+        self.pack_filename = pack_filename
+        with open(pack_filename, 'rb') as f:
+            assert f.read(len(VELO_PACK_MAGIC)) == VELO_PACK_MAGIC, 'Not a velodyne pack: %s'%pack_filename
+            n_frames = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+            self.dir_mtime = float(np.frombuffer(f.read(8), dtype='<f8')[0])
+            self.frame_nbs = np.frombuffer(f.read(8 * n_frames), dtype='<i8')
+            self.offsets = np.frombuffer(f.read(8 * (n_frames + 1)), dtype='<u8').astype(np.int64)
+            self.mtimes = np.frombuffer(f.read(8 * n_frames), dtype='<f8')
+            self.data_offset = f.tell()
+        self.n_points = int(self.offsets[-1])
+        self.data = _memmap_region(pack_filename, self.data_offset, self.n_points, 'r')
+
+    def __len__(self):
+        return self.frame_nbs.shape[0]
+
+    def matches_dir(self, velo_dir, full=False):
+        """ Whether the pack holds the current .bin files of velo_dir: same dir mtime and number of .bin files, or with
+            full=True same frames, sizes and mtimes (one stat per frame). A drive whose .bin files were deleted after
+            packing is taken as matching.
+        """
+        if not os.path.isdir(velo_dir):
+            return True
+        velo_files = [f for f in os.listdir(velo_dir) if f.endswith('.bin')]
+        if not velo_files:
+            return True
+        if not full:
+            return len(velo_files) == len(self) and os.stat(velo_dir).st_mtime == self.dir_mtime
+        velo_files = sorted(velo_files)
+        if len(velo_files) != len(self) or any(int(f[:-4]) != frame_nb for f, frame_nb in zip(velo_files, self.frame_nbs)):
+            return False
+        stats = [os.stat(os.path.join(velo_dir, f)) for f in velo_files]
+        sizes = np.diff(self.offsets) * VELO_DTYPE.itemsize
+        return all(st.st_size == size and st.st_mtime == mtime for st, size, mtime in zip(stats, sizes, self.mtimes))
+
+    def __contains__(self, frame_nb):
+        return self._pos(frame_nb) is not None
+
+    def _pos(self, frame_nb):
+        pos = np.searchsorted(self.frame_nbs, frame_nb)
+        if pos < len(self) and self.frame_nbs[pos] == frame_nb:
+            return pos
+        return None
+
+    def load(self, frame_nb, readonly=True):
+        """ Returns a [N, 4] view of one scan (or None); readonly=False maps a private copy-on-write region. """
+        pos = self._pos(int(frame_nb))
+        if pos is None:
+            return None
+        start, stop = self.offsets[pos], self.offsets[pos+1]
+        if readonly:
+            return self.data[start:stop]
+        return _memmap_region(self.pack_filename, self.data_offset + start * VELO_DTYPE.itemsize, stop - start, 'c')
+
+    def load_homo(self, frame_nb):
+        """ Same as load_velo_homo, for a packed frame. """
+        scan = self.load(frame_nb, readonly=False)
+        if scan is not None:
+            scan[:, 3] = 1.
+        return scan
+
+    def load_range(self, frame_start, frame_stop, in_memory=False):
+        """ Returns the scans with frame_start <= frame number < frame_stop, as views into one contiguous block.
+            in_memory=True reads the block with a single seek and read instead of mapping it.
+        """
+        pos_start, pos_stop = np.searchsorted(self.frame_nbs, [frame_start, frame_stop])
+        if pos_stop <= pos_start:
+            return []
+        start, stop = self.offsets[pos_start], self.offsets[pos_stop]
+        if in_memory:
+            with open(self.pack_filename, 'rb') as f:
+                f.seek(self.data_offset + start * VELO_DTYPE.itemsize)
+                block = np.fromfile(f, dtype=np.float32, count=4 * (stop - start)).reshape((-1, 4))
+        else:
+            block = self.data[start:stop]
+        return np.split(block, self.offsets[pos_start+1:pos_stop] - start)
+
+def _memmap_region(filename, offset, n_points, mode):
+    if n_points == 0:
+        return np.zeros((0, 4), dtype=np.float32)
+    return np.asarray(np.memmap(filename, dtype=np.float32, mode=mode, offset=offset, shape=(n_points, 4)))
+
+_velo_packs = {}
+
+def open_velo_pack(velo_dir):
+    """ Returns the (cached) VeloPack of velo_dir, or None if the drive has not been packed, or if the pack is out of
+        date (older format, or .bin files added, removed or changed since; the loaders then read the .bin files).
+    """
+    velo_dir = str(velo_dir)
+    pack_filename = velo_pack_path(velo_dir)
+    if not os.path.isfile(pack_filename):
+        return None
+    version = os.path.getmtime(pack_filename)
+    if pack_filename not in _velo_packs or _velo_packs[pack_filename][0] != version:
+        velo_pack = None
+        with open(pack_filename, 'rb') as f:
+            magic = f.read(len(VELO_PACK_MAGIC))
+        if magic != VELO_PACK_MAGIC:
+            logging.warning('Velodyne pack %s has an old format; reading the .bin files. Re-run pack_velo.py.'%pack_filename)
+        else:
+            velo_pack = VeloPack(pack_filename)
+            if not velo_pack.matches_dir(velo_dir):
+                logging.warning('Velodyne pack %s is out of date; reading the .bin files. Re-run pack_velo.py.'%pack_filename)
+                velo_pack = None
+        _velo_packs[pack_filename] = (version, velo_pack)
+    return _velo_packs[pack_filename][1]
@@ -8,6 +8,8 @@ from __future__ import print_function
 import numpy as np
 import cv2
 import os
+from kitti_tools.utils_velo import load_velo_scan
+from kitti_tools.utils_calib import get_calib_registry
 
 class Object3d(object):
     ''' 3d object label '''
@@ -104,22 +106,9 @@ class Calibration(object):
 
     def read_calib_file(self, filepath):
         ''' Read in a calibration file and parse into a dictionary.
-        Ref: https://github.com/utiasSTARS/pykitti/blob/master/pykitti/utils.py
+        Parsed once per file by the shared kitti_tools.utils_calib registry.
         '''
-        data = {}
-        with open(filepath, 'r') as f:
-            for line in f.readlines():
-                line = line.rstrip()
-                if len(line)==0: continue
-                key, value = line.split(':', 1)
-                # The only non-float values in these files are dates, which
-                # we don't care about anyway
-                try:
-                    data[key] = np.array([float(x) for x in value.split()])
-                except ValueError:
-                    pass
-
-        return data
+        return get_calib_registry().read(filepath)
     
     def read_calib_from_video(self, calib_root_dir):
         ''' Read calibration for camera 2 from video calib files.
@@ -267,11 +256,6 @@ def read_label(label_filename):
 def load_image(img_filename):
     return cv2.imread(img_filename)
 
-def load_velo_scan(velo_filename):
-    scan = np.fromfile(velo_filename, dtype=np.float32)
-    scan = scan.reshape((-1, 4))
-    return scan
-
 def project_to_image(pts_3d, P):
     ''' Project 3d points to image plane.
 
@@ -27,9 +27,11 @@ or simply on command line:
 #   Tracklet objects have str and iter functions
 # 5/7/12 ch: added constants for state, occlusion, truncation and added consistency checks
 # 30/1/14 ch: create example function from example code
+# streaming iterparse parser into a columnar TrackletTable; Tracklet objects are views into its columns
 
 from sys import argv as cmdLineArgs
-from xml.etree.ElementTree import ElementTree
+from xml.etree.ElementTree import ElementTree, Element, iterparse
+import itertools
 import numpy as np
 from warnings import warn
 
@@ -124,153 +126,206 @@ class Tracklet(object):
 #end: class Tracklet
 
 
-def parseXML(trackletFile):
-    """ 
-    Parses tracklet xml file and convert results to list of Tracklet objects
+class TrackletTable(object):
+    """
+    Columnar representation of all tracklets of a tracklet xml file, created by parseXMLColumns
 
-    :param trackletFile: name of a tracklet xml file
-    :returns: list of Tracklet objects read from xml file
+    Per pose (one row per tracklet and frame, grouped by tracklet): frames (absolute frame numbers), ids (tracklet
+    index), trans/rots (P x 3 float), states/truncs (len-P uint8), occs (P x 2 uint8), amtOccs (P x 2 float) and
+    amtBorders (P x 3 float), NaN where the file has no amt_* fields.
+    Per tracklet: objectTypes (list of strings), sizes (T x 3 float: height, width, length), firstFrames, nFrames and
+    hasAmt (len-T arrays); the poses of tracklet t are rows offsets[t]:offsets[t+1].
     """
 
-    # convert tracklet XML data to a tree structure
-    eTree = ElementTree()
-    print('Parsing tracklet file', trackletFile)
-    with open(trackletFile) as f:
-        eTree.parse(f)
-
-    # now convert output to list of Tracklet objects
-    trackletsElem = eTree.find('tracklets')
-    tracklets = []
-    trackletIdx = 0
-    nTracklets = None
-    for trackletElem in trackletsElem:
-        #print 'track:', trackletElem.tag
-        if trackletElem.tag == 'count':
-            nTracklets = int(trackletElem.text)
-            print('File contains', nTracklets, 'tracklets')
-        elif trackletElem.tag == 'item_version':
-            pass
-        elif trackletElem.tag == 'item':
-            #print 'tracklet {0} of {1}'.format(trackletIdx, nTracklets)
-            # a tracklet
-            newTrack = Tracklet()
-            isFinished = False
-            hasAmt = False
-            frameIdx = None
-            for info in trackletElem:
-                #print 'trackInfo:', info.tag
-                if isFinished:
-                    raise ValueError('more info on element after finished!')
-                if info.tag == 'objectType':
-                    newTrack.objectType = info.text
-                elif info.tag == 'h':
-                    newTrack.size[0] = float(info.text)
-                elif info.tag == 'w':
-                    newTrack.size[1] = float(info.text)
-                elif info.tag == 'l':
-                    newTrack.size[2] = float(info.text)
-                elif info.tag == 'first_frame':
-                    newTrack.firstFrame = int(info.text)
-                elif info.tag == 'poses':
-                    # this info is the possibly long list of poses
-                    for pose in info:
-                        #print 'trackInfoPose:', pose.tag
-                        if pose.tag == 'count':     # this should come before the others
-                            if newTrack.nFrames is not None:
-                                raise ValueError('there are several pose lists for a single track!')
-                            elif frameIdx is not None:
-                                raise ValueError('?!')
-                            newTrack.nFrames = int(pose.text)
-                            newTrack.trans = np.nan * np.ones((newTrack.nFrames, 3), dtype=float)
-                            newTrack.rots = np.nan * np.ones((newTrack.nFrames, 3), dtype=float)
-                            newTrack.states = np.nan * np.ones(newTrack.nFrames, dtype='uint8')
-                            newTrack.occs = np.nan * np.ones((newTrack.nFrames, 2), dtype='uint8')
-                            newTrack.truncs = np.nan * np.ones(newTrack.nFrames, dtype='uint8')
-                            newTrack.amtOccs = np.nan * np.ones((newTrack.nFrames, 2), dtype=float)
-                            newTrack.amtBorders = np.nan * np.ones((newTrack.nFrames, 3), dtype=float)
-                            frameIdx = 0
-                        elif pose.tag == 'item_version':
-                            pass
-                        elif pose.tag == 'item':
-                            # pose in one frame
-                            if frameIdx is None:
-                                raise ValueError('pose item came before number of poses!')
-                            for poseInfo in pose:
-                                #print 'trackInfoPoseInfo:', poseInfo.tag
-                                if poseInfo.tag == 'tx':
-                                    newTrack.trans[frameIdx, 0] = float(poseInfo.text)
-                                elif poseInfo.tag == 'ty':
-                                    newTrack.trans[frameIdx, 1] = float(poseInfo.text)
-                                elif poseInfo.tag == 'tz':
-                                    newTrack.trans[frameIdx, 2] = float(poseInfo.text)
-                                elif poseInfo.tag == 'rx':
-                                    newTrack.rots[frameIdx, 0] = float(poseInfo.text)
-                                elif poseInfo.tag == 'ry':
-                                    newTrack.rots[frameIdx, 1] = float(poseInfo.text)
-                                elif poseInfo.tag == 'rz':
-                                    newTrack.rots[frameIdx, 2] = float(poseInfo.text)
-                                elif poseInfo.tag == 'state':
-                                    newTrack.states[frameIdx] = stateFromText[poseInfo.text]
-                                elif poseInfo.tag == 'occlusion':
-                                    newTrack.occs[frameIdx, 0] = occFromText[poseInfo.text]
-                                elif poseInfo.tag == 'occlusion_kf':
-                                    newTrack.occs[frameIdx, 1] = occFromText[poseInfo.text]
-                                elif poseInfo.tag == 'truncation':
-                                    newTrack.truncs[frameIdx] = truncFromText[poseInfo.text]
-                                elif poseInfo.tag == 'amt_occlusion':
-                                    newTrack.amtOccs[frameIdx,0] = float(poseInfo.text)
-                                    hasAmt = True
-                                elif poseInfo.tag == 'amt_occlusion_kf':
-                                    newTrack.amtOccs[frameIdx,1] = float(poseInfo.text)
-                                    hasAmt = True
-                                elif poseInfo.tag == 'amt_border_l':
-                                    newTrack.amtBorders[frameIdx,0] = float(poseInfo.text)
-                                    hasAmt = True
-                                elif poseInfo.tag == 'amt_border_r':
-                                    newTrack.amtBorders[frameIdx,1] = float(poseInfo.text)
-                                    hasAmt = True
-                                elif poseInfo.tag == 'amt_border_kf':
-                                    newTrack.amtBorders[frameIdx,2] = float(poseInfo.text)
-                                    hasAmt = True
-                                else:
-                                    raise ValueError('unexpected tag in poses item: {0}!'.format(poseInfo.tag))
-                            frameIdx += 1
-                        else:
-                            raise ValueError('unexpected pose info: {0}!'.format(pose.tag))
-                elif info.tag == 'finished':
-                    isFinished = True
-                else:
-                    raise ValueError('unexpected tag in tracklets: {0}!'.format(info.tag))
-            #end: for all fields in current tracklet
-
-            # some final consistency checks on new tracklet
-            if not isFinished:
-                warn('tracklet {0} was not finished!'.format(trackletIdx))
-            if newTrack.nFrames is None:
-                warn('tracklet {0} contains no information!'.format(trackletIdx))
-            elif frameIdx != newTrack.nFrames:
-                warn('tracklet {0} is supposed to have {1} frames, but perser found {1}!'.format(trackletIdx, newTrack.nFrames, frameIdx))
-            if np.abs(newTrack.rots[:,:2]).sum() > 1e-16:
-                warn('track contains rotation other than yaw!')
-
-            # if amtOccs / amtBorders are not set, set them to None
-            if not hasAmt:
-                newTrack.amtOccs = None
-                newTrack.amtBorders = None
-
-            # add new tracklet to list
-            tracklets.append(newTrack)
-            trackletIdx += 1
+    def __init__(self, objectTypes, sizes, firstFrames, nFrames, hasAmt, offsets, columns):
+        self.objectTypes = objectTypes
+        self.sizes = sizes
+        self.firstFrames = firstFrames
+        self.nFrames = nFrames
+        self.hasAmt = hasAmt
+        self.offsets = offsets
+        self.ids = np.repeat(np.arange(len(objectTypes), dtype=np.int32), np.diff(offsets))
+        self.frames = (firstFrames[self.ids] + np.arange(offsets[-1]) - offsets[:-1][self.ids]).astype(np.int32)
+        for name, column in columns.items():
+            setattr(self, name, column)
+
+    def __len__(self):
+        """ Returns the number of tracklets """
+        return len(self.objectTypes)
+
+    @property
+    def yaws(self):
+        """ len-P float array of yaw angles (rotation around z); the other rotations are supposed to be 0 """
+        return self.rots[:, 2]
+
+    @property
+    def poseSizes(self):
+        """ P x 3 float array: size of the tracklet of each pose """
+        return self.sizes[self.ids]
+
+    def tracklet(self, idx):
+        """ Returns tracklet idx as a Tracklet whose arrays are views into the columns """
+        newTrack = Tracklet()
+        start, stop = self.offsets[idx], self.offsets[idx+1]
+        newTrack.objectType = self.objectTypes[idx]
+        newTrack.size = self.sizes[idx]
+        newTrack.firstFrame = int(self.firstFrames[idx])
+        newTrack.nFrames = int(self.nFrames[idx])
+        newTrack.trans = self.trans[start:stop]
+        newTrack.rots = self.rots[start:stop]
+        newTrack.states = self.states[start:stop]
+        newTrack.occs = self.occs[start:stop]
+        newTrack.truncs = self.truncs[start:stop]
+        if self.hasAmt[idx]:
+            newTrack.amtOccs = self.amtOccs[start:stop]
+            newTrack.amtBorders = self.amtBorders[start:stop]
+        return newTrack
+
+    def tracklets(self):
+        """ Returns all tracklets as a list of Tracklet views, as returned by parseXML """
+        return [self.tracklet(idx) for idx in range(len(self))]
+
+#end: class TrackletTable
+
+
+# pose item tag -> (column, column index or None, text conversion: float or a dict of enum values)
+poseTags = {'tx': ('trans', 0, float), 'ty': ('trans', 1, float), 'tz': ('trans', 2, float),
+            'rx': ('rots', 0, float), 'ry': ('rots', 1, float), 'rz': ('rots', 2, float),
+            'state': ('states', None, stateFromText),
+            'occlusion': ('occs', 0, occFromText), 'occlusion_kf': ('occs', 1, occFromText),
+            'truncation': ('truncs', None, truncFromText),
+            'amt_occlusion': ('amtOccs', 0, float), 'amt_occlusion_kf': ('amtOccs', 1, float),
+            'amt_border_l': ('amtBorders', 0, float), 'amt_border_r': ('amtBorders', 1, float), 'amt_border_kf': ('amtBorders', 2, float)}
+# column -> (shape of a row, dtype, value when unset)
+poseColumns = {'trans': ((3,), float, np.nan), 'rots': ((3,), float, np.nan), 'states': ((), 'uint8', STATE_UNSET),
+               'occs': ((2,), 'uint8', OCC_UNSET), 'truncs': ((), 'uint8', TRUNC_UNSET),
+               'amtOccs': ((2,), float, np.nan), 'amtBorders': ((3,), float, np.nan)}
+amtTags = [tag for tag in poseTags if tag.startswith('amt_')]
+trackletTags = set(['objectType', 'h', 'w', 'l', 'first_frame', 'poses', 'finished'])
+
+
+def _fromTexts(texts, fromText):
+    """ Converts a list of xml texts with fromText (float or an enum dict) in one go """
+    if fromText is float:
+        return np.array(texts, dtype=float)
+    values, inverse = np.unique(np.array(texts), return_inverse=True)
+    return np.array([fromText[v] for v in values], dtype='uint8')[inverse]
+
+
+def _parsePoses(posesElem, texts, rows, firstRow):
+    """ Appends the texts of all pose items of a tracklet (and their rows, numbered from firstRow) to texts and rows;
+        returns the number of poses and whether the tracklet has amt_* fields """
+    nPoses = 0
+    nAmt = sum(len(texts[tag]) for tag in amtTags)
+    for info in posesElem:
+        if info.tag == 'item':
+            row = firstRow + nPoses
+            for poseInfo in info:
+                if poseInfo.tag not in texts:
+                    raise ValueError('unexpected tag in poses item: {0}!'.format(poseInfo.tag))
+                texts[poseInfo.tag].append(poseInfo.text)
+                rows[poseInfo.tag].append(row)
+            nPoses += 1
+        elif info.tag not in ('count', 'item_version'):
+            raise ValueError('unexpected pose info: {0}!'.format(info.tag))
+    return nPoses, sum(len(texts[tag]) for tag in amtTags) > nAmt
+
+
+def parseXMLColumns(trackletFile):
+    """
+    Parses tracklet xml file in a single streaming pass into a TrackletTable
+
+    The pose texts of each tracklet are collected as soon as it has been read and its element is then cleared and removed
+    from the tree, so memory stays proportional to the number of poses rather than to the size of the xml tree; every
+    column is then converted in one go.
 
+    :param trackletFile: name of a tracklet xml file
+    :returns: TrackletTable with all tracklets of the xml file
+    """
+    print('Parsing tracklet file', trackletFile)
+    objectTypes, sizes, firstFrames, nFramesList, hasAmtList, offsets = [], [], [], [], [], [0]
+    texts = dict((tag, []) for tag in poseTags) # converted column-wise once the whole file has been read
+    rows = dict((tag, []) for tag in poseTags)
+    parser = iterparse(trackletFile, events=('start', 'end'))
+    parents = [] # open elements, to remove each tracklet from its parent once read
+    for event, elem in parser:
+        if event == 'start':
+            parents.append(elem)
+            continue
+        parents.pop()
+        if elem.tag != 'item' or elem.find('objectType') is None: # wait for the end of a whole tracklet
+            continue
+        trackletIdx = len(objectTypes)
+        tags = [info.tag for info in elem]
+        for tag in tags:
+            if tag not in trackletTags:
+                raise ValueError('unexpected tag in tracklets: {0}!'.format(tag))
+        if 'finished' in tags and tags.index('finished') != len(tags)-1:
+            raise ValueError('more info on element after finished!')
+        if 'finished' not in tags:
+            warn('tracklet {0} was not finished!'.format(trackletIdx))
+        size = np.nan*np.ones(3, dtype=float)
+        for i, tag in enumerate(['h', 'w', 'l']):
+            if elem.find(tag) is not None:
+                size[i] = float(elem.find(tag).text)
+        posesElem = elem.find('poses')
+        if posesElem is None:
+            posesElem = Element('poses')
+        counts = posesElem.findall('count')
+        if len(counts) > 1:
+            raise ValueError('there are several pose lists for a single track!')
+        nFrames = int(counts[0].text) if len(counts) == 1 else None
+        nPoses, hasAmt = _parsePoses(posesElem, texts, rows, offsets[-1])
+        if nFrames is None:
+            if nPoses > 0:
+                raise ValueError('pose item came before number of poses!')
+            warn('tracklet {0} contains no information!'.format(trackletIdx))
+        elif nPoses != nFrames:
+            warn('tracklet {0} is supposed to have {1} frames, but perser found {2}!'.format(trackletIdx, nFrames, nPoses))
+
+        objectTypes.append(elem.findtext('objectType'))
+        sizes.append(size)
+        firstFrames.append(int(elem.findtext('first_frame', '0')))
+        nFramesList.append(nFrames if nFrames is not None else 0)
+        hasAmtList.append(hasAmt)
+        offsets.append(offsets[-1] + nPoses)
+        elem.clear()
+        if parents:
+            parents[-1].remove(elem)
+    countText = parser.root.findtext('tracklets/count')
+    nTracklets = int(countText) if countText is not None else len(objectTypes) # <count> is optional, count the items
+    print('File contains', nTracklets, 'tracklets')
+
+    columns = dict((name, np.full((offsets[-1],) + shape, unset, dtype=dtype)) for name, (shape, dtype, unset) in poseColumns.items())
+    for tag, (name, col, fromText) in poseTags.items():
+        if len(texts[tag]) == 0:
+            continue
+        values = _fromTexts(texts[tag], fromText)
+        if col is None:
+            columns[name][rows[tag]] = values
         else:
-            raise ValueError('unexpected tracklet info')
-    #end: for tracklet list items
+            columns[name][rows[tag], col] = values
+    table = TrackletTable(objectTypes, np.array(sizes, dtype=float).reshape((-1, 3)), np.array(firstFrames, dtype=np.int32),
+                          np.array(nFramesList, dtype=np.int32), np.array(hasAmtList, dtype=bool), np.array(offsets, dtype=np.int64), columns)
+    for _ in np.unique(table.ids[np.abs(table.rots[:, :2]).sum(axis=1) > 1e-16]):
+        warn('track contains rotation other than yaw!')
 
-    print('Loaded', trackletIdx, 'tracklets.')
+    print('Loaded', len(table), 'tracklets.')
 
     # final consistency check
-    if trackletIdx != nTracklets:
-        warn('according to xml information the file has {0} tracklets, but parser found {1}!'.format(nTracklets, trackletIdx))
+    if len(table) != nTracklets:
+        warn('according to xml information the file has {0} tracklets, but parser found {1}!'.format(nTracklets, len(table)))
+
+    return table
+#end: function parseXMLColumns
+
 
-    return tracklets
+def parseXML(trackletFile):
+    """ 
+    Parses tracklet xml file and convert results to list of Tracklet objects
+
+    :param trackletFile: name of a tracklet xml file
+    :returns: list of Tracklet objects read from xml file (views into the columns of parseXMLColumns)
+    """
+    return parseXMLColumns(trackletFile).tracklets()
 #end: function parseXML
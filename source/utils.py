@@ -1,4 +1,6 @@
 import sys
+import os
+import hashlib
 import numpy as np
 import parseTrackletXML as xmlParser
 from scipy.spatial import Delaunay
@@ -21,6 +23,195 @@ def in_hull(p,hull):
     return hull.find_simplex(p)>=0
 
 
+def box_frames(boxes):
+    """
+    Centers [M, 3], unit axes [M, 3, 3] (as columns: length, width, height) and half extents [M, 3] of boxes [M, 8, 3]
+    whose corners are ordered as in TrackletBoxes (computeBox3D); the boxes may be rotated/translated rigidly.
+    """
+    centers = boxes.mean(axis=1)
+    edges = np.stack((boxes[:, 3] - boxes[:, 0], boxes[:, 0] - boxes[:, 1], boxes[:, 4] - boxes[:, 0]), axis=2)
+    extents = np.linalg.norm(edges, axis=1)
+    axes = edges / np.maximum(extents, 1e-12)[:, np.newaxis, :]
+    return centers, axes, extents / 2.
+
+
+def in_box(p, box):
+    """ Same as in_hull(p, box) for one tracklet box [8, 3], with an oriented box test instead of a triangulation. """
+    return points_in_boxes(p, box[np.newaxis]) == 0
+
+
+def points_in_boxes(p, boxes):
+    """
+    Labels points p [N, 3] with the index of the box [M, 8, 3] they are in (the first one if boxes overlap), or -1.
+    Points are moved into each box frame and compared against its half extents.
+    """
+    centers, axes, half_extents = box_frames(np.asarray(boxes, dtype=float).reshape((-1, 8, 3)))
+    M = centers.shape[0]
+    if M == 0:
+        return -np.ones(p.shape[0], dtype=np.int64)
+    # one [N, 3] @ [3, 3M] product gives the coordinates of every point along every box axis (in p's float precision),
+    # to be compared against center +- half extent along that axis
+    dtype = np.result_type(p.dtype, np.float32)
+    axes_all = axes.transpose(1, 0, 2).reshape((3, 3 * M)).astype(dtype)
+    offsets = np.einsum('mi,mij->mj', centers, axes)
+    lo, hi = (offsets - half_extents).reshape(-1).astype(dtype), (offsets + half_extents).reshape(-1).astype(dtype)
+    proj = np.dot(p, axes_all)
+    within = ((proj >= lo) & (proj <= hi)).reshape((-1, M, 3))
+    inside = within[:, :, 0] & within[:, :, 1] & within[:, :, 2] # [N, M]
+    return np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+
+
+class BevGrid(object):
+    """
+    Bird's eye view grid over a sweep p [N, 3]: point indices sorted by (x, y) cell, with CSR offsets per cell, so
+    that the points under an axis-aligned xy rectangle are a few contiguous slices (one per grid row).
+    """
+    def __init__(self, p, cell_size=2.):
+        self.cell_size = float(cell_size)
+        self.n_points = p.shape[0]
+        cells = np.floor(p[:, :2] / self.cell_size).astype(np.int64)
+        self.origin = cells.min(axis=0) if self.n_points else np.zeros(2, dtype=np.int64)
+        cells -= self.origin
+        self.shape = cells.max(axis=0) + 1 if self.n_points else np.ones(2, dtype=np.int64)
+        n_cells = int(self.shape[0] * self.shape[1])
+        keys = cells[:, 0] * self.shape[1] + cells[:, 1]
+        if n_cells <= 1 << 16: # numpy radix-sorts 16 bit keys
+            keys = keys.astype(np.uint16)
+        self.order = np.argsort(keys, kind='stable')
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(keys, minlength=n_cells))))
+
+    def candidates(self, xy_min, xy_max):
+        """ Sorted indices of the points whose cell overlaps the rectangle xy_min <= (x, y) <= xy_max. """
+        lo = np.maximum(np.floor(np.asarray(xy_min) / self.cell_size).astype(np.int64) - self.origin, 0)
+        hi = np.minimum(np.floor(np.asarray(xy_max) / self.cell_size).astype(np.int64) - self.origin, self.shape - 1)
+        if np.any(hi < lo):
+            return np.zeros((0,), dtype=np.int64)
+        rows = np.arange(lo[0], hi[0] + 1) * self.shape[1]
+        slices = [self.order[self.offsets[r + lo[1]]:self.offsets[r + hi[1] + 1]] for r in rows]
+        return np.sort(np.concatenate(slices))
+
+
+def points_in_boxes_lists(p, boxes, grid=None):
+    """
+    Indices [K_m] of the points p [N, 3] inside each box [M, 8, 3] (each box on its own, as in_box), testing only the
+    points of a BevGrid under the box footprint. grid may be shared between calls on the same sweep.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape((-1, 8, 3))
+    if grid is None:
+        grid = BevGrid(p)
+    box_points = []
+    for box in boxes:
+        cand = grid.candidates(box[:, :2].min(axis=0), box[:, :2].max(axis=0))
+        box_points.append(cand[points_in_boxes(p[cand], box[np.newaxis]) == 0])
+    return box_points
+
+
+class FrameIndexed(object):
+    """
+    Per-frame view of an array grouped by frame (CSR style): rows offsets[i]:offsets[i+1] belong to frame i, and
+    indexing with a frame returns that zero-copy slice. Behaves like the {frame: list} dicts it replaces
+    (len, keys, values, items).
+    """
+    def __init__(self, array, offsets):
+        self.array = array
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, frame):
+        return self.array[self.offsets[frame]:self.offsets[frame+1]]
+
+    def keys(self):
+        return range(len(self))
+
+    def values(self):
+        return (self[i] for i in range(len(self)))
+
+    def items(self):
+        return ((i, self[i]) for i in range(len(self)))
+
+
+class TrackletBoxes(object):
+    """
+    All in-image tracklet boxes of a drive, sorted by frame: boxes [M, 8, 3] (corners in velodyne coordinates),
+    frames, ids (tracklet index), types (object type), Rmats [M, 3, 3] and ts [M, 3]; the boxes of frame i are rows
+    frame_offsets[i]:frame_offsets[i+1].
+    """
+    def __init__(self, table, n_frames):
+        # determine if object is in the image, and skip poses beyond the last frame
+        keep = np.isin(table.truncs, (xmlParser.TRUNC_IN_IMAGE, xmlParser.TRUNC_TRUNCATED)) & (table.frames < n_frames)
+        rows = np.flatnonzero(keep)
+        rows = rows[np.argsort(table.frames[rows], kind='mergesort')] # stable: tracklet order within each frame
+        assert np.abs(table.rots[rows, :2]).sum() == 0, 'object rotations other than yaw given!'
+
+        self.frames = table.frames[rows]
+        self.ids = table.ids[rows]
+        self.types = np.array(table.objectTypes, dtype=object)[self.ids] if len(table) else np.zeros((0,), dtype=object)
+        self.ts = table.trans[rows]
+        self.frame_offsets = np.searchsorted(self.frames, np.arange(n_frames + 1))
+
+        # this part is inspired by kitti object development kit matlab code: computeBox3D
+        h, w, l = [table.sizes[self.ids, k][:, np.newaxis] for k in range(3)]
+        yaw = table.rots[rows, 2] # other rotations are supposedly 0
+        cos, sin = np.cos(yaw), np.sin(yaw)
+        self.Rmats = np.zeros((len(rows), 3, 3))
+        self.Rmats[:, 0, 0], self.Rmats[:, 0, 1] = cos, -sin
+        self.Rmats[:, 1, 0], self.Rmats[:, 1, 1] = sin, cos
+        self.Rmats[:, 2, 2] = 1.
+        # in velodyne coordinates around zero point and without orientation yet, [M, 8] each
+        x = l * np.array([-0.5, -0.5, 0.5, 0.5, -0.5, -0.5, 0.5, 0.5])
+        y = w * np.array([0.5, -0.5, -0.5, 0.5, 0.5, -0.5, -0.5, 0.5])
+        z = h * np.array([0., 0., 0., 0., 1., 1., 1., 1.])
+        self.boxes = np.stack((cos[:, np.newaxis] * x - sin[:, np.newaxis] * y, sin[:, np.newaxis] * x + cos[:, np.newaxis] * y, z), axis=2)
+        self.boxes += self.ts[:, np.newaxis, :]
+
+    def __len__(self):
+        return self.boxes.shape[0]
+
+    def per_frame(self, array):
+        return FrameIndexed(array, self.frame_offsets)
+
+
+TRACKLET_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'kitti_tracklets')
+
+
+def tracklet_cache_file(xml_path, cache_dir=None):
+    """ Cache file of a tracklet xml file: <cache_dir>/<sha1 of its real path>.npz """
+    cache_dir = TRACKLET_CACHE_DIR if cache_dir is None else cache_dir
+    return os.path.join(cache_dir, hashlib.sha1(os.path.realpath(xml_path).encode('utf-8')).hexdigest() + '.npz')
+
+
+def load_tracklets_cached(xml_path, cache_dir=None):
+    """
+    Returns the TrackletTable of a tracklet xml file (see parseTrackletXML.parseXMLColumns), from the on-disk cache
+    when it was written for the same path, size and mtime, and parses and caches the file otherwise.
+    """
+    cache_file = tracklet_cache_file(xml_path, cache_dir)
+    st = os.stat(xml_path)
+    if os.path.isfile(cache_file):
+        with np.load(cache_file) as cached:
+            if cached['xml_size'] == st.st_size and cached['xml_mtime'] == st.st_mtime:
+                columns = dict((name, cached[name]) for name in xmlParser.poseColumns)
+                return xmlParser.TrackletTable([str(t) for t in cached['objectTypes']], cached['sizes'], cached['firstFrames'],
+                                               cached['nFrames'], cached['hasAmt'], cached['offsets'], columns)
+
+    table = xmlParser.parseXMLColumns(xml_path)
+    if not os.path.isdir(os.path.dirname(cache_file)):
+        os.makedirs(os.path.dirname(cache_file))
+    tmp_file = cache_file + '.tmp.npz'
+    columns = dict((name, getattr(table, name)) for name in xmlParser.poseColumns)
+    np.savez(tmp_file, xml_size=st.st_size, xml_mtime=st.st_mtime, objectTypes=np.array(table.objectTypes, dtype=str),
+             sizes=table.sizes, firstFrames=table.firstFrames, nFrames=table.nFrames, hasAmt=table.hasAmt, offsets=table.offsets, **columns)
+    os.rename(tmp_file, cache_file) # never leave a half-written cache behind
+    return table
+
+
+def load_tracklet_boxes(n_frames, xml_path, cache_dir=None):
+    """ Loads the tracklets of a drive as a TrackletBoxes, with all boxes computed in one batch. """
+    return TrackletBoxes(load_tracklets_cached(xml_path, cache_dir), n_frames)
+
+
 def load_tracklets_for_frames(n_frames, xml_path):
     """
     Loads dataset labels also referred to as tracklets, saving them individually for each frame.
@@ -32,55 +223,13 @@ def load_tracklets_for_frames(n_frames, xml_path):
 
     Returns
     -------
-    Tuple of dictionaries with integer keys corresponding to absolute frame numbers and arrays as values. First array
-    contains coordinates of bounding box vertices for each object in the frame, and the second array contains objects
-    types as strings.
-    """
-    tracklets = xmlParser.parseXML(xml_path)
-
-    frame_tracklets = {}
-    frame_tracklets_types = {}
-    frame_tracklets_id = {}
-    frame_tracklets_Rmat = {}
-    frame_tracklets_t = {}
-    for i in range(n_frames):
-        frame_tracklets[i] = []
-        frame_tracklets_types[i] = []
-        frame_tracklets_id[i] = []
-        frame_tracklets_Rmat[i] = []
-        frame_tracklets_t[i] = []
-    # loop over tracklets
-    for i, tracklet in enumerate(tracklets):
-        # this part is inspired by kitti object development kit matlab code: computeBox3D
-        h, w, l = tracklet.size
-        # in velodyne coordinates around zero point and without orientation yet
-        trackletBox = np.array([
-            [-l / 2, -l / 2, l / 2, l / 2, -l / 2, -l / 2, l / 2, l / 2],
-            [w / 2, -w / 2, -w / 2, w / 2, w / 2, -w / 2, -w / 2, w / 2],
-            [0.0, 0.0, 0.0, 0.0, h, h, h, h]
-        ])
-        # import pdb; pdb.set_trace()
-        # loop over all data in tracklet
-        for translation, rotation, state, occlusion, truncation, amtOcclusion, amtBorders, absoluteFrameNumber in tracklet.__iter__():
-            # determine if object is in the image; otherwise continue
-            if truncation not in (xmlParser.TRUNC_IN_IMAGE, xmlParser.TRUNC_TRUNCATED):
-                continue
-            # re-create 3D bounding box in velodyne coordinate system
-            yaw = rotation[2]  # other rotations are supposedly 0
-            assert np.abs(rotation[:2]).sum() == 0, 'object rotations other than yaw given!'
-            rotMat = np.array([
-                [np.cos(yaw), -np.sin(yaw), 0.0],
-                [np.sin(yaw), np.cos(yaw), 0.0],
-                [0.0, 0.0, 1.0]
-            ])
-            cornerPosInVelo = np.dot(rotMat, trackletBox) + np.tile(translation, (8, 1)).T
-            frame_tracklets[absoluteFrameNumber] += [cornerPosInVelo]
-            frame_tracklets_types[absoluteFrameNumber] += [tracklet.objectType]
-            frame_tracklets_id[absoluteFrameNumber] += [i]
-            frame_tracklets_Rmat[absoluteFrameNumber] += [rotMat]
-            frame_tracklets_t[absoluteFrameNumber] += [translation]
-
-    return (frame_tracklets, frame_tracklets_types, frame_tracklets_id, frame_tracklets_Rmat, frame_tracklets_t)
+    Tuple of per-frame views (FrameIndexed) indexed by absolute frame numbers. First one gives coordinates of bounding
+    box vertices [k, 3, 8] for each object in the frame, then objects types as strings, tracklet ids, rotation matrices
+    and translations; all are slices of the arrays of a TrackletBoxes (see load_tracklet_boxes).
+    """
+    boxes = load_tracklet_boxes(n_frames, xml_path) # parsed xml files are cached, see load_tracklets_cached
+    return (boxes.per_frame(boxes.boxes.transpose(0, 2, 1)), boxes.per_frame(boxes.types), boxes.per_frame(boxes.ids),
+            boxes.per_frame(boxes.Rmats), boxes.per_frame(boxes.ts))
 
 
 # Print iterations progress